@@ -0,0 +1,105 @@
+"""
+Stored value encodings: bytes per key and encode/decode throughput, JSON against binary.
+
+    python -m benchmarks.bench_codec
+
+Each workload is encoded as the log engine used to store values (JSON text) and in the
+ValueCodec binary format without compression, with zlib and with lzma. Bytes per key
+count the value only; the on-disk column writes the workload to a LogStructuredEngine
+and reports the segment bytes per key, record headers and keys included.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+
+from utils.codec import ValueCodec
+from utils.storage_engine import LogStructuredEngine
+
+WORDS = ["order", "shipped", "pending", "customer", "invoice", "warehouse", "priority", "address",
+         "quantity", "returned", "payment", "express", "delivery", "region", "status", "note"]
+
+
+def workloads(count, blob_bytes, seed=7):
+    rng = random.Random(seed)
+
+    def text(size):
+        words = []
+        while sum(len(word) + 1 for word in words) < size:
+            words.append(rng.choice(WORDS) if rng.random() < 0.8 else "".join(rng.choices(string.ascii_letters, k=8)))
+        return " ".join(words)[:size]
+
+    return {
+        "short strings": [f"value-{rng.randrange(10 ** 6)}" for _ in range(count)],
+        "json objects": [{"id": i, "status": rng.choice(WORDS), "price": round(rng.uniform(1, 500), 2),
+                          "tags": rng.sample(WORDS, 3), "active": rng.random() < 0.5} for i in range(count)],
+        f"{blob_bytes // 1024} KB text blobs": [text(blob_bytes) for _ in range(count // 10 or 1)],
+    }
+
+
+class JsonCodec:
+    """The previous record format: the value as JSON text."""
+
+    @staticmethod
+    def encode(value):
+        return json.dumps(value).encode("utf-8")
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data.decode("utf-8"))
+
+
+def throughput(func, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            func(item)
+    return len(items) * repeat / (time.perf_counter() - start)
+
+
+def disk_bytes(values, value_format, compression):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        engine = LogStructuredEngine(os.path.join(tmp_dir, "bench.json"), background_compaction=False,
+                                     value_format=value_format, compression=compression)
+        engine.put_many([(f"key{i:08d}", value) for i, value in enumerate(values)])
+        size = sum(engine._sizes.values())
+        engine.close()
+        return size / len(values)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--values", type=int, default=20000, help="Values per small-value workload.")
+    parser.add_argument("--blob-bytes", type=int, default=4096, help="Size of each text blob.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    formats = [
+        ("json", JsonCodec(), "json", None),
+        ("binary", ValueCodec(), "binary", None),
+        ("binary+zlib", ValueCodec("zlib"), "binary", "zlib"),
+        ("binary+lzma", ValueCodec("lzma"), "binary", "lzma"),
+    ]
+    for name, values in workloads(args.values, args.blob_bytes).items():
+        print(f"{name} ({len(values)} values)")
+        print(f"{'format':>12} {'bytes/key':>10} {'on disk':>10} {'encode/s':>12} {'decode/s':>12}")
+        for label, codec, value_format, compression in formats:
+            encoded = [codec.encode(value) for value in values]
+            assert [codec.decode(data) for data in encoded] == values
+            size = sum(len(data) for data in encoded) / len(values)
+            encode_rate = throughput(codec.encode, values, args.repeat)
+            decode_rate = throughput(codec.decode, encoded, args.repeat)
+            on_disk = disk_bytes(values, value_format, compression)
+            print(f"{label:>12} {size:>10.1f} {on_disk:>10.1f} {encode_rate:>12,.0f} {decode_rate:>12,.0f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
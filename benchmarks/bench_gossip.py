@@ -0,0 +1,110 @@
+"""
+Gossip failure detection: detection latency and network cost as the cluster grows.
+
+    python -m benchmarks.bench_gossip
+
+Every node runs a HealthMonitor whose connection pool is replaced by in-process
+delivery, so only the protocol is measured. After a warm-up, one node stops
+answering and the time until every other node declares it down is recorded.
+All-to-all heartbeating would need n - 1 messages per node per round.
+"""
+import argparse
+import logging
+import statistics
+import threading
+import time
+
+from server.health_monitor import HealthMonitor
+
+
+class LocalNetwork:
+    """Delivers GOSSIP requests straight to the target monitor; dead nodes refuse connections."""
+
+    def __init__(self):
+        self.monitors = {}
+        self.dead = set()
+
+    def request(self, peer, *fields, timeout=None):
+        if peer in self.dead:
+            raise ConnectionRefusedError(f"{peer} is down")
+        return self.monitors[peer].receive_gossip(fields[1])
+
+    def discard(self, peer):
+        pass
+
+
+def measure(node_count, interval, fanout, warmup_rounds):
+    network = LocalNetwork()
+    nodes = [("127.0.0.1", 5000 + i) for i in range(node_count)]
+    for node in nodes:
+        # Each node starts out knowing a single seed; gossip fills in the rest
+        seed = [nodes[0]] if node != nodes[0] else [nodes[1]]
+        network.monitors[node] = HealthMonitor(seed, heartbeat_interval=interval, connection_pool=network,
+                                               self_node=node, fanout=fanout)
+
+    def run_round(alive):
+        threads = [threading.Thread(target=network.monitors[node].gossip_round) for node in alive]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for _ in range(warmup_rounds):
+        run_round(nodes)
+        time.sleep(interval)
+    converged = all(len(monitor.nodes) == node_count - 1 for monitor in network.monitors.values())
+    sent_before = {node: (m.messages_sent, m.bytes_sent, m.rounds) for node, m in network.monitors.items()}
+
+    victim = nodes[-1]
+    network.dead.add(victim)
+    survivors = nodes[:-1]
+    killed_at = time.monotonic()
+    detected = {}
+    while len(detected) < len(survivors) and time.monotonic() - killed_at < 60 * interval:
+        run_round(survivors)
+        now = time.monotonic()
+        for node in survivors:
+            if node not in detected and victim not in network.monitors[node].active_nodes:
+                detected[node] = now - killed_at
+        time.sleep(interval)
+
+    messages = sum(m.messages_sent - sent_before[n][0] for n, m in network.monitors.items() if n in survivors)
+    traffic = sum(m.bytes_sent - sent_before[n][1] for n, m in network.monitors.items() if n in survivors)
+    rounds = sum(m.rounds - sent_before[n][2] for n, m in network.monitors.items() if n in survivors)
+    # Survivors wrongly suspected by another survivor
+    false_downs = sum(other not in network.monitors[node].active_nodes
+                      for node in survivors for other in survivors if other != node)
+    return {
+        "converged": converged,
+        "detected": len(detected),
+        "median_s": statistics.median(detected.values()) if detected else float("nan"),
+        "max_s": max(detected.values()) if detected else float("nan"),
+        "msgs_per_node_round": messages / rounds if rounds else 0.0,
+        "bytes_per_node_round": traffic / rounds if rounds else 0.0,
+        "false_downs": false_downs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", type=int, nargs="*", default=[5, 10, 25, 50])
+    parser.add_argument("--interval", type=float, default=0.05, help="Seconds between gossip rounds.")
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--warmup-rounds", type=int, default=30)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"interval {args.interval * 1000:.0f} ms, fanout {args.fanout}")
+    print(f"{'nodes':>6} {'converged':>9} {'detected':>9} {'median':>9} {'max':>9} "
+          f"{'msgs/node':>10} {'all-to-all':>10} {'bytes/node':>11} {'false':>6}")
+    for node_count in args.nodes:
+        result = measure(node_count, args.interval, args.fanout, args.warmup_rounds)
+        print(f"{node_count:>6} {str(result['converged']):>9} {result['detected']:>4}/{node_count - 1:<4} "
+              f"{result['median_s'] / args.interval:>7.1f}it {result['max_s'] / args.interval:>7.1f}it "
+              f"{result['msgs_per_node_round']:>10.1f} {node_count - 1:>10} "
+              f"{result['bytes_per_node_round']:>11.0f} {result['false_downs']:>6}")
+    print("Detection latency is in gossip intervals; msgs/node is per round, against n - 1 for all-to-all.")
+
+
+if __name__ == "__main__":
+    main()
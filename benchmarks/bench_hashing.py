@@ -0,0 +1,74 @@
+"""
+Ring lookup and preference-list rate, and load balance, as the cluster grows.
+
+    python -m benchmarks.bench_hashing
+"""
+import argparse
+import hashlib
+import statistics
+import time
+
+from utils.hashing import ConsistentHashing, ring_hash
+
+
+def measure(node_count, vnodes, keys):
+    nodes = [("127.0.0.1", 5000 + i) for i in range(node_count)]
+    ring = ConsistentHashing(nodes, vnodes=vnodes)
+    ring_hash.cache_clear()
+
+    start = time.perf_counter()
+    counts = dict.fromkeys(nodes, 0)
+    for key in keys:
+        counts[ring.get_node(key)] += 1
+    cold = len(keys) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in keys:
+        ring.get_node(key)
+    warm = len(keys) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for key in keys:
+        ring.preference_list(key)
+    preference = len(keys) / (time.perf_counter() - start)
+
+    mean = len(keys) / node_count
+    loads = list(counts.values())
+    return {
+        "cold": cold,
+        "warm": warm,
+        "preference": preference,
+        "max_over_mean": max(loads) / mean,
+        "stdev_pct": 100 * statistics.pstdev(loads) / mean,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, nargs="*", default=[3, 10, 50, 100])
+    parser.add_argument("--vnodes", type=int, nargs="*", default=[3, 160])
+    args = parser.parse_args()
+    keys = [f"key{i}" for i in range(args.keys)]
+
+    start = time.perf_counter()
+    for key in keys:
+        int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+    md5_rate = len(keys) / (time.perf_counter() - start)
+    ring_hash.cache_clear()
+    start = time.perf_counter()
+    for key in keys:
+        ring_hash.__wrapped__(key)
+    new_rate = len(keys) / (time.perf_counter() - start)
+    print(f"hash rate: md5 hexdigest->int {md5_rate:,.0f}/s, ring_hash {new_rate:,.0f}/s")
+    print()
+    print(f"{'nodes':>6} {'vnodes':>7} {'lookups/s (cold)':>17} {'lookups/s (cached)':>19} {'pref lists/s':>13} {'max/mean':>9} {'stdev %':>8}")
+    for node_count in args.nodes:
+        for vnodes in args.vnodes:
+            result = measure(node_count, vnodes, keys)
+            print(f"{node_count:>6} {vnodes:>7} {result['cold']:>17,.0f} {result['warm']:>19,.0f} {result['preference']:>13,.0f} "
+                  f"{result['max_over_mean']:>9.2f} {result['stdev_pct']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
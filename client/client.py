@@ -1,11 +1,26 @@
+import itertools
+import json
 import socket
+import uuid
+
+from utils.cache import LRUCache
+from utils.protocol import HELLO, HELLO_OK, STATUS_ERROR, encode_frame, read_frame
 
 class Client:
-    def __init__(self, host='127.0.0.1', port=5000):
+    def __init__(self, host='127.0.0.1', port=5000, protocol="text", cache_lease=None, cache_entries=1000):
         self.host = host
         self.port = port
+        self.protocol = protocol
+        # Optional client-side cache: a GET result is trusted for ``cache_lease`` seconds,
+        # and writes made through this client drop the keys they touch right away
+        self.cache = LRUCache(max_entries=cache_entries, ttl=cache_lease) if cache_lease else None
+        self._socket = None
+        self._stream = None
+        self._request_ids = itertools.count(1)
 
     def send_request(self, command):
+        if self.protocol == "binary":
+            return self.call(*command.split(None))
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
                 client_socket.connect((self.host, self.port))
@@ -15,39 +30,161 @@ class Client:
         except Exception as e:
             return f"Error connecting to {self.host}:{self.port} - {e}"
 
+    def _connect_binary(self):
+        """Open a persistent connection and negotiate the framed protocol."""
+        if self._socket is None:
+            sock = socket.create_connection((self.host, self.port))
+            sock.sendall(HELLO.encode('utf-8'))
+            reply = sock.recv(len(HELLO_OK)).decode('utf-8')
+            if reply != HELLO_OK:
+                sock.close()
+                raise ConnectionError(f"Server does not support the binary protocol: {reply}")
+            self._socket = sock
+            self._stream = sock.makefile('rb')
+        return self._socket
+
+    def call(self, *fields):
+        """Send one command as separate fields, so keys and values may contain spaces."""
+        return self.pipeline([fields])[0]
+
+    def pipeline(self, commands):
+        """Send several commands back to back and collect their responses in order."""
+        try:
+            sock = self._connect_binary()
+            pending = {}
+            frames = []
+            for index, fields in enumerate(commands):
+                request_id = next(self._request_ids)
+                pending[request_id] = index
+                frames.append(encode_frame(request_id, fields))
+            sock.sendall(b"".join(frames))
+            responses = [None] * len(frames)
+            while pending:
+                frame = read_frame(self._stream)
+                if frame is None:
+                    raise ConnectionError("Connection closed by server")
+                request_id, status, fields = frame
+                response = fields[0] if fields else ""
+                if status == STATUS_ERROR and not response.startswith("Error"):
+                    response = f"Error: {response}"
+                responses[pending.pop(request_id)] = response
+            return responses
+        except Exception as e:
+            self.close()
+            return [f"Error connecting to {self.host}:{self.port} - {e}"] * len(commands)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+        self._stream = None
+
     def put(self, key, value):
+        if self.cache is not None:
+            self.cache.invalidate(key)
         try:
+            if self.protocol == "binary":
+                return self.call("PUT", key, value)
             return self.send_request(f"PUT {key} {value}")
         except Exception as e:
             return f"Error during PUT operation: {e}"
 
     def get(self, key):
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         try:
-            return self.send_request(f"GET {key}")
+            if self.protocol == "binary":
+                response = self.call("GET", key)
+            else:
+                response = self.send_request(f"GET {key}")
         except Exception as e:
             return f"Error during GET operation: {e}"
+        if self.cache is not None and not response.startswith("Error"):
+            self.cache.put(key, response)
+        return response
+
+    def mput(self, items, batch_size=500):
+        """
+        Write many key/value pairs (a dict or pairs). Batches always use the framed
+        protocol, since text commands are limited to a single 1 KiB read; chunks of
+        ``batch_size`` pairs are pipelined over one connection.
+        """
+        pairs = list(items.items()) if isinstance(items, dict) else list(items)
+        if self.cache is not None:
+            self.cache.invalidate_many(key for key, _ in pairs)
+        commands = []
+        for start in range(0, len(pairs), batch_size):
+            fields = ["MPUT"]
+            for key, value in pairs[start:start + batch_size]:
+                fields.extend((key, str(value)))
+            commands.append(fields)
+        for response in self.pipeline(commands):
+            if response.startswith("Error"):
+                return response
+        return f"MPUT {len(pairs)} OK"
+
+    def mget(self, keys, batch_size=500):
+        """Read many keys at once; returns {key: value or None}, or an error string."""
+        keys = list(keys)
+        commands = [["MGET"] + keys[start:start + batch_size] for start in range(0, len(keys), batch_size)]
+        values = {}
+        for response in self.pipeline(commands):
+            if response.startswith("Error"):
+                return response
+            values.update(json.loads(response))
+        return values
+
+    def transact(self, items, transaction_id=None):
+        """Write a dict of key/value pairs atomically across their owning nodes (two-phase commit)."""
+        if self.cache is not None:
+            self.cache.invalidate_many(items)
+        fields = ["TRANSACTION", transaction_id or uuid.uuid4().hex, "EXECUTE"]
+        for key, value in items.items():
+            fields.extend((key, str(value)))
+        return self.call(*fields)
+
+    def cluster_scan_page(self, limit=500, token=None):
+        """One page of a whole-table scan: (items, token). Pass the token back to resume; None means done."""
+        response = self.call("CLUSTER_SCAN", str(limit), *([token] if token else []))
+        if response.startswith("Error"):
+            raise ConnectionError(response)
+        page = json.loads(response)
+        return [tuple(item) for item in page["items"]], page["token"]
+
+    def scan_cluster(self, page_size=500, token=None):
+        """Yield every (key, value) in the cluster in key order, fetching one page at a time."""
+        while True:
+            items, token = self.cluster_scan_page(page_size, token)
+            yield from items
+            if token is None:
+                return
         
 
-# Primary server client
-primary_client = Client(host="127.0.0.1", port=5000)
+if __name__ == "__main__":
+    # Primary server client
+    primary_client = Client(host="127.0.0.1", port=5000)
 
-# Replica servers clients
-replica_clients = [
-    Client(host="127.0.0.1", port=5001),  # Replica 1
-    Client(host="127.0.0.1", port=5002),  # Replica 2
-]
+    # Replica servers clients
+    replica_clients = [
+        Client(host="127.0.0.1", port=5001),  # Replica 1
+        Client(host="127.0.0.1", port=5002),  # Replica 2
+    ]
 
-# PUT operation on the primary server
-key = "key1"
+    # PUT operation on the primary server
+    key = "key1"
 
-# value = "value1"
-# print(f"Primary PUT Response: {primary_client.put(key, value)}")
+    # value = "value1"
+    # print(f"Primary PUT Response: {primary_client.put(key, value)}")
 
-# client = Client(host="127.0.0.1", port=5000)
-# replica_client = Client(host="127.0.0.1", port=5001)
-print(primary_client.put("key2", 69))
-print(primary_client.get("key1"))
-# print(client.put("key1", "value1"))
+    # client = Client(host="127.0.0.1", port=5000)
+    # replica_client = Client(host="127.0.0.1", port=5001)
+    print(primary_client.put("key2", 69))
+    print(primary_client.get("key1"))
+    # print(client.put("key1", "value1"))
 
-# replica_client = Client(host="127.0.0.1", port=5001)
-# print(replica_client.get("key1"))
+    # replica_client = Client(host="127.0.0.1", port=5001)
+    # print(replica_client.get("key1"))
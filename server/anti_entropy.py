@@ -0,0 +1,186 @@
+import json
+import logging
+import threading
+
+from server.health_monitor import MerkleTree, node_name
+from server.versioning import newer
+
+
+class AntiEntropy:
+    """
+    Merkle-tree based repair between two nodes.
+
+    Both sides keep a MerkleTree of the same depth over the same hashed key ranges.
+    The initiator compares subtree hashes level by level, descending only into
+    children of nodes that differ, until it reaches the divergent leaf buckets. Only
+    the keys of those buckets are exchanged, so repair traffic follows the size of the
+    divergence rather than the size of the data set. Keys travel with their version
+    (``[key, value, version]``), so the receiving side keeps whichever copy is newer.
+
+    With ``owns(node, key)``, a pair of nodes compares a tree built only over the keys
+    both of them replicate, so with more nodes than replicas the keys held by just one
+    of them do not show up as divergence. These shared trees are built on first use,
+    kept current by watching storage, and dropped by ``invalidate()`` when the ring
+    changes.
+    """
+
+    def __init__(self, merkle_tree, storage, send, apply_batch, buckets_per_request=32, node=None, owns=None,
+                 versions=None):
+        self.merkle_tree = merkle_tree
+        self.storage = storage
+        self.versions = versions        # key -> version store of the stored values, or None
+        self.send = send                # send(peer, *fields) -> response text
+        self.apply_batch = apply_batch  # apply_batch([(key, value, version), ...]) -> the writes applied
+        self.buckets_per_request = buckets_per_request
+        self.node = node                # (host, port) of this node, for owns()
+        self.owns = owns or (lambda node, key: True)
+        self._shared = {}               # peer -> MerkleTree over the keys both nodes replicate
+        self._lock = threading.Lock()
+        storage.watch(self)
+
+    # -- shared trees --------------------------------------------------------
+
+    def shared_tree(self, peer):
+        """The tree over the keys this node and ``peer`` both replicate (the full tree without a peer)."""
+        if peer is None or self.node is None:
+            return self.merkle_tree
+        with self._lock:
+            tree = self._shared.get(peer)
+            if tree is None:
+                tree = self._shared[peer] = MerkleTree(self.merkle_tree.depth)
+                for bucket in self.merkle_tree.buckets:
+                    for key in list(bucket):
+                        value = self.storage[key]
+                        if value is not None and self._shares(peer, key):
+                            tree.update(key, value)
+            return tree
+
+    def invalidate(self):
+        """Drop the shared trees; call when the ring changes which nodes replicate which keys."""
+        with self._lock:
+            self._shared.clear()
+
+    def _shares(self, peer, key):
+        return self.owns(self.node, key) and self.owns(peer, key)
+
+    def update(self, key, value):
+        """Storage watcher: a key was written."""
+        with self._lock:
+            for peer, tree in self._shared.items():
+                if self._shares(peer, key):
+                    tree.update(key, value)
+
+    def remove(self, key):
+        """Storage watcher: a key was deleted."""
+        with self._lock:
+            for tree in self._shared.values():
+                tree.remove(key)
+
+    # -- serving side --------------------------------------------------------
+
+    def check_hash(self, root_hash, peer=None):
+        return "MATCH" if root_hash == self.shared_tree(peer).root_hash else "MISMATCH"
+
+    def node_hashes(self, depth, indices, peer=None):
+        """Hashes of the given heap indices (1 is the root, children of i are 2i and 2i+1)."""
+        tree = self.shared_tree(peer)
+        if int(depth) != tree.depth:
+            return f"Error: Merkle depth mismatch (local {tree.depth}, remote {depth})"
+        nodes = tree.nodes
+        return json.dumps([nodes[int(index)].hex() for index in indices.split(",") if index])
+
+    def version_of(self, key):
+        return self.versions.get(key) if self.versions is not None else None
+
+    def range_items(self, buckets, peer=None):
+        """Every key currently stored in the given leaf buckets, as ``{key: [value, version]}``."""
+        tree = self.shared_tree(peer)
+        items = {}
+        for bucket in buckets.split(","):
+            if not bucket:
+                continue
+            for key in list(tree.buckets[int(bucket)]):
+                value = self.storage[key]
+                if value is not None:
+                    items[key] = [value, self.version_of(key)]
+        return json.dumps(items)
+
+    def apply_range(self, payload):
+        """Handle RANGE_APPLY: apply ``[[key, value, version], ...]`` and report how many writes were kept."""
+        return f"OK {len(self.apply_batch(json.loads(payload)))}"
+
+    # -- initiating side -----------------------------------------------------
+
+    def _identity(self):
+        return (node_name(self.node),) if self.node is not None else ()
+
+    def divergent_buckets(self, peer):
+        """Walk both trees top-down and return the leaf buckets whose hashes differ."""
+        tree = self.shared_tree(peer)
+        frontier = [1]
+        rounds = 0
+        while frontier:
+            response = self.send(peer, "MERKLE_NODES", tree.depth, ",".join(map(str, frontier)), *self._identity())
+            if response.startswith("Error"):
+                raise RuntimeError(response)
+            rounds += 1
+            remote = json.loads(response)
+            differing = [index for index, digest in zip(frontier, remote) if tree.nodes[index].hex() != digest]
+            if not differing or differing[0] >= tree.leaf_count:
+                return [index - tree.leaf_count for index in differing], rounds
+            frontier = [child for index in differing for child in (2 * index, 2 * index + 1)]
+        return [], rounds
+
+    def sync_with(self, peer, prefer_remote=False):
+        """
+        Repair divergent key ranges with ``peer``: keys missing on one side are copied
+        to it, and a key holding different values on both sides is settled by version,
+        the newer copy going to the other side. Two copies without a version are settled
+        by ``prefer_remote`` (e.g. while this node recovers) or else by value, so both
+        sides pick the same one.
+        """
+        tree = self.shared_tree(peer)
+        buckets, rounds = self.divergent_buckets(peer)
+        stats = {"rounds": rounds, "buckets": len(buckets), "pulled": 0, "pushed": 0, "conflicts": 0}
+        for start in range(0, len(buckets), self.buckets_per_request):
+            chunk = buckets[start:start + self.buckets_per_request]
+            remote = json.loads(self.send(peer, "RANGE_FETCH", ",".join(map(str, chunk)), *self._identity()))
+            pull, push = [], []
+            for bucket in chunk:
+                for key in list(tree.buckets[bucket]):
+                    if key not in remote:
+                        value = self.storage[key]
+                        if value is not None:
+                            push.append((key, value, self.version_of(key)))
+            for key, (value, version) in remote.items():
+                local = self.storage[key]
+                if local is None:
+                    pull.append((key, value, version))
+                elif not tree.verify_data(key, value):
+                    stats["conflicts"] += 1
+                    local_version = self.version_of(key)
+                    if self._remote_wins(value, version, local, local_version, prefer_remote):
+                        pull.append((key, value, version))
+                    else:
+                        push.append((key, local, local_version))
+            # Only the writes the receiving side kept count; it skips copies older than its own
+            if pull:
+                stats["pulled"] += len(self.apply_batch(pull))
+            if push:
+                response = self.send(peer, "RANGE_APPLY", json.dumps(push))
+                if not response.startswith("OK"):
+                    raise RuntimeError(response)
+                stats["pushed"] += int(response.split()[1])
+        logging.info(f"Anti-entropy with {peer}: {stats}")
+        return stats
+
+    @staticmethod
+    def _remote_wins(value, version, local, local_version, prefer_remote):
+        if newer(version, local_version):
+            return True
+        if newer(local_version, version):
+            return False
+        if prefer_remote:
+            return True
+        return json.dumps(value, sort_keys=True) > json.dumps(local, sort_keys=True)
+
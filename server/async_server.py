@@ -0,0 +1,165 @@
+import asyncio
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from server.server import Server
+from utils.protocol import (
+    HELLO, HELLO_OK, STATUS_OK, STATUS_ERROR, ProtocolError, encode_frame, read_frame_async,
+)
+
+
+class AsyncConnectionPool:
+    """
+    Keeps idle framed-protocol streams to each peer so replication reuses connections.
+    A request that takes longer than ``request_timeout`` fails and its stream is closed.
+    """
+
+    def __init__(self, max_idle_per_peer=8, connect_timeout=2, request_timeout=5):
+        self.max_idle_per_peer = max_idle_per_peer
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self._idle = {}  # peer -> [(reader, writer), ...]
+        self._request_ids = itertools.count(1)
+
+    async def _connect(self, peer):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*peer), self.connect_timeout)
+        writer.write(HELLO.encode('utf-8'))
+        await writer.drain()
+        reply = await asyncio.wait_for(reader.readexactly(len(HELLO_OK)), self.connect_timeout)
+        if reply.decode('utf-8') != HELLO_OK:
+            writer.close()
+            raise ConnectionError(f"Peer {peer} does not support the binary protocol")
+        return reader, writer
+
+    async def _acquire(self, peer):
+        idle = self._idle.setdefault(peer, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await self._connect(peer)
+
+    def _release(self, peer, reader, writer):
+        idle = self._idle.setdefault(peer, [])
+        if len(idle) < self.max_idle_per_peer and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, peer, *fields, timeout=None):
+        """Send one command to ``peer`` and return its response text."""
+        return await asyncio.wait_for(self._exchange(peer, fields), timeout or self.request_timeout)
+
+    async def _exchange(self, peer, fields):
+        reader, writer = await self._acquire(peer)
+        try:
+            request_id = next(self._request_ids)
+            writer.write(encode_frame(request_id, fields))
+            await writer.drain()
+            frame = await read_frame_async(reader)
+            if frame is None or frame[0] != request_id:
+                raise ConnectionError(f"Unexpected reply from {peer}")
+        except BaseException:
+            # Including the cancellation by a timeout, which leaves the stream mid-request
+            writer.close()
+            raise
+        self._release(peer, reader, writer)
+        return frame[2][0] if frame[2] else ""
+
+    def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncServer(Server):
+    """
+    Serves the same command set as Server from a single asyncio event loop.
+
+    Connections are coroutines rather than threads; commands that touch storage run on
+    a bounded executor so disk I/O never stalls the loop, and replication batches go
+    through pooled framed streams owned by the loop.
+    """
+
+    def __init__(self, *args, executor_workers=32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+        self.replica_pool = AsyncConnectionPool(request_timeout=self.connection_pool.request_timeout)
+        self.loop = None
+        self._loop_ready = threading.Event()  # set once serve() runs the loop
+
+    def start_server(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.executor)
+        self._loop_ready.set()
+        listener = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Server started on {self.host}:{self.port}")
+        logging.info(f"Server started on {self.host}:{self.port} (asyncio)")
+        async with listener:
+            await listener.serve_forever()
+
+    async def run_command(self, command_parts, addr):
+        if command_parts and command_parts[0] == "HEARTBEAT":
+            return self.dispatch(command_parts, addr)
+        return await self.loop.run_in_executor(None, self.dispatch, command_parts, addr)
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        logging.info(f"Connection established with {addr}")
+        try:
+            while True:
+                data = (await reader.read(1024)).decode('utf-8').strip()
+                if not data:
+                    break
+                if data == HELLO:
+                    writer.write(HELLO_OK.encode('utf-8'))
+                    await writer.drain()
+                    await self.handle_binary_connection(reader, writer, addr)
+                    break
+                try:
+                    response = await self.run_command(data.split(None), addr)
+                except Exception as e:
+                    logging.error(f"Error processing request from {addr}: {e}")
+                    response = f"Error: {e}"
+                writer.write(response.encode('utf-8'))
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            logging.error(f"Error handling client {addr}: {e}")
+        finally:
+            writer.close()
+
+    async def handle_binary_connection(self, reader, writer, addr):
+        while True:
+            try:
+                frame = await read_frame_async(reader)
+            except ProtocolError as e:
+                logging.error(f"Malformed frame from {addr}: {e}")
+                return
+            if frame is None:
+                return
+            request_id, _, fields = frame
+            try:
+                response = await self.run_command(fields, addr)
+            except Exception as e:
+                logging.error(f"Error processing request from {addr}: {e}")
+                response = f"Error: {e}"
+            status = STATUS_ERROR if response.startswith("Error") else STATUS_OK
+            writer.write(encode_frame(request_id, [response], status))
+            await writer.drain()
+
+    def send_to_peer(self, peer, *fields, timeout=None):
+        # Called from replication and executor threads; the send itself runs on the event loop,
+        # so traffic started before start_server() (e.g. --join) waits for the loop to run.
+        # The pool bounds the request with its own timeout.
+        self._loop_ready.wait()
+        future = asyncio.run_coroutine_threadsafe(self.replica_pool.request(peer, *fields, timeout=timeout), self.loop)
+        return future.result()
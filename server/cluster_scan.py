@@ -0,0 +1,105 @@
+import base64
+import bisect
+import heapq
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from utils.hashing import ring_hash
+
+
+def encode_token(after):
+    return base64.urlsafe_b64encode(json.dumps({"after": after}).encode("utf-8")).decode("ascii")
+
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode("ascii")))["after"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid continuation token '{token}'")
+
+
+class ClusterScan:
+    """
+    Scatter-gather scan of the whole table in key order.
+
+    The ring is split into ``(start, end]`` hash ranges by owning node. Every node is
+    asked, in parallel and at most ``concurrency`` at a time, for its next page of keys
+    whose hash falls in its own ranges, and the sorted pages are merged. A page only
+    emits keys up to the point every unfinished node has reached, and the continuation
+    token is the last emitted key. The coordinator therefore holds at most one page per
+    node, and a scan can resume from any token.
+    """
+
+    def __init__(self, node, storage, hashing, send, active_nodes, concurrency=8, max_examined=10000):
+        self.node = node                  # (host, port) of this node
+        self.storage = storage
+        self.hashing = hashing
+        self.send = send                  # send(peer, *fields) -> response text
+        self.active_nodes = active_nodes  # active_nodes() -> set of healthy nodes
+        self.max_examined = max_examined
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    # -- serving side --------------------------------------------------------
+
+    def local_page(self, ranges, limit, after=None):
+        """
+        Up to ``limit`` local items in key order whose hash lies in ``ranges``, after key
+        ``after``. ``frontier`` is the last key looked at (None once the keys ran out).
+        At most ``max_examined`` keys are looked at per call.
+        """
+        ends = [end for _, end in ranges]
+        items, examined = [], 0
+        while examined < self.max_examined:
+            keys = self.storage.key_index.range("", limit=min(limit * 4, self.max_examined - examined), after=after)
+            if not keys:
+                return {"items": items, "frontier": None}
+            for key in keys:
+                examined += 1
+                after = key
+                position = ring_hash(key)
+                index = bisect.bisect_left(ends, position)
+                if index < len(ranges) and ranges[index][0] < position:
+                    value = self.storage[key]
+                    if value is not None:
+                        items.append((key, value))
+                        if len(items) == limit:
+                            return {"items": items, "frontier": key}
+        return {"items": items, "frontier": after}
+
+    # -- coordinating side ---------------------------------------------------
+
+    def _fetch(self, node, ranges, limit, after):
+        if node != self.node:
+            try:
+                fields = ["TOKEN_SCAN", json.dumps(ranges), limit] + ([after] if after is not None else [])
+                response = self.send(node, *fields)
+                if not response.startswith("Error"):
+                    return json.loads(response)
+                logging.error(f"Node {node} failed a scan page: {response}")
+            except Exception as e:
+                logging.error(f"Failed to scan node {node}: {e}")
+        # Serve the node's ranges from the local copy when it cannot answer
+        return self.local_page(ranges, limit, after)
+
+    def page(self, limit, token=None):
+        """One page of the cluster-wide scan: (items, continuation token or None when done)."""
+        after = decode_token(token) if token else None
+        ranges = self.hashing.token_ranges(self.active_nodes())
+        futures = [self._executor.submit(self._fetch, node, owned, limit, after) for node, owned in ranges.items()]
+        pages = [future.result() for future in futures]
+
+        frontiers = [page["frontier"] for page in pages if page["frontier"] is not None]
+        bound = min(frontiers) if frontiers else None
+        merged = heapq.merge(*[[tuple(item) for item in page["items"]] for page in pages], key=itemgetter(0))
+        items = []
+        for item in merged:
+            if len(items) == limit or (bound is not None and item[0] > bound):
+                break
+            items.append(item)
+        if len(items) == limit:
+            return items, encode_token(items[-1][0])
+        if bound is not None:
+            return items, encode_token(bound)
+        return items, None
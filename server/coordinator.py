@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def coordinator_of(transaction_id):
+    """The (host, port) that coordinates a distributed transaction id, or None for a local one."""
+    if "/" not in transaction_id:
+        return None
+    host, _, port = transaction_id.split("/", 1)[0].rpartition(":")
+    return host, int(port)
+
+
+class TransactionCoordinator:
+    """
+    Two-phase commit across the nodes owning a transaction's keys.
+
+    Operations are grouped by owning node and every participant gets its PREPARE in
+    parallel. Only if all of them vote yes is the COMMIT decision written durably to
+    the decision log; the COMMITs are then sent in parallel too, so a transaction costs
+    one parallel round trip per phase. Without a logged decision a transaction is
+    presumed aborted, so ABORT needs no log record.
+
+    Transaction ids are ``<host>:<port>/<id>``, which lets a participant that restarts
+    with an in-doubt PREPARED transaction ask its coordinator for the outcome
+    (``TRANSACTION <id> STATUS``). A restarted coordinator re-sends the COMMITs of
+    every logged decision that was not yet acknowledged by all participants.
+    """
+
+    def __init__(self, node, owners, send, local, log, concurrency=16, retry_interval=1.0):
+        self.node = node                    # (host, port) of this node
+        self.owners = owners                # owners(keys) -> {node: [key, ...]}
+        self.send = send                    # send(peer, *fields) -> response text
+        self.local = local                  # local(*fields) -> response text, for this node's share
+        self.log = log                      # TransactionLog of COMMIT decisions
+        self.retry_interval = retry_interval
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._lock = threading.Lock()
+        self._in_progress = set()
+
+    def global_id(self, transaction_id):
+        return f"{self.node[0]}:{self.node[1]}/{transaction_id}"
+
+    def _call(self, participant, *fields):
+        try:
+            if participant == self.node:
+                return self.local(*fields)
+            return self.send(participant, *fields)
+        except Exception as e:
+            return f"Error: {e}"
+
+    def _broadcast(self, requests):
+        """Send ``{participant: fields}`` in parallel; returns {participant: response}."""
+        futures = {participant: self._executor.submit(self._call, participant, *fields)
+                   for participant, fields in requests.items()}
+        return {participant: future.result() for participant, future in futures.items()}
+
+    def execute(self, transaction_id, operations):
+        """Atomically apply ``{key: value}`` across the cluster; returns (committed, global id)."""
+        tid = self.global_id(transaction_id)
+        groups = self.owners(operations)
+        with self._lock:
+            self._in_progress.add(tid)
+        try:
+            prepares = {}
+            for participant, keys in groups.items():
+                fields = ["TRANSACTION", tid, "PREPARE"]
+                for key in keys:
+                    fields.extend((key, operations[key]))
+                prepares[participant] = fields
+            votes = self._broadcast(prepares)
+            voted_yes = [participant for participant, vote in votes.items() if vote.endswith("PREPARED")]
+            if len(voted_yes) < len(votes):
+                refused = {participant: vote for participant, vote in votes.items() if participant not in voted_yes}
+                logging.info(f"Transaction {tid} aborted; participants refused to prepare: {refused}")
+                # A participant whose vote was lost (e.g. timed out) may still have prepared;
+                # rolling back an unknown transaction changes nothing on the others
+                self._broadcast({participant: ["TRANSACTION", tid, "ROLLBACK"] for participant in prepares})
+                return False, tid
+            self.log.append(tid, decision="COMMIT", participants=[list(participant) for participant in groups])
+        finally:
+            with self._lock:
+                self._in_progress.discard(tid)
+        if not self._commit_all(tid, list(groups)):
+            # Decided and logged: the remaining participants are retried in the background
+            threading.Thread(target=self._finish, args=(tid, list(groups)), daemon=True).start()
+        return True, tid
+
+    def _commit_all(self, tid, participants):
+        """Send COMMIT in parallel; True once every participant applied (or already finished) it."""
+        acks = self._broadcast({participant: ["TRANSACTION", tid, "COMMIT"] for participant in participants})
+        pending = [participant for participant, response in acks.items()
+                   if not (response.endswith("COMMITTED") or response.endswith("not found."))]
+        if pending:
+            logging.error(f"Transaction {tid} not yet committed on {pending}: {[acks[p] for p in pending]}")
+            return False
+        self.log.append(tid, done=True)
+        return True
+
+    def _finish(self, tid, participants):
+        while not self._commit_all(tid, participants):
+            time.sleep(self.retry_interval)
+
+    def status(self, tid):
+        """COMMITTED, PENDING while the prepare phase runs, or ABORTED (presumed)."""
+        with self._lock:
+            if tid in self._in_progress:
+                return "PENDING"
+        record = self.log.pending.get(tid)
+        if record is not None and record.get("decision") == "COMMIT":
+            return "COMMITTED"
+        # A COMMIT decision is retired only once every participant applied it, so no one can be in doubt
+        return "ABORTED"
+
+    def recover(self):
+        """Finish, in the background, the logged commits of a previous run."""
+        for tid, record in list(self.log.pending.items()):
+            if record.get("decision") == "COMMIT":
+                participants = [tuple(participant) for participant in record["participants"]]
+                threading.Thread(target=self._finish, args=(tid, participants), daemon=True).start()
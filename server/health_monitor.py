@@ -3,107 +3,350 @@ import time
 import socket
 import logging
 import hashlib
-# from .server import hashing_list
+import json
+import math
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.connection_pool import ConnectionPool
+from utils.hashing import ring_hash
+
+class PhiAccrualDetector:
+    """
+    Phi-accrual failure detector (Hayashibara et al.).
+
+    Instead of a fixed timeout, each node's heartbeat inter-arrival times are sampled
+    and ``phi`` expresses how unlikely the current silence is under that history:
+    phi = -log10(P(a heartbeat arrives later than now)). A node is suspected once phi
+    exceeds ``threshold``; 8 corresponds to one false suspicion in 10^8.
+    """
+
+    def __init__(self, threshold=8.0, window=100, min_std=0.25, acceptable_pause=0.0, first_interval=1.0):
+        self.threshold = threshold
+        self.window = window
+        self.min_std = max(min_std, 0.001)  # a zero deviation would make phi divide by zero
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self._intervals = {}  # node -> deque of seconds between heartbeats
+        self._last = {}       # node -> monotonic time of its last heartbeat
+
+    def heartbeat(self, node, now=None):
+        now = time.monotonic() if now is None else now
+        last = self._last.get(node)
+        intervals = self._intervals.get(node)
+        if intervals is None:
+            # Seed with the expected interval so phi is meaningful from the first beat
+            intervals = self._intervals[node] = deque([self.first_interval, self.first_interval], maxlen=self.window)
+        elif last is not None:
+            intervals.append(now - last)
+        self._last[node] = now
+
+    def last_heartbeat(self, node):
+        return self._last.get(node)
+
+    def phi(self, node, now=None):
+        last = self._last.get(node)
+        if last is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        intervals = self._intervals[node]
+        mean = sum(intervals) / len(intervals)
+        std = max(self.min_std, math.sqrt(sum((i - mean) ** 2 for i in intervals) / len(intervals)))
+        mean += self.acceptable_pause
+        # Logistic approximation of the normal CDF, as used by Akka and Cassandra
+        # Clamped so exp() stays finite; |y| = 10 already means phi ~ 37
+        y = min(10.0, max(-10.0, (now - last - mean) / std))
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if now - last > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def is_available(self, node, now=None):
+        return self.phi(node, now) < self.threshold
+
+    def forget(self, node):
+        self._intervals.pop(node, None)
+        self._last.pop(node, None)
+
+
+def node_name(node):
+    return f"{node[0]}:{node[1]}"
+
+
+def parse_node(name):
+    host, _, port = name.rpartition(":")
+    return host, int(port)
+
 
 class HealthMonitor:
-    def __init__(self, nodes, heartbeat_interval=5):
-        self.nodes = nodes  # List of other nodes
+    """
+    Gossip-based membership with phi-accrual failure detection.
+
+    Every ``heartbeat_interval`` seconds the node bumps its own heartbeat counter and
+    exchanges its membership table with ``fanout`` random peers in parallel
+    (push-pull). Each entry is ``[generation, heartbeat]``, where the generation is the
+    node's start time, so a restarted node is never mistaken for an old one. A node's
+    entry advancing, whichever peer brought the news, counts as a heartbeat for the
+    PhiAccrualDetector. A node is in ``active_nodes`` while its phi stays under the
+    threshold, so one slow peer delays no one. A round costs ``fanout`` messages per
+    node instead of a heartbeat to every peer, and news spreads in O(log n) rounds.
+
+    Nodes learned through gossip are added to the membership and reported through
+    ``on_join(node)``; ``on_status(node, alive)`` fires whenever a node goes down or
+    comes back. A ``heartbeat_interval`` of 0 disables failure detection: every known
+    node stays in ``active_nodes``.
+    """
+
+    def __init__(self, nodes, heartbeat_interval=1.0, connection_pool=None, self_node=None, fanout=3,
+                 phi_threshold=8.0, on_join=None, on_status=None):
+        self.nodes = list(nodes)  # List of other nodes
         self.heartbeat_interval = heartbeat_interval
         self.active_nodes = set(nodes)
+        self.connection_pool = connection_pool or ConnectionPool()
+        self.self_node = self_node
+        self.fanout = fanout
+        self.on_join = on_join
+        self.on_status = on_status
+        self.detector = PhiAccrualDetector(threshold=phi_threshold, min_std=heartbeat_interval / 4,
+                                           acceptable_pause=heartbeat_interval, first_interval=heartbeat_interval)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, fanout))
+        self.membership = {}  # "host:port" -> [generation, heartbeat]
+        self.departed = {}    # "host:port" -> generation of a node that left; its old entries are ignored
+        if self_node is not None:
+            self.membership[node_name(self_node)] = [time.time(), 0]
+        for node in self.nodes:
+            self.detector.heartbeat(node)
+        self.rounds = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.detections = []  # (node, seconds from its last heartbeat to being declared down)
+
+    def is_alive(self, node):
+        return node in self.active_nodes
 
     def send_heartbeat(self, node):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(2)
-                sock.connect(node)
-                sock.sendall("HEARTBEAT".encode('utf-8'))
-                response = sock.recv(1024).decode('utf-8')
-                if response != "ALIVE":
-                    raise Exception("Unexpected response")
+            response = self.connection_pool.request(node, "HEARTBEAT", timeout=2)
+            if response != "ALIVE":
+                raise Exception("Unexpected response")
             return True
         except:
+            # Do not hand a half-dead connection to the next caller
+            self.connection_pool.discard(node)
             return False
-    
-    # def redistribute_data(self, failed_node):
-    #     logging.warning(f"Redistributing data from failed node {failed_node}")
-        
-    #     # Remove the failed node from consistent hashing
-    #     # hashing_list.remove_node(failed_node)
-        
-    #     # Retrieve keys for which the failed node was responsible
-    #     # failed_keys = hashing_list.get_keys_responsible(failed_node)  # Add logic to get keys for failed node
-    #     for key in failed_keys:
-    #         # Use replicas to retrieve the value
-    #         value = self.retrieve_from_replicas(key)  # Ensure replication logic exists
-    #         responsible_node = hashing_list.get_node(key)
-    #         try:
-    #             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    #                 sock.connect(responsible_node)
-    #                 sock.sendall(f"PUT {key} {value}".encode('utf-8'))
-    #             logging.info(f"Key '{key}' redistributed to node {responsible_node}")
-    #         except Exception as e:
-    #             logging.error(f"Failed to redistribute key '{key}' to node {responsible_node}: {e}")
-    
+
     def retrieve_from_replicas(self, key):
         # Add logic to fetch the key's value from available replicas
         for node in self.active_nodes:
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.connect(node)
-                    sock.sendall(f"GET {key}".encode('utf-8'))
-                    response = sock.recv(1024).decode('utf-8')
-                    if "Error" not in response:
-                        return response  # Key value retrieved
+                response = self.connection_pool.request(node, "GET", key)
+                if "Error" not in response:
+                    return response  # Key value retrieved
             except:
                 continue
         logging.error(f"Key '{key}' not found in any replica.")
         return None
 
-    def monitor_nodes(self):
-        while True:
+    # -- gossip ----------------------------------------------------------------
+
+    def digest(self):
+        with self._lock:
+            return json.dumps(self.membership, separators=(",", ":"))
+
+    def merge(self, table):
+        """Merge a peer's membership table; newer entries count as heartbeats of their node."""
+        joined = []
+        with self._lock:
+            for name, entry in table.items():
+                entry = list(entry)
+                node = parse_node(name)
+                if node == self.self_node or entry[0] <= self.departed.get(name, -1):
+                    continue
+                known = self.membership.get(name)
+                if known is not None and entry <= known:
+                    continue
+                self.membership[name] = entry
+                self.detector.heartbeat(node)
+                if node not in self.nodes:
+                    self.nodes.append(node)
+                    joined.append(node)
+        for node in joined:
+            logging.info(f"Node {node} joined the cluster through gossip.")
+            if self.on_join is not None:
+                self.on_join(node)
+        self.update_status()
+
+    def remove(self, node):
+        """Forget a node that left the cluster; gossip about it only counts again after it restarts."""
+        name = node_name(node)
+        with self._lock:
+            entry = self.membership.pop(name, None)
+            self.departed[name] = entry[0] if entry is not None else time.time()
+            if node in self.nodes:
+                self.nodes.remove(node)
+            self.active_nodes.discard(node)
+            self.detector.forget(node)
+
+    def receive_gossip(self, payload):
+        """Handle a GOSSIP request: merge the sender's table and answer with ours."""
+        self.merge(json.loads(payload))
+        return self.digest()
+
+    def _exchange(self, node, payload):
+        try:
+            response = self.connection_pool.request(node, "GOSSIP", payload, timeout=self.heartbeat_interval * 2)
+            self.merge(json.loads(response))
+        except Exception as e:
+            logging.debug(f"Gossip with {node} failed: {e}")
+            self.connection_pool.discard(node)
+
+    def gossip_round(self):
+        """Bump our heartbeat and exchange tables with ``fanout`` random peers in parallel."""
+        with self._lock:
+            if self.self_node is not None:
+                self.membership[node_name(self.self_node)][1] += 1
+            peers = random.sample(self.nodes, min(self.fanout, len(self.nodes)))
+        payload = self.digest()
+        futures = [self._executor.submit(self._exchange, peer, payload) for peer in peers]
+        self.rounds += 1
+        self.messages_sent += len(peers)
+        self.bytes_sent += len(peers) * len(payload)
+        for future in futures:
+            future.result()
+        self.update_status()
+
+    def update_status(self):
+        """Recompute ``active_nodes`` from phi and report the nodes that changed state."""
+        if not self.heartbeat_interval:
+            with self._lock:
+                self.active_nodes.update(self.nodes)
+            return
+        now = time.monotonic()
+        changed = []
+        with self._lock:
             for node in self.nodes:
-                if not self.send_heartbeat(node):
-                    logging.error(f"Node {node} is DOWN.")
-                    self.active_nodes.discard(node)
-                    self.redistribute_data(node)
-                else:
+                alive = self.detector.is_available(node, now)
+                if alive and node not in self.active_nodes:
                     self.active_nodes.add(node)
+                    changed.append((node, True))
+                elif not alive and node in self.active_nodes:
+                    self.active_nodes.discard(node)
+                    self.detections.append((node, now - self.detector.last_heartbeat(node)))
+                    changed.append((node, False))
+        for node, alive in changed:
+            if alive:
+                logging.info(f"Node {node} is UP.")
+            else:
+                logging.error(f"Node {node} is DOWN (phi {self.detector.phi(node, now):.1f}).")
+            if self.on_status is not None:
+                self.on_status(node, alive)
+
+    def stats(self):
+        """Membership view with per-node phi, plus detection latency and gossip traffic."""
+        now = time.monotonic()
+        with self._lock:
+            nodes = {node_name(node): {"alive": node in self.active_nodes,
+                                       "phi": round(self.detector.phi(node, now), 2),
+                                       "heartbeat": self.membership.get(node_name(node))}
+                     for node in self.nodes}
+            latencies = [latency for _, latency in self.detections]
+        return {
+            "nodes": nodes,
+            "rounds": self.rounds,
+            "messages_sent": self.messages_sent,
+            "bytes_sent": self.bytes_sent,
+            "messages_per_round": self.messages_sent / self.rounds if self.rounds else 0,
+            "detections": len(latencies),
+            "mean_detection_seconds": sum(latencies) / len(latencies) if latencies else None,
+        }
+
+    def monitor_nodes(self):
+        while True:
             time.sleep(self.heartbeat_interval)
+            self.gossip_round()
 
     def start_monitoring(self):
         threading.Thread(target=self.monitor_nodes, daemon=True).start()
+
+
 class MerkleTree:
-    def __init__(self):
-        self.leaves = []  # List of leaf node hashes
-        self.tree = []    # Complete tree structure
+    """
+    Fixed-shape Merkle tree over hashed key ranges.
+
+    The 64-bit ring hash space is split into ``2 ** depth`` buckets (leaves); a key
+    always lands in the same bucket, so overwriting it replaces its entry instead of
+    adding a leaf. A leaf's hash is the XOR of its entries' SHA-256 digests, so an
+    update touches one leaf and recomputes only the ``depth`` hashes on its path to the
+    root.
+    """
+
+    def __init__(self, depth=10):
+        self.depth = depth
+        self.leaf_count = 1 << depth
+        self.buckets = [dict() for _ in range(self.leaf_count)]  # bucket -> {key: entry digest}
+        self._leaf_values = [0] * self.leaf_count                # XOR of the bucket's entry digests
+        # Heap layout: nodes[1] is the root, leaves live at nodes[leaf_count:]
+        empty_leaf = self._hash_bytes((0).to_bytes(32, 'big'))
+        self.nodes = [b""] * (2 * self.leaf_count)
+        for index in range(self.leaf_count, 2 * self.leaf_count):
+            self.nodes[index] = empty_leaf
+        for index in range(self.leaf_count - 1, 0, -1):
+            self.nodes[index] = self._hash_bytes(self.nodes[2 * index] + self.nodes[2 * index + 1])
+        self._lock = threading.Lock()
 
     def _hash(self, data):
         """Hash a data block using SHA-256."""
         return hashlib.sha256(data.encode('utf-8')).hexdigest()
 
+    @staticmethod
+    def _hash_bytes(data):
+        return hashlib.sha256(data).digest()
+
+    def bucket_of(self, key):
+        return ring_hash(key) >> (64 - self.depth)
+
+    def _entry_digest(self, key, value):
+        return int.from_bytes(self._hash_bytes(f"{key}:{value}".encode('utf-8')), 'big')
+
+    def _set_leaf(self, bucket, leaf_value):
+        self._leaf_values[bucket] = leaf_value
+        index = self.leaf_count + bucket
+        self.nodes[index] = self._hash_bytes(leaf_value.to_bytes(32, 'big'))
+        index //= 2
+        while index:
+            self.nodes[index] = self._hash_bytes(self.nodes[2 * index] + self.nodes[2 * index + 1])
+            index //= 2
+
+    def update(self, key, value):
+        """Insert or overwrite one key and rehash its path to the root."""
+        digest = self._entry_digest(key, value)
+        bucket = self.bucket_of(key)
+        with self._lock:
+            entries = self.buckets[bucket]
+            leaf_value = self._leaf_values[bucket] ^ entries.get(key, 0) ^ digest
+            entries[key] = digest
+            self._set_leaf(bucket, leaf_value)
+
+    def remove(self, key):
+        bucket = self.bucket_of(key)
+        with self._lock:
+            entries = self.buckets[bucket]
+            if key in entries:
+                self._set_leaf(bucket, self._leaf_values[bucket] ^ entries.pop(key))
+
     def add_leaf(self, key, value):
-        """Add a leaf node (hash of key-value pair)."""
-        leaf_hash = self._hash(f"{key}:{value}")
-        self.leaves.append(leaf_hash)
+        """Add or replace the leaf entry for a key-value pair."""
+        self.update(key, value)
 
     def build_tree(self):
-        """Build the Merkle tree from the leaves."""
-        nodes = self.leaves[:]
-        while len(nodes) > 1:
-            new_level = []
-            for i in range(0, len(nodes), 2):
-                if i + 1 < len(nodes):
-                    # Combine and hash sibling nodes
-                    combined_hash = self._hash(nodes[i] + nodes[i + 1])
-                else:
-                    # Handle odd number of nodes (duplicate last node)
-                    combined_hash = self._hash(nodes[i] + nodes[i])
-                new_level.append(combined_hash)
-            nodes = new_level
-        self.tree = nodes
-        return self.tree[0] if self.tree else None  # Return root hash
+        """Return the root hash; the tree is kept up to date incrementally."""
+        return self.root_hash
+
+    @property
+    def root_hash(self):
+        return self.nodes[1].hex()
 
     def verify_data(self, key, value):
         """Verify a key-value pair is part of the tree."""
-        leaf_hash = self._hash(f"{key}:{value}")
-        return leaf_hash in self.leaves
+        return self.buckets[self.bucket_of(key)].get(key) == self._entry_digest(key, value)
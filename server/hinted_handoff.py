@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class HintedHandoff:
+    """
+    Keeps the writes meant for a replica that is down, and hands them over once it is back.
+
+    While a replica is down its writes are appended to a per-replica hint file instead
+    of its replication stream. When the replica returns, the hints are replayed to it
+    in order, in batches of ``batch_size`` and at most ``replay_rate`` writes per
+    second, so catching up costs as much as the writes it missed and does not swamp
+    the replica. New writes keep going to the hint file until it is drained, so nothing
+    overtakes the replay.
+
+    A replica's hints are capped at ``max_bytes``. Past that further hints are dropped,
+    and ``on_overflow(node)`` runs after the replay so a full anti-entropy sync can
+    repair the gap.
+    """
+
+    def __init__(self, hint_dir, send, max_bytes=64 * 1024 * 1024, batch_size=256, replay_rate=5000,
+                 on_overflow=None, retry_interval=1.0):
+        self.hint_dir = hint_dir
+        self.send = send                # send(peer, *fields) -> response text
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.replay_rate = replay_rate
+        self.on_overflow = on_overflow
+        self.retry_interval = retry_interval
+        os.makedirs(hint_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._diverted = set()  # replicas whose writes currently go to hints
+        self._replaying = set()
+        self._files = {}        # replica -> append handle of its hint file
+        self._bytes = {}        # replica -> size of its hint file
+        self._overflowed = set()
+        self.hinted = 0
+        self.dropped = 0
+        self.replayed = 0
+        for name in os.listdir(hint_dir):
+            stem, extension = os.path.splitext(name)
+            host, _, port = stem.rpartition("_")
+            if extension == ".hints":
+                self._diverted.add((host, int(port)))
+                self._bytes[(host, int(port))] = os.path.getsize(os.path.join(hint_dir, name))
+            elif extension == ".overflow":
+                self._diverted.add((host, int(port)))
+                self._overflowed.add((host, int(port)))
+
+    def _path(self, node, extension=".hints"):
+        return os.path.join(self.hint_dir, f"{node[0]}_{node[1]}{extension}")
+
+    def pending_nodes(self):
+        """Replicas with hints on disk, e.g. left over from before a restart."""
+        with self._lock:
+            return sorted(self._diverted)
+
+    def is_diverted(self, node):
+        return node in self._diverted
+
+    def divert(self, node):
+        """Send ``node``'s writes to its hint file from now on."""
+        with self._lock:
+            self._diverted.add(node)
+
+    def hint(self, node, key, value, version=None):
+        line = json.dumps([key, value] if version is None else [key, value, version]) + "\n"
+        with self._lock:
+            if self._bytes.get(node, 0) + len(line) > self.max_bytes:
+                if node not in self._overflowed:
+                    logging.error(f"Hint store for {node} is full; later writes will need anti-entropy.")
+                    # Remembered across restarts, so the gap is repaired even then
+                    open(self._path(node, ".overflow"), "w").close()
+                self._overflowed.add(node)
+                self.dropped += 1
+                return
+            hint_file = self._files.get(node)
+            if hint_file is None:
+                hint_file = self._files[node] = open(self._path(node), "a", encoding="utf-8")
+            hint_file.write(line)
+            hint_file.flush()
+            self._bytes[node] = self._bytes.get(node, 0) + len(line)
+            self.hinted += 1
+
+    def replay(self, node, is_alive=lambda: True):
+        """
+        Hand ``node``'s hints over, then send its writes to the replication stream again.
+        Returns False if the node went away (or kept failing) before the hints were drained.
+        """
+        with self._lock:
+            if node in self._replaying or node not in self._diverted:
+                return node not in self._diverted
+            self._replaying.add(node)
+        try:
+            return self._replay(node, is_alive)
+        finally:
+            with self._lock:
+                self._replaying.discard(node)
+
+    def _replay(self, node, is_alive):
+        path = self._path(node)
+        sent = 0
+        started = time.monotonic()
+        reader = open(path, "a+", encoding="utf-8")
+        reader.seek(0)
+        try:
+            while True:
+                batch = []
+                with self._lock:
+                    if node in self._files:
+                        self._files[node].flush()
+                    while len(batch) < self.batch_size:
+                        line = reader.readline()
+                        if not line.endswith("\n"):
+                            break  # end of file, or a write torn by a crash
+                        batch.append(json.loads(line))
+                    if not batch:
+                        # Drained while holding the lock, so no hint can slip in before we switch back
+                        self._diverted.discard(node)
+                        hint_file = self._files.pop(node, None)
+                        if hint_file is not None:
+                            hint_file.close()
+                        os.remove(path)
+                        self._bytes.pop(node, None)
+                        overflowed = node in self._overflowed
+                        if overflowed:
+                            self._overflowed.discard(node)
+                            os.remove(self._path(node, ".overflow"))
+                        break
+                while not self._send(node, batch):
+                    if not is_alive():
+                        logging.info(f"Node {node} went down again; {sent} hints were handed over.")
+                        return False
+                    time.sleep(self.retry_interval)
+                sent += len(batch)
+                with self._lock:
+                    self.replayed += len(batch)
+                # Throttle to replay_rate writes per second
+                ahead = sent / self.replay_rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        finally:
+            reader.close()
+        logging.info(f"Handed {sent} hinted writes over to {node} in {time.monotonic() - started:.2f}s.")
+        if overflowed and self.on_overflow is not None:
+            self.on_overflow(node)
+        return True
+
+    def _send(self, node, batch):
+        try:
+            response = self.send(node, "RANGE_APPLY", json.dumps(batch))
+            if response.startswith("OK"):
+                return True
+            logging.error(f"Node {node} rejected {len(batch)} hinted writes: {response}")
+        except Exception as e:
+            logging.error(f"Failed to hand hinted writes over to {node}: {e}")
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "diverted": sorted(f"{host}:{port}" for host, port in self._diverted),
+                "bytes": {f"{host}:{port}": size for (host, port), size in self._bytes.items()},
+                "hinted": self.hinted,
+                "dropped": self.dropped,
+                "replayed": self.replayed,
+            }
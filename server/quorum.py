@@ -0,0 +1,68 @@
+import threading
+import time
+
+CONSISTENCY_LEVELS = ("one", "quorum", "all")
+OPTION_NAMES = ("N", "R", "W", "CONSISTENCY")
+
+
+def parse_options(parts):
+    """Pick ``NAME=value`` request options (N, R, W, CONSISTENCY) out of trailing command parts."""
+    options = {}
+    for part in parts:
+        name, sep, value = part.partition("=")
+        if sep and name.upper() in OPTION_NAMES:
+            options[name.upper()] = value
+    return options
+
+
+class QuorumSettings:
+    """Dynamo-style N/R/W: replicas per key, replies needed for a read, acks needed for a write."""
+
+    def __init__(self, n=3, r=1, w=1):
+        self.n, self.r, self.w = n, r, w
+        self.validate(n, r, w)
+
+    @staticmethod
+    def validate(n, r, w):
+        if n < 1 or not 1 <= r <= n or not 1 <= w <= n:
+            raise ValueError(f"Invalid quorum N={n} R={r} W={w}: need 1 <= R, W <= N")
+
+    def resolve(self, options):
+        """Cluster-wide settings overridden by per-request options; returns (n, r, w)."""
+        n = int(options.get("N", self.n))
+        r = int(options.get("R", min(self.r, n)))
+        w = int(options.get("W", min(self.w, n)))
+        level = options.get("CONSISTENCY")
+        if level is not None:
+            level = level.lower()
+            if level not in CONSISTENCY_LEVELS:
+                raise ValueError(f"Unknown consistency level '{level}'. Choose from: {', '.join(CONSISTENCY_LEVELS)}")
+            required = {"one": 1, "quorum": n // 2 + 1, "all": n}[level]
+            r = int(options.get("R", required))
+            w = int(options.get("W", required))
+        self.validate(n, r, w)
+        return n, r, w
+
+
+class AckCounter:
+    """Counts replica acknowledgements from callback threads until a quorum is reached."""
+
+    def __init__(self, needed):
+        self.needed = needed
+        self.acked = []
+        self._cond = threading.Condition()
+
+    def ack(self, node):
+        with self._cond:
+            self.acked.append(node)
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.acked) < self.needed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
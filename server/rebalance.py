@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Rebalancer:
+    """
+    Streams token ranges to the nodes that gain them when a node joins or leaves.
+
+    The ring works out exactly which ``(start, end]`` hash ranges change hands
+    (ConsistentHashing.transfer_plan), and the gaining node pulls each of them from its
+    source with repeated TOKEN_SCAN pages of ``chunk_size`` keys, at most ``rate`` keys
+    per second, while both nodes keep serving. Live writes keep reaching the gaining
+    node during the transfer (it is already on the ring, or the leaving node forwards
+    them), so a streamed value is skipped for any key written since the transfer began:
+    the live write is at least as new.
+    """
+
+    def __init__(self, node, send, apply_batch, chunk_size=500, rate=5000, concurrency=4):
+        self.node = node                # (host, port) of this node
+        self.send = send                # send(peer, *fields) -> response text
+        self.apply_batch = apply_batch  # apply_batch([(key, value), ...]) to local storage
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._lock = threading.RLock()  # re-entered when apply_batch itself reports the write
+        self._transfers = 0
+        self._fresh = set()             # keys written by live traffic while a transfer runs
+        self.streamed = 0
+        self.skipped = 0
+
+    def observe(self, keys):
+        """Record a live write; call before it is applied so no streamed value can land after it."""
+        if self._transfers:
+            with self._lock:
+                if self._transfers:
+                    self._fresh.update(keys)
+
+    def pull(self, source, ranges):
+        """Copy every key of ``ranges`` stored on ``source`` to this node; returns the keys applied."""
+        with self._lock:
+            self._transfers += 1
+        applied = 0
+        started = time.monotonic()
+        after = None
+        try:
+            while True:
+                fields = ["TOKEN_SCAN", json.dumps(ranges), self.chunk_size] + ([after] if after is not None else [])
+                response = self.send(source, *fields)
+                if response.startswith("Error"):
+                    raise RuntimeError(f"{source} failed a range transfer: {response}")
+                page = json.loads(response)
+                # Checked and applied under the lock, so a live write is either seen here or lands afterwards
+                with self._lock:
+                    batch = [(key, value) for key, value in page["items"] if key not in self._fresh]
+                    if batch:
+                        self.apply_batch(batch)
+                    self.streamed += len(batch)
+                    self.skipped += len(page["items"]) - len(batch)
+                applied += len(batch)
+                if page["frontier"] is None:
+                    break
+                after = page["frontier"]
+                # Throttle to rate keys per second
+                ahead = applied / self.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        finally:
+            with self._lock:
+                self._transfers -= 1
+                if not self._transfers:
+                    self._fresh.clear()
+        logging.info(f"Streamed {applied} keys in {len(ranges)} ranges from {source} "
+                     f"in {time.monotonic() - started:.2f}s.")
+        return applied
+
+    def pull_all(self, plan):
+        """Run this node's transfers of ``plan``, pulling from the sources in parallel."""
+        futures = {source: self._executor.submit(self.pull, source, ranges)
+                   for (source, target), ranges in plan.items() if target == self.node and source != self.node}
+        return {source: future.result() for source, future in futures.items()}
+
+    def stats(self):
+        with self._lock:
+            return {"transfers": self._transfers, "streamed": self.streamed, "skipped": self.skipped}
@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class ReplicationStream:
+    """
+    Ships writes to one replica as ordered, sequence-numbered batches.
+
+    Writes are buffered until ``max_batch_ops``/``max_batch_bytes`` is reached or
+    ``max_delay_ms`` has passed since the first buffered write. Repeated writes to the
+    same key within a batch are coalesced so only the latest value is sent; a write's
+    version, when it has one, travels with it as ``[key, value, version]``. A batch is
+    retried (with the same sequence number) until the replica acknowledges it, and the
+    next batch is not sent before that, so replicas apply writes in order.
+    """
+
+    def __init__(self, replica, send, source, max_batch_ops=256, max_batch_bytes=256 * 1024,
+                 max_delay_ms=10, retry_interval=0.5):
+        self.replica = replica
+        self.send = send              # send(peer, *fields) -> response text
+        self.source = source          # "host:port" of the sending node
+        self.epoch = uuid.uuid4().hex  # lets the replica tell a restarted sender from duplicates
+        self.max_batch_ops = max_batch_ops
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay_ms / 1000.0
+        self.retry_interval = retry_interval
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # key -> (value, version)
+        self._pending_bytes = 0
+        self._first_pending_at = None
+        self._callbacks = []           # on_ack callbacks of the pending writes
+        self._inflight_ops = 0
+        self._inflight_bytes = 0
+        self.next_seq = 1
+        self.acked_seq = 0
+        self.coalesced = 0
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(str(value))
+
+    def enqueue(self, key, value, on_ack=None, urgent=False, version=None):
+        """
+        Buffer a write. ``on_ack`` is called once the batch carrying it (or a later value
+        for the same key) is acknowledged; ``urgent`` ships the batch without waiting
+        for the time window, for callers blocked on a write quorum.
+        """
+        with self._cond:
+            if key in self._pending:
+                self._pending_bytes -= self._size(key, self._pending.pop(key)[0])
+                self.coalesced += 1
+            elif not self._pending:
+                self._first_pending_at = time.monotonic()
+            self._pending[key] = (value, version)
+            self._pending_bytes += self._size(key, value)
+            if on_ack is not None:
+                self._callbacks.append(on_ack)
+            if urgent:
+                self._first_pending_at = 0
+            if urgent or len(self._pending) >= self.max_batch_ops or self._pending_bytes >= self.max_batch_bytes:
+                self._cond.notify_all()
+
+    def lag(self):
+        """Writes accepted locally but not yet acknowledged by the replica."""
+        with self._cond:
+            return {
+                "ops": len(self._pending) + self._inflight_ops,
+                "bytes": self._pending_bytes + self._inflight_bytes,
+                "sent_seq": self.next_seq - 1,
+                "acked_seq": self.acked_seq,
+                "coalesced": self.coalesced,
+            }
+
+    def take_pending(self):
+        """
+        Remove and return the buffered writes that were not shipped yet as
+        ``(key, value, version)``, e.g. to hint them while the replica is down. Their
+        ``on_ack`` callbacks are dropped.
+        """
+        with self._cond:
+            batch = [(key, value, version) for key, (value, version) in self._pending.items()]
+            self._pending = OrderedDict()
+            self._pending_bytes = 0
+            self._callbacks = []
+            self._cond.notify_all()
+            return batch
+
+    def flush(self, timeout=None):
+        """Block until everything enqueued so far has been acknowledged."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._first_pending_at = 0 if self._pending else self._first_pending_at
+            self._cond.notify_all()
+            while self._pending or self._inflight_ops:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _batch_ready(self):
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.max_batch_ops or self._pending_bytes >= self.max_batch_bytes:
+            return True
+        return time.monotonic() - self._first_pending_at >= self.max_delay
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._batch_ready():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0.0, self._first_pending_at + self.max_delay - time.monotonic())
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                batch = [[key, value] if version is None else [key, value, version]
+                         for key, (value, version) in self._pending.items()]
+                callbacks, self._callbacks = self._callbacks, []
+                self._pending = OrderedDict()
+                self._inflight_ops, self._inflight_bytes = len(batch), self._pending_bytes
+                self._pending_bytes = 0
+                seq = self.next_seq
+                self.next_seq += 1
+            acked = self._ship(seq, batch)
+            with self._cond:
+                if acked:
+                    self.acked_seq = seq
+                self._inflight_ops = self._inflight_bytes = 0
+                self._cond.notify_all()
+            if not acked:
+                return  # closed before the replica acknowledged; its writes never count as acks
+            for callback in callbacks:
+                callback(self.replica)
+
+    def _ship(self, seq, batch):
+        """Send a batch until the replica acknowledges it; False if the stream was closed first."""
+        payload = json.dumps(batch)
+        while not self._closed:
+            try:
+                response = self.send(self.replica, "REPLICATE", self.source, self.epoch, seq, payload)
+                if response == f"ACK {seq}":
+                    logging.debug(f"Replica {self.replica} acknowledged batch {seq} ({len(batch)} writes)")
+                    return True
+                logging.error(f"Replica {self.replica} rejected batch {seq}: {response}")
+            except Exception as e:
+                logging.error(f"Error replicating batch {seq} to replica {self.replica}: {e}")
+            time.sleep(self.retry_interval)
+        return False
+
+
+class ReplicationReceiver:
+    """Applies incoming batches exactly once and in order, per sending stream."""
+
+    def __init__(self, apply_batch):
+        self.apply_batch = apply_batch  # apply_batch([(key, value[, version]), ...])
+        self._lock = threading.Lock()
+        self._applied = {}  # source -> (epoch, last applied seq)
+
+    def receive(self, source, epoch, seq, payload):
+        seq = int(seq)
+        with self._lock:
+            last_epoch, last_seq = self._applied.get(source, (None, 0))
+            if last_epoch != epoch:
+                last_seq = seq - 1
+            if seq <= last_seq:
+                return f"ACK {seq}"  # duplicate of a batch we already applied
+            if seq != last_seq + 1:
+                return f"Error: expected batch {last_seq + 1} from {source}, got {seq}"
+            self.apply_batch(json.loads(payload))
+            self._applied[source] = (epoch, seq)
+        return f"ACK {seq}"
@@ -1,13 +1,30 @@
+import contextlib
 import socket
 import threading
+import time
 from utils.data_structures import InMemoryStorage, PersistentStorage
 from utils.hashing import ConsistentHashing  # New utility for consistent hashing
 import logging
 import argparse
-from server.health_monitor import MerkleTree
-from concurrent.futures import ThreadPoolExecutor
+from server.health_monitor import HealthMonitor, MerkleTree, parse_node
+from server.hinted_handoff import HintedHandoff
+from server.replication import ReplicationReceiver, ReplicationStream
+from server.anti_entropy import AntiEntropy
+from server.cluster_scan import ClusterScan
+from server.coordinator import TransactionCoordinator, coordinator_of
+from server.transactions import TransactionLog, TransactionManager
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from collections import Counter
+from server.quorum import AckCounter, QuorumSettings, parse_options
+from server.rebalance import Rebalancer
+from server.versioning import HybridClock, newer, parse_version
 from utils.backup import BackupManager
+from utils.cache import LRUCache
+from utils.connection_pool import ConnectionPool
+from utils.storage_engine import create_engine
+from utils.protocol import HELLO, HELLO_OK, STATUS_OK, STATUS_ERROR, ProtocolError, encode_frame, read_frame
 import os
+import json
 
 # Ensure logs directory exists
 log_dir = "logs"
@@ -28,55 +45,45 @@ logging.info("Logging has been successfully configured.")
 
 hashing_list = None
 
-# Set up a thread pool with a limit on the number of threads
-thread_pool = ThreadPoolExecutor(max_workers=5)
-class TransactionManager:
-    """
-    Manages transaction states and ensures atomicity, consistency, isolation, and durability (ACID).
-    """
-    def __init__(self):
-        self.transactions = {}  # {transaction_id: {"state": "PREPARED/COMMITTED/ABORTED", "data": {key: value}}}
-        logging.basicConfig(level=logging.INFO)
-
-    def prepare(self, transaction_id, operations):
-        if transaction_id in self.transactions:
-            logging.error(f"Transaction {transaction_id} already exists. Cannot prepare again.")
-            return False
-        self.transactions[transaction_id] = {"state": "PREPARED", "data": operations}
-        logging.info(f"Transaction {transaction_id} prepared with operations: {operations}")
-        return True
-
-    def commit(self, transaction_id, storage):
-        if transaction_id not in self.transactions:
-            logging.error(f"Transaction {transaction_id} not found. Cannot commit.")
-            return False
-        if self.transactions[transaction_id]["state"] == "PREPARED":
-            # Apply the changes from the transaction data to storage
-            for key, value in self.transactions[transaction_id]["data"].items():
-                storage[key] = value
-            self.transactions[transaction_id]["state"] = "COMMITTED"
-            logging.info(f"Transaction {transaction_id} committed.")
-            return True
-        logging.error(f"Transaction {transaction_id} is not in PREPARED state, cannot commit.")
-        return False
-
-    def rollback(self, transaction_id):
-        if transaction_id not in self.transactions:
-            logging.error(f"Transaction {transaction_id} not found. Cannot rollback.")
-            return False
-        if self.transactions[transaction_id]["state"] == "PREPARED":
-            del self.transactions[transaction_id]
-            logging.info(f"Transaction {transaction_id} rolled back.")
-            return True
-        logging.error(f"Transaction {transaction_id} is not in PREPARED state, cannot rollback.")
-        return False
-
+# Set up a thread pool with a limit on the number of threads (used for quorum read fan-out)
+thread_pool = ThreadPoolExecutor(max_workers=32)
+# Largest page a single SCAN/PREFIX/QUERY request returns
+MAX_SCAN_LIMIT = 1000
 class Server:
-    def __init__(self, host='127.0.0.1', port=5000, replicas=None, node_id=None, backup_interval=300):
+    def __init__(self, host='127.0.0.1', port=5000, replicas=None, node_id=None, backup_interval=300,
+                 storage_engine="log", wal_sync="interval", wal_sync_interval=100, wal_sync_bytes=64 * 1024,
+                 replication_batch_ops=256, replication_batch_bytes=256 * 1024, replication_batch_delay=10,
+                 replication_factor=3, read_quorum=1, write_quorum=1, quorum_timeout=2.0,
+                 anti_entropy_interval=30, cache_entries=10000, cache_ttl=30.0, secondary_indexes=(),
+                 scan_concurrency=8, gossip_interval=1.0, gossip_fanout=3, hint_max_bytes=64 * 1024 * 1024,
+                 hint_replay_rate=5000, rebalance_chunk=500, rebalance_rate=5000, value_compression=None):
         self.host = host
         self.port = port
         self.node_id = node_id
-        self.storage = PersistentStorage(storage_file=f"server_{port}_storage.json")
+        # The log engine stores values in a compact binary format, optionally compressed per record
+        engine_options = {"compression": value_compression} if storage_engine == "log" else {}
+        self.storage = PersistentStorage(storage_file=f"server_{port}_storage.json", engine=storage_engine,
+                                         indexes=secondary_indexes, engine_options=engine_options)
+        # Initialize BackupManager with a periodic backup interval of 5 minutes (300 seconds)
+        self.backup_manager = BackupManager(self.storage, backup_dir=os.path.join("backups", f"server_{port}"),
+                                            log_file=f"server_{port}_wal.txt", wal_sync=wal_sync,
+                                            wal_sync_interval=wal_sync_interval, wal_sync_bytes=wal_sync_bytes,
+                                            backup_interval=backup_interval)
+        # Re-apply writes logged after the last checkpoint before serving anything
+        self.backup_manager.replay_log()
+        # Hybrid-logical-clock version of every stored value, kept beside the data
+        self.versions = create_engine(storage_engine, f"server_{port}_versions.json")
+        self.clock = HybridClock(f"{host}:{port}")
+        self.read_repairs = 0
+        self._repair_lock = threading.Lock()
+        # Hot-key read cache; every write path below invalidates the keys it touches
+        self.read_cache = LRUCache(max_entries=cache_entries, ttl=cache_ttl)
+        # Snapshot-isolated transactions; plain writes are tracked so open snapshots stay stable.
+        # PREPARE votes are logged durably, and votes still undecided at the last shutdown are restored
+        self.transaction_manager = TransactionManager(on_commit=self.read_cache.invalidate_many,
+                                                      apply=self.apply_transaction,
+                                                      log=TransactionLog(f"server_{port}_transactions.log"))
+        in_doubt = self.transaction_manager.recover()
         # Remove self from replicas list
         if replicas:
             self.replicas = [
@@ -85,11 +92,62 @@ class Server:
         else:
             self.replicas = []
         logging.info(f"Validated replicas: {self.replicas}")
-        self.consistent_hashing = ConsistentHashing(self.replicas)  # Add self to the hash ring
+        # Cluster-wide N/R/W; requests may override them with N=, R=, W= or CONSISTENCY= options
+        self.quorum = QuorumSettings(replication_factor, read_quorum, write_quorum)
+        self.quorum_timeout = quorum_timeout
+        self.consistent_hashing = ConsistentHashing(self.replicas + [(self.host, self.port)],
+                                                    replicas=replication_factor)  # Add self to the hash ring
         hashing_list = self.consistent_hashing
         self.merkle_tree = MerkleTree()
-        # Initialize BackupManager with a periodic backup interval of 5 minutes (300 seconds)
-        self.backup_manager = BackupManager(self.storage)
+        for key, value in self.storage.items():
+            self.merkle_tree.update(key, value)
+        # Kept current under each write's stripe lock, so racing writes to a key leave it matching storage
+        self.storage.watch(self.merkle_tree)
+        self.anti_entropy = AntiEntropy(self.merkle_tree, self.storage, self.send_to_peer, self.apply_replicated_batch,
+                                        node=(self.host, self.port), owns=self.holds_replica, versions=self.versions)
+        self.anti_entropy_interval = anti_entropy_interval
+        # Persistent connections shared by replication, recovery, heartbeats and integrity checks
+        self.connection_pool = ConnectionPool()
+        # Gossip membership with phi-accrual failure detection; nodes learned by gossip join the ring
+        self.health_monitor = HealthMonitor(self.replicas, heartbeat_interval=gossip_interval,
+                                            connection_pool=self.connection_pool, self_node=(self.host, self.port),
+                                            fanout=gossip_fanout, on_join=self.add_peer,
+                                            on_status=self.replica_status_changed)
+        self.cluster_scan = ClusterScan((self.host, self.port), self.storage, self.consistent_hashing,
+                                        self.send_to_peer, self.active_nodes, concurrency=scan_concurrency)
+        self.replication_options = {"max_batch_ops": replication_batch_ops, "max_batch_bytes": replication_batch_bytes,
+                                    "max_delay_ms": replication_batch_delay}
+        self.replication_streams = {
+            replica: ReplicationStream(replica, self.send_to_peer, source=f"{self.host}:{self.port}",
+                                       **self.replication_options)
+            for replica in self.replicas
+        }
+        self.replication_receiver = ReplicationReceiver(self.apply_replicated_batch)
+        # Writes for replicas that are down are kept on disk and handed over when they return
+        self.hinted_handoff = HintedHandoff(os.path.join("hints", f"server_{port}"), self.send_to_peer,
+                                            max_bytes=hint_max_bytes, replay_rate=hint_replay_rate,
+                                            on_overflow=self.resync_with_node)
+        for node in self.hinted_handoff.pending_nodes():
+            threading.Thread(target=self.hand_off_hints, args=(node,), daemon=True).start()
+        # Token ranges stream between nodes on join and leave while both keep serving
+        self.rebalancer = Rebalancer((self.host, self.port), self.send_to_peer, self.write_batch,
+                                     chunk_size=rebalance_chunk, rate=rebalance_rate)
+        self.leaving_ring = None  # the ring without this node while it hands its ranges over
+        # Two-phase commit across key owners, with a durable log of COMMIT decisions
+        self.coordinator = TransactionCoordinator((self.host, self.port), self.group_by_owner, self.send_to_peer,
+                                                  lambda *fields: self.dispatch(list(fields)),
+                                                  TransactionLog(f"server_{port}_decisions.log"))
+        self.coordinator.recover()
+        if in_doubt:
+            threading.Thread(target=self.resolve_in_doubt, args=(in_doubt,), daemon=True).start()
+        # Incremental snapshots; a full one is taken whenever there is no chain to extend
+        if backup_interval:
+            threading.Thread(target=self.backup_manager.periodic_backup, daemon=True).start()
+        # Periodic anti-entropy with every replica
+        if anti_entropy_interval:
+            threading.Thread(target=self.integrity_check, daemon=True).start()
+        if gossip_interval:
+            self.health_monitor.start_monitoring()
     
     def handle_client(self, conn, addr):
         try:
@@ -101,54 +159,14 @@ class Server:
                     if not data:
                         break  # Close the connection if no data is received
                     logging.info(f"Received data: {data} from {addr}")
-                    
-                    # Handle HEARTBEAT
-                    if data == "HEARTBEAT":
-                        conn.sendall("ALIVE".encode('utf-8'))
-                        continue
-
-                    # Handle TRANSACTION commands (PREPARE, COMMIT, ROLLBACK)
-                    if data.startswith("TRANSACTION"):
-                        # Split the input and check the format
-                        command_parts = data.split(None)
-                        if len(command_parts) < 3:
-                            logging.error(f"Malformed TRANSACTION command: {data} from {addr}")
-                            response = "Error: TRANSACTION command must be in the format 'TRANSACTION <id> PREPARE|COMMIT|ROLLBACK'."
-                        else:
-                            transaction_id = command_parts[1]
-                            if command_parts[2] == "PREPARE":
-                                response = self.handle_prepare(transaction_id, command_parts[3:])
-                            elif command_parts[2] == "COMMIT":
-                                response = self.handle_commit(transaction_id)
-                            elif command_parts[2] == "ROLLBACK":
-                                response = self.handle_rollback(transaction_id)
-                            else:
-                                response = "Invalid TRANSACTION command. Use PREPARE, COMMIT, or ROLLBACK."
-                    # Handle PUT and GET commands
-                    elif data.startswith("PUT"):
-                        # Split the input and check length
-                        command_parts = data.split(None)
-                        if len(command_parts) < 3:
-                            logging.error(f"Malformed PUT command: {data} from {addr}")
-                            response = "Error: PUT command must be in the format 'PUT <key> <value>'."
-                        else:
-                            _, key, value = command_parts[:3]
-                            # Check if the request is a replication request
-                            is_replication = "replication=true" in command_parts
-                            response = self.handle_put(key, value, is_replication)
-
-                    elif data.startswith("GET"):
-                        # Split the input and check length
-                        command_parts = data.split(None)
-                        if len(command_parts) != 2:
-                            logging.error(f"Malformed GET command: {data} from {addr}")
-                            response = "Error: GET command must be in the format 'GET <key>'."
-                        else:
-                            _, key = command_parts
-                            response = self.handle_get(key)
-                    else:
-                        response = "Invalid command. Use PUT <key> <value> or GET <key>."
-                    
+
+                    # Switch this connection to the framed binary protocol
+                    if data == HELLO:
+                        conn.sendall(HELLO_OK.encode('utf-8'))
+                        self.handle_binary_client(conn, addr)
+                        break
+
+                    response = self.dispatch(data.split(None), addr)
                     conn.sendall(response.encode('utf-8'))
                 except ConnectionResetError:
                     break
@@ -160,74 +178,708 @@ class Server:
         finally:
             conn.close()
 
-    def handle_put(self, key, value, is_replication=False):
-        self.storage[key] = value  # This will invoke __setitem__ in PersistentStorage
-        self.storage.save_data()  # Ensure the data is saved after the operation
+    def handle_binary_client(self, conn, addr):
+        """Serve length-prefixed frames; clients may pipeline many requests before reading."""
+        stream = conn.makefile('rb')
+        try:
+            while True:
+                try:
+                    frame = read_frame(stream)
+                except ProtocolError as e:
+                    logging.error(f"Malformed frame from {addr}: {e}")
+                    break
+                if frame is None:
+                    break
+                request_id, _, fields = frame
+                try:
+                    response = self.dispatch(fields, addr)
+                except Exception as e:
+                    logging.error(f"Error processing request from {addr}: {e}")
+                    response = f"Error: {e}"
+                status = STATUS_ERROR if response.startswith("Error") else STATUS_OK
+                conn.sendall(encode_frame(request_id, [response], status))
+        finally:
+            stream.close()
+
+    def dispatch(self, command_parts, addr=None):
+        """Run one command given as [name, arg, ...]; shared by the text and binary protocols."""
+        if not command_parts:
+            return "Invalid command. Use PUT <key> <value> or GET <key>."
+        command = command_parts[0]
+
+        # Handle HEARTBEAT
+        if command == "HEARTBEAT":
+            return "ALIVE"
+
+        # Push-pull gossip exchange of membership tables
+        if command == "GOSSIP":
+            if len(command_parts) != 2:
+                return "Error: GOSSIP command must be in the format 'GOSSIP <membership json>'."
+            return self.health_monitor.receive_gossip(command_parts[1])
+
+        if command == "MEMBERSHIP":
+            return json.dumps(self.health_monitor.stats())
+
+        if command == "HINT_STATUS":
+            return json.dumps(self.hinted_handoff.stats())
+
+        # Online membership changes: the ring a joining node starts from, and join/leave announcements
+        if command == "RING":
+            ring = self.consistent_hashing
+            return json.dumps({"nodes": [[host, port, weight] for (host, port), weight in ring.weights.items()],
+                               "replicas": ring.replicas})
+        if command in ("JOIN", "LEAVE"):
+            if len(command_parts) != 3 or not command_parts[2].isdigit():
+                logging.error(f"Malformed {command} command: {command_parts} from {addr}")
+                return f"Error: {command} command must be in the format '{command} <host> <port>'."
+            node = (command_parts[1], int(command_parts[2]))
+            if command == "JOIN":
+                self.add_peer(node)
+                return "JOINED"
+            return self.handle_leave(node)
+        if command == "REBALANCE_STATUS":
+            return json.dumps(self.rebalancer.stats())
+
+        # Handle TRANSACTION commands (BEGIN, GET, PUT, PREPARE, COMMIT, ROLLBACK)
+        if command == "TRANSACTION":
+            if len(command_parts) < 3:
+                logging.error(f"Malformed TRANSACTION command: {command_parts} from {addr}")
+                return "Error: TRANSACTION command must be in the format 'TRANSACTION <id> BEGIN|GET|PUT|PREPARE|COMMIT|ROLLBACK'."
+            return self.handle_transaction(command_parts[1], command_parts[2], command_parts[3:])
+
+        # Handle PUT and GET commands
+        if command == "PUT":
+            if len(command_parts) < 3:
+                logging.error(f"Malformed PUT command: {command_parts} from {addr}")
+                return "Error: PUT command must be in the format 'PUT <key> <value>'."
+            _, key, value = command_parts[:3]
+            # Check if the request is a replication request
+            is_replication = "replication=true" in command_parts
+            return self.handle_put(key, value, is_replication, parse_options(command_parts[3:]))
+
+        # Ordered batch from another node's replication stream
+        if command == "REPLICATE":
+            if len(command_parts) != 5:
+                logging.error(f"Malformed REPLICATE command from {addr}")
+                return "Error: REPLICATE command must be in the format 'REPLICATE <source> <epoch> <seq> <batch>'."
+            return self.replication_receiver.receive(*command_parts[1:])
+
+        # Anti-entropy: root comparison, level-by-level subtree hashes and range transfer
+        # Anti-entropy requests may name the requesting node, to compare only the key ranges both replicate
+        if command == "CHECK_HASH" and len(command_parts) in (2, 3):
+            return self.anti_entropy.check_hash(command_parts[1], *map(parse_node, command_parts[2:]))
+        if command == "MERKLE_NODES" and len(command_parts) in (3, 4):
+            return self.anti_entropy.node_hashes(command_parts[1], command_parts[2], *map(parse_node, command_parts[3:]))
+        if command == "RANGE_FETCH" and len(command_parts) in (2, 3):
+            return self.anti_entropy.range_items(command_parts[1], *map(parse_node, command_parts[2:]))
+        if command == "RANGE_APPLY" and len(command_parts) == 2:
+            return self.anti_entropy.apply_range(command_parts[1])
+
+        # Multi-key batches from clients, and the per-owner sub-batches they are split into
+        if command == "MPUT":
+            if len(command_parts) < 3 or len(command_parts) % 2 == 0:
+                logging.error(f"Malformed MPUT command: {command_parts[:3]}... from {addr}")
+                return "Error: MPUT command must be in the format 'MPUT <key> <value> [<key> <value> ...]'."
+            return self.handle_mput(list(zip(command_parts[1::2], command_parts[2::2])))
+        if command == "MGET":
+            if len(command_parts) < 2:
+                logging.error(f"Malformed MGET command from {addr}")
+                return "Error: MGET command must be in the format 'MGET <key> [<key> ...]'."
+            return json.dumps(self.handle_mget(command_parts[1:]))
+        if command == "BATCH_PUT" and len(command_parts) == 2:
+            return f"BATCH_PUT {self.apply_owned_batch(json.loads(command_parts[1]))} OK"
+        if command == "BATCH_GET" and len(command_parts) == 2:
+            return json.dumps(self.read_local_batch(json.loads(command_parts[1])))
+
+        # Ordered and secondary-index reads over this node's keys, one page per request
+        if command in ("SCAN", "PREFIX", "QUERY"):
+            return self.handle_scan(command, command_parts[1:], addr)
+
+        # Whole-table scan across the ring, and the per-node token-range pages it is built from
+        if command == "CLUSTER_SCAN":
+            if len(command_parts) not in (2, 3) or not command_parts[1].isdigit():
+                logging.error(f"Malformed CLUSTER_SCAN command: {command_parts} from {addr}")
+                return "Error: CLUSTER_SCAN command must be in the format 'CLUSTER_SCAN <limit> [token]'."
+            limit = min(int(command_parts[1]), MAX_SCAN_LIMIT)
+            items, token = self.cluster_scan.page(limit, command_parts[2] if len(command_parts) == 3 else None)
+            return json.dumps({"items": items, "token": token})
+        if command == "TOKEN_SCAN" and len(command_parts) in (3, 4):
+            after = command_parts[3] if len(command_parts) == 4 else None
+            return json.dumps(self.cluster_scan.local_page(json.loads(command_parts[1]), int(command_parts[2]), after))
+
+        if command == "REPLICATION_STATUS":
+            return json.dumps(self.replication_status())
+        if command == "CACHE_STATS":
+            return json.dumps(self.read_cache.stats())
+
+        # A replica's copy of a key with its version, for quorum reads
+        if command == "VERSIONED_GET" and len(command_parts) == 2:
+            key = command_parts[1]
+            return json.dumps([self.storage[key], self.versions.get(key)])
+
+        if command == "GET":
+            options = parse_options(command_parts[2:])
+            if len(command_parts) < 2 or len(options) != len(command_parts) - 2:
+                logging.error(f"Malformed GET command: {command_parts} from {addr}")
+                return "Error: GET command must be in the format 'GET <key> [R=<r>] [N=<n>] [CONSISTENCY=one|quorum|all]'."
+            return self.handle_get(command_parts[1], options)
+
+        return "Invalid command. Use PUT <key> <value> or GET <key>."
+
+    def handle_put(self, key, value, is_replication=False, options=None):
+        # Client writes get a new version; a replicated PUT without one only fills in an unversioned key
+        version = None if is_replication else self.clock.now()
+        self.rebalancer.observe((key,))
+        keep = (lambda key, _: self.is_current(key, None)) if is_replication else None
+        # Log before applying; concurrent callers share the WAL's group-commit fsync
+        with self.transaction_manager.tracking_write([(key, value)], self.storage, keep=keep) as applied:
+            if not applied:
+                return f"PUT {key}={value} OK"
+            lsn = self.backup_manager.log_write(["PUT", key, value])
+            try:
+                self.storage[key] = value  # A single append with the log-structured engine
+                self.store_versions([(key, version)])
+            finally:
+                # Snapshots only claim WAL positions whose writes have reached storage
+                self.backup_manager.mark_applied(lsn)
+                self.read_cache.invalidate(key)
         
         response = f"PUT {key}={value} OK"
         
-        self.merkle_tree.add_leaf(key, value)
-        root_hash = self.merkle_tree.build_tree()
-        # Log the updated root hash
-        logging.info(f"Updated Merkle Tree Root Hash: {root_hash}")
-        # Log the PUT operation for replication if necessary
+        # Writes applied on behalf of another node are not forwarded again, except to the
+        # nodes taking over this node's ranges while it leaves
         if is_replication:
-            self.backup_manager.log_write(f"PUT {key} {value}")
-        #     if not is_replication:
-        # self.backup_manager.log_write(f"PUT {key} {value}")
-        # Replicate the PUT operation to the replicas
-            for replica in self.replicas:
-                self.replicate_put(replica, key, value, root_hash)
+            self.forward_while_leaving([(key, value)])
+            return response
+
+        n, _, w = self.quorum.resolve(options or {})
+        replicas = self.replica_targets(key)
+        me = (self.host, self.port)
+        preferred = self.preference_list(key, n)
+        # The local write is the first ack only if this node is one of the key's preferred replicas
+        local_ack = me in preferred
+        needed = w - 1 if local_ack else w
+        if needed <= 0:
+            # Queue the PUT on each replica's ordered, batching replication stream
+            for replica in replicas:
+                self.replicate_put(replica, key, value, version)
+            return response
+
+        # Wait for the remaining acks from the key's other preferred replicas
+        # Replicas still receiving hinted writes cannot ack in order yet; they get this write as a hint
+        targets = {node for node in preferred if node != me and not self.hinted_handoff.is_diverted(node)}
+        replicas += [node for node in targets if node not in replicas and node in self.replication_streams]
+        acks = AckCounter(needed)
+        for replica in replicas:
+            if replica in targets:
+                self.replication_streams[replica].enqueue(key, value, on_ack=acks.ack, urgent=True, version=version)
+            else:
+                self.replicate_put(replica, key, value, version)
+        if len(targets & set(replicas)) < needed or not acks.wait(self.quorum_timeout):
+            return f"Error: Write quorum not reached for '{key}' ({int(local_ack) + len(acks.acked)}/{w} acks)."
         return response
 
-    def handle_get(self, key):
-        value = self.storage[key]
-        # This will invoke __getitem__ in PersistentStorage
+    def add_peer(self, node):
+        """Start replicating to a node that joined the cluster and place it on the hash ring."""
+        if node == (self.host, self.port) or node in self.replicas:
+            return
+        self.replication_streams[node] = ReplicationStream(node, self.send_to_peer, source=f"{self.host}:{self.port}",
+                                                           **self.replication_options)
+        self.replicas.append(node)
+        self.consistent_hashing.add_node(node)
+        self.anti_entropy.invalidate()
+        logging.info(f"Added {node} to the hash ring; replicas are now {self.replicas}")
+
+    def remove_peer(self, node):
+        """Stop replicating to a node that left the cluster and take it off the hash ring."""
+        if node not in self.replicas:
+            return
+        self.consistent_hashing.remove_node(node)
+        self.anti_entropy.invalidate()
+        self.replicas.remove(node)
+        self.health_monitor.remove(node)
+        stream = self.replication_streams.pop(node)
+        stream.flush(timeout=self.quorum_timeout)
+        stream.close()
+        logging.info(f"Removed {node} from the hash ring; replicas are now {self.replicas}")
+
+    def replica_targets(self, key):
+        """
+        The other nodes that keep a copy of ``key``: its preference list on the ring, plus
+        the nodes taking the key over while this node leaves.
+        """
+        me = (self.host, self.port)
+        targets = [node for node in self.consistent_hashing.preference_list(key) if node != me]
+        if self.leaving_ring is not None:
+            targets += [node for node in self.leaving_ring.preference_list(key) if node not in targets]
+        return targets
+
+    def holds_replica(self, node, key):
+        return node in self.consistent_hashing.preference_list(key)
+
+    def join(self, seed):
+        """
+        Join a running cluster through ``seed``: announce this node to every member, which
+        then sends it the writes for its new ranges, and stream those ranges over from
+        their previous holders. Returns the number of keys streamed.
+        """
+        ring = json.loads(self.send_to_peer(seed, "RING"))
+        members = [(host, port) for host, port, _ in ring["nodes"] if (host, port) != (self.host, self.port)]
+        before = ConsistentHashing(members, replicas=ring["replicas"],
+                                   weights={(host, port): weight for host, port, weight in ring["nodes"]})
+        for member in members:
+            self.add_peer(member)
+        plan = before.transfer_plan(self.consistent_hashing)
+        for member in members:
+            response = self.send_to_peer(member, "JOIN", self.host, self.port)
+            if response != "JOINED":
+                raise RuntimeError(f"{member} refused the join: {response}")
+        streamed = self.rebalancer.pull_all(plan)
+        logging.info(f"Joined the cluster through {seed}; streamed {sum(streamed.values())} keys from {len(streamed)} nodes.")
+        return sum(streamed.values())
+
+    def leave(self):
+        """
+        Hand this node's ranges over and leave the ring. Each member pulls the ranges it
+        gains from this node before answering; meanwhile writes reaching this node are
+        forwarded to the new holders. Returns False if a member could not take its share.
+        """
+        self.leaving_ring = self.consistent_hashing.copy()
+        self.leaving_ring.remove_node((self.host, self.port))
+        # A member answers LEAVE only after pulling its share at --rebalance-rate keys per
+        # second, so each request gets a timeout sized to the keys that member gains
+        gained = Counter()
+        for key in self.storage.keys():
+            current = self.consistent_hashing.preference_list(key)
+            gained.update(node for node in self.leaving_ring.preference_list(key) if node not in current)
+        handed_over = True
+        for member in list(self.replicas):
+            timeout = self.connection_pool.request_timeout + 2 * gained[member] / self.rebalancer.rate
+            try:
+                response = self.send_to_peer(member, "LEAVE", self.host, self.port, timeout=timeout)
+            except Exception as e:
+                response = f"Error: {e}"
+            if not response.startswith("LEFT"):
+                logging.error(f"{member} did not take over its ranges from this node: {response}")
+                handed_over = False
+        for stream in self.replication_streams.values():
+            stream.flush(timeout=self.quorum_timeout)
+        return handed_over
+
+    def handle_leave(self, node):
+        """Pull the ranges this node gains from a leaving ``node``, then drop it from the ring."""
+        if node not in self.replicas:
+            return "LEFT 0"
+        after = self.consistent_hashing.copy()
+        after.remove_node(node)
+        streamed = self.rebalancer.pull_all(self.consistent_hashing.transfer_plan(after))
+        self.remove_peer(node)
+        return f"LEFT {sum(streamed.values())}"
+
+    def forward_while_leaving(self, writes):
+        """While this node leaves, send ``(key, value[, version])`` writes on to the nodes that gain their keys."""
+        if self.leaving_ring is None:
+            return
+        for key, value, *version in writes:
+            current = self.consistent_hashing.preference_list(key)
+            for node in self.leaving_ring.preference_list(key):
+                if node not in current and node in self.replication_streams:
+                    self.replicate_put(node, key, value, *version)
+
+    def active_nodes(self):
+        """This node plus the peers the HealthMonitor reports up."""
+        active_nodes = set(self.health_monitor.active_nodes)
+        active_nodes.add((self.host, self.port))
+        return active_nodes
+
+    def preference_list(self, key, n=None):
+        """Healthy nodes responsible for ``key``, skipping peers the HealthMonitor reports down."""
+        return self.consistent_hashing.preference_list(key, n, active_nodes=self.active_nodes())
+
+    def apply_replicated_batch(self, batch):
+        """Apply a batch shipped by another node's ReplicationStream, hinted handoff or read repair."""
+        if not batch:
+            return []
+        applied = self.write_batch(batch)
+        self.forward_while_leaving(applied)
+        return applied
+
+    def write_batch(self, writes, tracked=True):
+        """
+        Log ``[(key, value[, version]), ...]`` as one WAL record and apply it with a single
+        storage write; returns the writes applied. A versioned write is skipped when the
+        stored copy is at least as new, so replicas converge whatever order writes arrive in.
+        ``tracked=False`` is for transaction commits, whose versions the TransactionManager records itself.
+        """
+        versions = {}
+        for key, _, *version in writes:
+            versions[key] = version[0] if version else None
+            self.clock.observe(versions[key])
+        pairs = [(key, value) for key, value, *_ in writes]
+        self.rebalancer.observe(key for key, _ in pairs)
+        if tracked:
+            tracking = self.transaction_manager.tracking_write(
+                pairs, self.storage, keep=lambda key, _: self.is_current(key, versions[key]))
+        else:
+            tracking = contextlib.nullcontext(pairs)
+        with tracking as pairs:
+            if not pairs:
+                return []
+            lsn = self.backup_manager.log_write(["MPUT", [[key, value] for key, value in pairs]])
+            try:
+                self.storage.update(pairs)
+                self.store_versions((key, versions[key]) for key, _ in pairs)
+            finally:
+                self.backup_manager.mark_applied(lsn)
+                self.read_cache.invalidate_many(key for key, _ in pairs)
+        return [(key, value, versions[key]) for key, value in pairs]
+
+    def is_current(self, key, version):
+        """
+        Whether a write carrying ``version`` supersedes the stored copy of ``key``. An
+        unversioned write counts as older than any versioned copy, so it only replaces
+        a copy that has no version either.
+        """
+        stored = self.versions.get(key)
+        if version is None:
+            return stored is None
+        return newer(version, stored)
+
+    def store_versions(self, versions):
+        """Record ``(key, version)`` of applied writes; unversioned writes have nothing to record."""
+        versioned = [(key, version) for key, version in versions if version is not None]
+        if versioned:
+            self.versions.put_many(versioned)
+
+    def group_by_owner(self, keys):
+        """Map each healthy owning node (first in the preference list) to the keys it owns."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.preference_list(key, 1)[0], []).append(key)
+        return groups
+
+    def handle_mput(self, pairs):
+        """
+        Coordinate a multi-key write: the latest value per key is grouped by owning node
+        and every owner receives its sub-batch in parallel, persisting it in one write.
+        """
+        values = dict(pairs)
+        futures = {}
+        for owner, keys in self.group_by_owner(values).items():
+            sub_batch = [(key, values[key]) for key in keys]
+            if owner == (self.host, self.port):
+                futures[thread_pool.submit(self.apply_owned_batch, sub_batch)] = owner
+            else:
+                futures[thread_pool.submit(self.forward_batch, owner, sub_batch)] = owner
+        for future in as_completed(futures):
+            future.result()
+        return f"MPUT {len(values)} OK"
+
+    def forward_batch(self, owner, sub_batch):
+        """Send a sub-batch to its owner; falls back to applying it here if the owner is unreachable."""
+        try:
+            response = self.send_to_peer(owner, "BATCH_PUT", json.dumps(sub_batch))
+            if not response.startswith("Error"):
+                return len(sub_batch)
+            logging.error(f"Owner {owner} rejected a batch of {len(sub_batch)} writes: {response}")
+        except Exception as e:
+            logging.error(f"Failed to forward a batch of {len(sub_batch)} writes to {owner}: {e}")
+        return self.apply_owned_batch(sub_batch)
+
+    def apply_owned_batch(self, sub_batch):
+        """Persist a sub-batch locally in one write and queue it on every replication stream."""
+        if sub_batch:
+            for key, value, version in self.write_batch([(key, value, self.clock.now()) for key, value in sub_batch]):
+                for replica in self.replica_targets(key):
+                    self.replicate_put(replica, key, value, version)
+        return len(sub_batch)
+
+    def handle_mget(self, keys):
+        """Read many keys, asking each owning node for its keys in parallel; missing keys map to None."""
+        futures = {}
+        for owner, owned in self.group_by_owner(dict.fromkeys(keys)).items():
+            if owner == (self.host, self.port):
+                futures[thread_pool.submit(self.read_local_batch, owned)] = owner
+            else:
+                futures[thread_pool.submit(self.fetch_batch, owner, owned)] = owner
+        found = {}
+        for future in as_completed(futures):
+            found.update(future.result())
+        return {key: found.get(key) for key in keys}
+
+    def fetch_batch(self, owner, keys):
+        """Read ``keys`` from their owner; falls back to the local copy if the owner is unreachable."""
+        try:
+            response = self.send_to_peer(owner, "BATCH_GET", json.dumps(keys))
+            if not response.startswith("Error"):
+                return json.loads(response)
+            logging.error(f"Owner {owner} failed a batch read of {len(keys)} keys: {response}")
+        except Exception as e:
+            logging.error(f"Failed to read a batch of {len(keys)} keys from {owner}: {e}")
+        return self.read_local_batch(keys)
+
+    def read_local_batch(self, keys):
+        return {key: self.read_cache.get_or_load(key, self.storage.__getitem__) for key in keys}
+
+    def apply_transaction(self, pairs):
+        """Install a committed transaction's writes in one logged storage write and replicate them."""
+        for key, value, version in self.write_batch([(key, value, self.clock.now()) for key, value in pairs],
+                                                    tracked=False):
+            for replica in self.replica_targets(key):
+                self.replicate_put(replica, key, value, version)
+
+    def handle_transaction(self, transaction_id, action, args):
+        manager = self.transaction_manager
+        if action == "BEGIN":
+            if manager.begin(transaction_id):
+                return f"TRANSACTION {transaction_id} BEGIN OK"
+            return f"Error: Transaction {transaction_id} already exists."
+        try:
+            if action == "GET" and len(args) == 1:
+                value = manager.read(transaction_id, args[0], self.storage)
+                return f"GET {args[0]}={value}" if value is not None else f"Error: Key '{args[0]}' not found."
+            if action == "PUT" and len(args) == 2:
+                manager.write(transaction_id, args[0], args[1])
+                return f"TRANSACTION {transaction_id} PUT {args[0]} OK"
+        except KeyError as e:
+            return f"Error: {e.args[0]}"
+        if action == "EXECUTE":
+            return self.handle_execute(transaction_id, args)
+        if action == "STATUS":
+            return self.coordinator.status(transaction_id)
+        if action == "PREPARE":
+            return self.handle_prepare(transaction_id, args)
+        if action == "COMMIT":
+            return self.handle_commit(transaction_id)
+        if action == "ROLLBACK":
+            return self.handle_rollback(transaction_id)
+        return ("Invalid TRANSACTION command. Use BEGIN, GET <key>, PUT <key> <value>, PREPARE, COMMIT, "
+                "ROLLBACK, EXECUTE or STATUS.")
+
+    def handle_prepare(self, transaction_id, args):
+        """PREPARE takes the transaction's writes as ``<key> <value>`` pairs."""
+        if len(args) % 2:
+            return "Error: TRANSACTION PREPARE takes <key> <value> pairs."
+        if self.transaction_manager.prepare(transaction_id, dict(zip(args[::2], args[1::2]))):
+            return f"TRANSACTION {transaction_id} PREPARED"
+        return f"Error: Transaction {transaction_id} cannot be prepared."
+
+    def handle_execute(self, transaction_id, args):
+        """Coordinate a two-phase commit of ``<key> <value>`` pairs across the nodes owning them."""
+        if not args or len(args) % 2:
+            return "Error: TRANSACTION EXECUTE takes <key> <value> pairs."
+        committed, tid = self.coordinator.execute(transaction_id, dict(zip(args[::2], args[1::2])))
+        if committed:
+            return f"TRANSACTION {tid} COMMITTED"
+        return f"Error: Transaction {tid} aborted; a participant refused to prepare."
+
+    def handle_commit(self, transaction_id):
+        if self.transaction_manager.commit(transaction_id, self.storage):
+            return f"TRANSACTION {transaction_id} COMMITTED"
+        state = self.transaction_manager.transactions.get(transaction_id, {}).get("state")
+        if state is None:
+            return f"Error: Transaction {transaction_id} not found."
+        if state == "COMMITTED":
+            # A coordinator retrying its COMMIT after a lost acknowledgement
+            return f"TRANSACTION {transaction_id} COMMITTED"
+        if state == "ABORTED":
+            return f"Error: Transaction {transaction_id} aborted by a conflicting write."
+        return f"Error: Transaction {transaction_id} cannot be committed."
+
+    def resolve_in_doubt(self, transaction_ids, retry_interval=1.0):
+        """Ask the coordinators of PREPARED transactions restored on startup for their outcome."""
+        pending = [tid for tid in transaction_ids if coordinator_of(tid) is not None]
+        while pending:
+            for tid in list(pending):
+                coordinator = coordinator_of(tid)
+                try:
+                    if coordinator == (self.host, self.port):
+                        outcome = self.coordinator.status(tid)
+                    else:
+                        outcome = self.send_to_peer(coordinator, "TRANSACTION", tid, "STATUS")
+                except Exception as e:
+                    logging.error(f"Cannot reach coordinator {coordinator} of in-doubt transaction {tid}: {e}")
+                    continue
+                if outcome == "COMMITTED":
+                    self.handle_commit(tid)
+                elif outcome == "ABORTED":
+                    self.handle_rollback(tid)
+                else:
+                    continue
+                logging.info(f"In-doubt transaction {tid} resolved: {outcome}")
+                pending.remove(tid)
+            if pending:
+                time.sleep(retry_interval)
+
+    def handle_rollback(self, transaction_id):
+        if self.transaction_manager.rollback(transaction_id):
+            return f"TRANSACTION {transaction_id} ROLLED BACK"
+        return f"Error: Transaction {transaction_id} cannot be rolled back."
+
+    def replication_status(self):
+        """Per-replica lag of the outgoing replication streams."""
+        return {f"{host}:{port}": stream.lag() for (host, port), stream in self.replication_streams.items()}
+
+    def handle_scan(self, command, args, addr=None):
+        """Serve one page of a SCAN, PREFIX or QUERY request as JSON items plus a cursor."""
+        bounds = {"SCAN": 2, "PREFIX": 1, "QUERY": 2}[command]
+        usage = {
+            "SCAN": "'SCAN <start> <end> <limit> [cursor]'",
+            "PREFIX": "'PREFIX <prefix> <limit> [cursor]'",
+            "QUERY": "'QUERY <attribute> <value> <limit> [cursor]'",
+        }[command]
+        if len(args) not in (bounds + 1, bounds + 2) or not args[bounds].isdigit():
+            logging.error(f"Malformed {command} command: {args} from {addr}")
+            return f"Error: {command} command must be in the format {usage}."
+        limit = min(int(args[bounds]), MAX_SCAN_LIMIT)
+        cursor = args[bounds + 1] if len(args) > bounds + 1 else None
+        if command == "SCAN":
+            items, cursor = self.storage.scan(args[0], args[1], limit, cursor)
+        elif command == "PREFIX":
+            items, cursor = self.storage.prefix(args[0], limit, cursor)
+        elif args[0] not in self.storage.secondary_indexes:
+            return f"Error: No secondary index on '{args[0]}'."
+        else:
+            items, cursor = self.storage.query(args[0], args[1], limit, cursor)
+        return json.dumps({"items": items, "cursor": cursor})
+
+    def handle_get(self, key, options=None):
+        n, r, _ = self.quorum.resolve(options or {})
+        # A node outside the key's preference list holds no copy, so it reads from the replicas
+        if (self.host, self.port) not in self.preference_list(key, n):
+            return self.quorum_get(key, None, n, r)
+        # Hot keys are served from the read cache; misses invoke __getitem__ in PersistentStorage
+        value = self.read_cache.get_or_load(key, self.storage.__getitem__)
+        if r > 1:
+            return self.quorum_get(key, value, n, r)
         if value is None:
             return f"Error: Key '{key}' not found."
         return f"GET {key}={value}"
 
+    def quorum_get(self, key, local_value, n, r):
+        """
+        Read from the key's preferred replicas in parallel and answer after R replies with
+        the newest version among them. Replicas found holding an older version, including
+        those replying after the answer, are repaired in the background (read repair).
+        """
+        me = (self.host, self.port)
+        preferred = self.preference_list(key, n)
+        targets = [node for node in preferred if node != me]
+        futures = {thread_pool.submit(self.send_to_peer, node, "VERSIONED_GET", key): node for node in targets}
+        # A copy on a node outside the preference list is no replica and fills no quorum slot
+        replies = {me: (local_value, self.versions.get(key))} if me in preferred else {}
+        late = set(futures)
+        try:
+            if len(replies) < r:
+                for future in as_completed(futures, timeout=self.quorum_timeout):
+                    late.discard(future)
+                    reply = self._versioned_reply(key, future)
+                    if reply is not None:
+                        replies[futures[future]] = reply
+                    # Answer as soon as the R-th reply is in, not when the slowest replica replies
+                    if len(replies) >= r:
+                        break
+        except FuturesTimeoutError:
+            pass
+        if len(replies) < r:
+            return f"Error: Read quorum not reached for '{key}' ({len(replies)}/{r} replies)."
+        found = [reply for reply in replies.values() if reply[0] is not None]
+        if not found:
+            return f"Error: Key '{key}' not found."
+        version = max((reply[1] for reply in found), key=parse_version)
+        # Among copies of the newest version the value most replicas agree on wins (ties favour the first reply)
+        values = Counter(str(value) for value, other in found if other == version)
+        value = next(value for value, other in found if other == version and values[str(value)] == max(values.values()))
+
+        for node, (other_value, other_version) in replies.items():
+            if other_value is None or newer(version, other_version):
+                thread_pool.submit(self.repair_replica, node, key, value, version)
+        for future in late:
+            future.add_done_callback(lambda done, node=futures[future]: thread_pool.submit(
+                self._repair_if_stale, node, done, key, value, version))
+        return f"GET {key}={value}"
+
+    @staticmethod
+    def _versioned_reply(key, future):
+        """(value, version) from a VERSIONED_GET future, or None if the replica failed."""
+        try:
+            value, version = json.loads(future.result())
+            return value, version
+        except Exception as e:
+            logging.warning(f"Quorum read of '{key}' failed on a replica: {e}")
+            return None
+
+    def _repair_if_stale(self, node, future, key, value, version):
+        """Read repair for a replica whose reply arrived after the read was answered."""
+        reply = self._versioned_reply(key, future)
+        if reply is not None and (reply[0] is None or newer(version, reply[1])):
+            self.repair_replica(node, key, value, version)
+
+    def repair_replica(self, node, key, value, version):
+        """Read repair: send the newest ``value`` of ``key`` to a replica that returned an older one."""
+        write = [(key, value, version)]
+        try:
+            if node == (self.host, self.port):
+                self.write_batch(write)
+            else:
+                response = self.send_to_peer(node, "RANGE_APPLY", json.dumps(write))
+                if not response.startswith("OK"):
+                    raise RuntimeError(response)
+        except Exception as e:
+            logging.error(f"Read repair of '{key}' on {node} failed: {e}")
+            return
+        with self._repair_lock:
+            self.read_repairs += 1
+        logging.info(f"Read repair: sent version {version} of '{key}' to {node}")
+
     def integrity_check(self):
         while True:
-            root_hash = self.merkle_tree.build_tree()
-            for node in self.active_nodes:
+            time.sleep(self.anti_entropy_interval)
+            for node in self.replicas:
                 try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                        sock.connect(node)
-                        sock.sendall(f"CHECK_HASH {root_hash}".encode('utf-8'))
-                        response = sock.recv(1024).decode('utf-8')
-                        if response != "MATCH":
-                            logging.warning(f"Hash mismatch with node {node}")
-                            self.resync_with_node(node)
+                    root_hash = self.anti_entropy.shared_tree(node).root_hash
+                    response = self.connection_pool.request(node, "CHECK_HASH", root_hash, f"{self.host}:{self.port}")
+                    if response != "MATCH":
+                        logging.warning(f"Hash mismatch with node {node}")
+                        self.resync_with_node(node)
                 except Exception as e:
                     logging.error(f"Error checking integrity with node {node}: {e}")
-            time.sleep(30)  # Check every 30 seconds
 
-    def replicate_put(self, replica, key, value, root_hash):
-        # Define the replicate task that will be executed by the thread
-        def replicate_task(replica, key, value):
-            try:
-                # Create a socket to connect to the replica
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as replica_socket:
-                    # Connect to the replica server
-                    replica_socket.connect(replica)
-                    
-                    # Send PUT command with root hash for verification
-                    command = f"PUT {key} {value} ROOT_HASH {root_hash}"
-                    replica_socket.sendall(command.encode('utf-8'))
-                    
-                    # Format the PUT request with the replication flag
-                    # command = f"PUT {key} {value} replication=true"
-                    # replica_socket.sendall(command.encode('utf-8'))  # Send the data to the replica
-                    
-                    logging.info(f"Replication success for key '{key}' to replica {replica}")
-            except Exception as e:
-                # Handle any errors that occur during replication
-                logging.error(f"Error replicating key '{key}' to replica {replica}: {e}")
-        
-        # Create and start the thread for non-blocking replication
-        threading.Thread(target=replicate_task, args=(replica, key, value)).start()
+    def resync_with_node(self, node, prefer_remote=False):
+        """Exchange only the key ranges whose Merkle hashes differ from ``node``'s."""
+        return self.anti_entropy.sync_with(node, prefer_remote=prefer_remote)
+
+    def replicate_put(self, replica, key, value, version=None):
+        if self.hinted_handoff.is_diverted(replica):
+            # The replica is down (or still catching up): keep the write as a hint
+            self.hinted_handoff.hint(replica, key, value, version)
+            return
+        stream = self.replication_streams.get(replica)
+        if stream is not None:  # None once the replica has left the cluster
+            # Coalesced and shipped in order by the replica's background stream
+            stream.enqueue(key, value, version=version)
+
+    def replica_status_changed(self, node, alive):
+        """HealthMonitor callback: start hinting a replica's writes when it goes down, hand them over when it returns."""
+        if node not in self.replication_streams:
+            return
+        if not alive:
+            self.hinted_handoff.divert(node)
+            for key, value, version in self.replication_streams[node].take_pending():
+                self.hinted_handoff.hint(node, key, value, version)
+        else:
+            threading.Thread(target=self.hand_off_hints, args=(node,), daemon=True).start()
+
+    def hand_off_hints(self, node):
+        # A batch that was in flight when the replica went down lands before the hints
+        stream = self.replication_streams.get(node)
+        if stream is not None:
+            stream.flush()
+        self.hinted_handoff.replay(node, is_alive=lambda: self.health_monitor.is_alive(node))
 
+    def send_to_peer(self, peer, *fields, timeout=None):
+        """Send one command to another node over a pooled connection."""
+        return self.connection_pool.request(peer, *fields, timeout=timeout)
 
     def start_server(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
@@ -240,27 +892,36 @@ class Server:
                 thread = threading.Thread(target=self.handle_client, args=(conn, addr))
                 thread.start()
     
-    def recover_data(self, node):
-        try:
-            logging.info(f"Attempting to recover data for node {node}")
-            # Assume we can query replica nodes for missing data
-            for key in self.storage.keys():
-                responsible_node = self.consistent_hashing.get_node(key)
-                if responsible_node == (self.host, self.port):  # Current node is responsible
-                    # Re-fetch missing data
-                    self.storage.put(key, self.fetch_data_from_replicas(key))
-        except Exception as e:
-            logging.error(f"Error recovering data for node {node}: {e}")
+    def recover_data(self, node=None):
+        """Catch up with ``node`` (default: every replica), taking their copy of conflicting keys."""
+        for peer in [node] if node else self.replicas:
+            try:
+                logging.info(f"Attempting to recover data from node {peer}")
+                self.resync_with_node(peer, prefer_remote=True)
+            except Exception as e:
+                logging.error(f"Error recovering data from node {peer}: {e}")
     
+    def restore_backup(self):
+        """
+        Load the latest snapshot chain into storage and replay the WAL written after it;
+        the Merkle tree follows the restored writes and drops keys no longer stored.
+        """
+        lsn = self.backup_manager.restore()
+        self.read_cache.clear()
+        if lsn is not None:
+            self.backup_manager.replay_log(start_lsn=lsn)
+            for bucket in self.merkle_tree.buckets:
+                for key in [key for key in bucket if key not in self.storage]:
+                    self.merkle_tree.remove(key)
+        return lsn
+
     def validate_replicas(self, replicas):
         validated_replicas = []
         for replica in replicas:
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.settimeout(2)  # Timeout for connection attempt
-                    sock.connect(replica)
+                self.connection_pool.request(replica, "HEARTBEAT", timeout=2)
                 validated_replicas.append(replica)
-            except (socket.error, ConnectionRefusedError):
+            except (OSError, ProtocolError):
                 logging.warning(f"Replica {replica} is unreachable and will be excluded.")
         return validated_replicas
 
@@ -268,48 +929,122 @@ class Server:
     def fetch_data_from_replicas(self, key):
         for replica in self.replicas:
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    sock.connect(replica)
-                    sock.sendall(f"GET {key}".encode('utf-8'))
-                    response = sock.recv(1024).decode('utf-8')
-                    if not response.startswith("Error"):
-                        return response
+                response = self.connection_pool.request(replica, "GET", key)
+                if not response.startswith("Error"):
+                    return response
             except Exception as e:
                 logging.error(f"Failed to fetch key '{key}' from replica {replica}: {e}")
         return None
 
 
-# Parse command-line arguments for port and optional replicas
-parser = argparse.ArgumentParser(description="Start a distributed key-value store server.")
-parser.add_argument("--host", type=str, default="127.0.0.1", help="Host IP address of the server (default: 127.0.0.1)")
-parser.add_argument("--port", type=int, required=True, help="Port number the server will bind to.")
-parser.add_argument(
-    "--replicas",
-    type=str,
-    nargs="*",
-    help="List of replica nodes in the format 'host:port', separated by spaces.",
-)
-parser.add_argument("--node-id", type=str, default=None, help="Unique identifier for the server node (optional).")
-args = parser.parse_args()
+def main():
+    # Parse command-line arguments for port and optional replicas
+    parser = argparse.ArgumentParser(description="Start a distributed key-value store server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host IP address of the server (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, required=True, help="Port number the server will bind to.")
+    parser.add_argument(
+        "--replicas",
+        type=str,
+        nargs="*",
+        help="List of replica nodes in the format 'host:port', separated by spaces.",
+    )
+    parser.add_argument("--node-id", type=str, default=None, help="Unique identifier for the server node (optional).")
+    parser.add_argument(
+        "--storage-engine",
+        type=str,
+        choices=["log", "json"],
+        default="log",
+        help="Storage backend: append-only log segments or the legacy single JSON file (default: log).",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=["none", "zlib", "lzma"],
+        default="none",
+        help="Compress stored values of 256 bytes or more with the log engine (default: none).",
+    )
+    parser.add_argument(
+        "--wal-sync",
+        type=str,
+        choices=["always", "interval", "bytes"],
+        default="interval",
+        help="WAL fsync policy: per operation, every --wal-sync-interval ms, or every --wal-sync-bytes bytes.",
+    )
+    parser.add_argument("--wal-sync-interval", type=int, default=100, help="Milliseconds between WAL syncs (default: 100).")
+    parser.add_argument("--wal-sync-bytes", type=int, default=64 * 1024, help="Unsynced WAL bytes that trigger a sync (default: 65536).")
+    parser.add_argument("--replication-factor", type=int, default=3, help="Replicas per key, N (default: 3).")
+    parser.add_argument("--read-quorum", type=int, default=1, help="Replies a read waits for, R (default: 1).")
+    parser.add_argument("--write-quorum", type=int, default=1, help="Acks a write waits for, W (default: 1).")
+    parser.add_argument("--cache-entries", type=int, default=10000, help="Hot-key read cache size, 0 disables it (default: 10000).")
+    parser.add_argument("--cache-ttl", type=float, default=30.0, help="Seconds a cached value stays valid (default: 30).")
+    parser.add_argument(
+        "--index",
+        dest="indexes",
+        action="append",
+        default=[],
+        help="Attribute of JSON object values to keep a secondary index on for QUERY (repeatable).",
+    )
+    parser.add_argument("--scan-concurrency", type=int, default=8, help="Nodes a CLUSTER_SCAN queries at once (default: 8).")
+    parser.add_argument("--gossip-interval", type=float, default=1.0,
+                        help="Seconds between gossip rounds; 0 disables failure detection (default: 1).")
+    parser.add_argument("--gossip-fanout", type=int, default=3, help="Peers contacted per gossip round (default: 3).")
+    parser.add_argument("--hint-max-bytes", type=int, default=64 * 1024 * 1024,
+                        help="Hinted-handoff bytes kept per unavailable replica (default: 64 MiB).")
+    parser.add_argument("--hint-replay-rate", type=int, default=5000,
+                        help="Hinted writes handed over per second to a returning replica (default: 5000).")
+    parser.add_argument("--join", type=str, default=None,
+                        help="Join a running cluster through this 'host:port' member, streaming over the ranges this node takes.")
+    parser.add_argument("--rebalance-chunk", type=int, default=500, help="Keys per range-transfer request (default: 500).")
+    parser.add_argument("--rebalance-rate", type=int, default=5000,
+                        help="Keys streamed per second while rebalancing (default: 5000).")
+    parser.add_argument(
+        "--io-mode",
+        type=str,
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Serve connections with one thread each, or from a single asyncio event loop (default: threads).",
+    )
+    args = parser.parse_args()
 
-# Parse replicas into tuples of (host, port)
-replicas = []
-if args.replicas:
-    for replica in args.replicas:
-        try:
-            host, port = replica.split(":")
-            replicas.append((host, int(port)))
-        except ValueError:
-            print(f"Invalid replica format: {replica}. Use 'host:port'.")
-            exit(0)
-
-# Create and start the server
-server = Server(host=args.host, port=args.port, replicas=replicas, node_id=args.node_id)
-print(f"Starting server on {args.host}:{args.port} with replicas: {replicas}")
-server.start_server()
-# Example: Save a snapshot every 10 minutes
-import time
+    # Parse replicas into tuples of (host, port)
+    replicas = []
+    if args.replicas:
+        for replica in args.replicas:
+            try:
+                host, port = replica.split(":")
+                replicas.append((host, int(port)))
+            except ValueError:
+                print(f"Invalid replica format: {replica}. Use 'host:port'.")
+                exit(0)
+
+    # Create and start the server
+    server_class = Server
+    if args.io_mode == "asyncio":
+        from server.async_server import AsyncServer
+        server_class = AsyncServer
+    server = server_class(host=args.host, port=args.port, replicas=replicas, node_id=args.node_id,
+                          storage_engine=args.storage_engine, wal_sync=args.wal_sync,
+                          wal_sync_interval=args.wal_sync_interval, wal_sync_bytes=args.wal_sync_bytes,
+                          replication_factor=args.replication_factor, read_quorum=args.read_quorum,
+                          write_quorum=args.write_quorum, cache_entries=args.cache_entries,
+                          cache_ttl=args.cache_ttl, secondary_indexes=args.indexes,
+                          scan_concurrency=args.scan_concurrency, gossip_interval=args.gossip_interval,
+                          gossip_fanout=args.gossip_fanout, hint_max_bytes=args.hint_max_bytes,
+                          hint_replay_rate=args.hint_replay_rate, rebalance_chunk=args.rebalance_chunk,
+                          rebalance_rate=args.rebalance_rate,
+                          value_compression=None if args.compression == "none" else args.compression)
+    print(f"Starting server on {args.host}:{args.port} with replicas: {replicas}")
+    if args.join:
+        host, port = args.join.split(":")
+        # Members stream ranges over while this node already serves requests
+        threading.Thread(target=server.join, args=((host, int(port)),), daemon=True).start()
+    server.start_server()
 
+
+if __name__ == "__main__":
+    main()
+
+# Example: Save a snapshot every 10 minutes
 # while True:
 #     time.sleep(6)  # Sleep for 10 minutes
 #     self.backup_manager.save_snapshot()
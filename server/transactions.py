@@ -0,0 +1,434 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+class TransactionLog:
+    """
+    Append-only JSON-lines log of transaction records, fsynced record by record.
+
+    ``pending`` holds the latest record of every transaction not yet marked done. On
+    open the file is rewritten with only those records, so it stays small.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn final write
+                    self._track(record)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.pending.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _track(self, record):
+        if record.get("done"):
+            self.pending.pop(record["tid"], None)
+        else:
+            self.pending[record["tid"]] = record
+
+    def append(self, transaction_id, **fields):
+        """Durably record ``fields`` for a transaction; ``done=True`` retires it."""
+        record = dict(fields, tid=transaction_id)
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._track(record)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TransactionManager:
+    """
+    Multi-version transactions with snapshot isolation.
+
+    A transaction reads the snapshot of its start timestamp: committed values are
+    kept as versioned chains for as long as an open snapshot may need an older
+    version, so readers never wait for writers. Writes are buffered until commit.
+    Commit checks optimistically that no key in the write set was written after the
+    transaction started (first committer wins). Only the per-key locks of that write
+    set are held, so transactions on disjoint keys commit in parallel. While no
+    transaction is open, writes keep no versions at all.
+
+    A PREPARED transaction is a binding vote for two-phase commit: its keys are
+    reserved, so no other transaction can commit or prepare over them and plain
+    writes to them wait until it is decided (up to ``reservation_timeout`` seconds).
+    With a ``log`` the vote is made durable before it is returned and re-registered
+    by ``recover`` after a restart.
+
+    Plain writes that bypass transactions should go through ``tracking_write`` so
+    open snapshots keep the version they started with and conflicts are detected.
+    Finished transactions are forgotten after ``retention`` seconds, and versions
+    no open snapshot can see any more are garbage-collected.
+    """
+
+    def __init__(self, on_commit=None, apply=None, lock_stripes=64, retention=60.0, gc_every=64, log=None,
+                 reservation_timeout=10.0):
+        self.transactions = {}  # {transaction_id: {"state": "ACTIVE/PREPARED/COMMITTED/ABORTED", "data": {key: value}, ...}}
+        self.on_commit = on_commit  # called with the committed keys, e.g. to invalidate read caches
+        self.apply = apply          # apply([(key, value), ...]) installs committed writes; default storage.put
+        self.retention = retention
+        self.gc_every = gc_every
+        self._lock = threading.Lock()  # guards the bookkeeping below; never held while writing storage
+        self._decided = threading.Condition(self._lock)  # notified when reservations are released
+        self._drained = threading.Condition(self._lock)  # notified when a write is installed
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self._clock = itertools.count(1)
+        self._last_ts = 0
+        self._inflight = set()      # timestamps of writes not yet installed in storage
+        self._versions = {}         # key -> [(ts, value), ...] oldest first; ts 0 is the pre-transaction value
+        self._last_write = {}       # key -> ts of its latest write
+        self._open = 0              # open transactions, i.e. snapshots that may need older versions
+        self._finished = 0
+        self._reserved = {}         # key -> id of the PREPARED transaction that will write it
+        self.reservation_timeout = reservation_timeout
+        self.log = log              # TransactionLog of prepared votes, or None
+        logging.basicConfig(level=logging.INFO)
+
+    # -- timestamps and versions --------------------------------------------
+
+    def _visible_ts(self):
+        """Newest timestamp whose writes, and every earlier one's, are fully installed."""
+        return min(self._inflight) - 1 if self._inflight else self._last_ts
+
+    def _write_locks(self, keys):
+        return [self._stripes[i] for i in sorted({hash(key) % len(self._stripes) for key in keys})]
+
+    def _allocate_ts(self):
+        ts = next(self._clock)
+        self._last_ts = max(self._last_ts, ts)
+        self._inflight.add(ts)
+        return ts
+
+    def _open_snapshot(self):
+        """
+        Count a new open snapshot and return its start timestamp; call with ``_lock``
+        held. Writes that began while no snapshot was open kept no versions, so the
+        snapshot starts once they are installed and includes them.
+        """
+        self._open += 1
+        unrecorded = set(self._inflight)
+        while unrecorded & self._inflight:
+            self._drained.wait()
+        return self._visible_ts()
+
+    def _open_starts(self):
+        return [txn["start_ts"] for txn in self.transactions.values()
+                if txn["state"] in ("ACTIVE", "PREPARED", "COMMITTING")]
+
+    @contextlib.contextmanager
+    def tracking_write(self, pairs, storage, keep=None):
+        """
+        Wrap a non-transactional write of ``pairs`` so open snapshots and commit checks see it.
+        Yields the pairs to write: with ``keep(key, value)``, those it accepts once their
+        keys are locked, so the check and the write are atomic with other writes. Waits
+        while a PREPARED transaction holds one of the keys, whose COMMIT would otherwise
+        overwrite this write; raises TimeoutError if it stays undecided too long.
+        """
+        pairs = list(pairs)
+        locks = self._write_locks(key for key, _ in pairs)
+        deadline = time.monotonic() + self.reservation_timeout
+        while True:
+            for lock in locks:
+                lock.acquire()
+            locked = False
+            try:
+                kept = pairs if keep is None else [(key, value) for key, value in pairs if keep(key, value)]
+                with self._lock:
+                    reserved = [key for key, _ in kept if key in self._reserved]
+                    if not reserved:
+                        # Marked written at once, so a PREPARE from now on sees the conflict
+                        ts = self._allocate_ts()
+                        record = self._open > 0
+                        for key, _ in kept:
+                            self._last_write[key] = max(ts, self._last_write.get(key, 0))
+                        locked = True
+            finally:
+                if not locked:
+                    for lock in reversed(locks):
+                        lock.release()
+            if locked:
+                break
+            self._wait_for_decision(reserved, deadline)
+        pairs = kept
+        try:
+            try:
+                # Only an open snapshot can need the value being replaced
+                if record:
+                    for key, value in pairs:
+                        self._record_version(key, ts, value, storage)
+                yield pairs
+            finally:
+                with self._lock:
+                    self._installed(ts, [key for key, _ in pairs])
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _wait_for_decision(self, keys, deadline):
+        """Block until no PREPARED transaction holds ``keys``."""
+        with self._decided:
+            while any(key in self._reserved for key in keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    holders = sorted({self._reserved[key] for key in keys if key in self._reserved})
+                    raise TimeoutError(f"Keys {keys} are held by undecided transaction(s) {holders}")
+                self._decided.wait(remaining)
+
+    def _record_version(self, key, ts, value, storage):
+        # Called under the key's stripe lock, so storage still holds the previous version
+        with self._lock:
+            chain = self._versions.get(key)
+        if chain is None:
+            previous = self._read_storage(storage, key)
+            with self._lock:
+                chain = self._versions.setdefault(key, [(0, previous)])
+        with self._lock:
+            chain.append((ts, value))
+            chain.sort(key=lambda version: version[0])
+
+    def _installed(self, ts, keys):
+        """Mark the write at ``ts`` as in storage; without open snapshots its versions are dropped at once."""
+        self._inflight.discard(ts)
+        self._drained.notify_all()
+        if self._open:
+            return
+        visible = self._visible_ts()
+        for key in keys:
+            if self._last_write.get(key, 0) <= visible:
+                self._last_write.pop(key, None)
+            chain = self._versions.get(key)
+            if chain is not None and chain[-1][0] <= visible:
+                del self._versions[key]
+
+    @staticmethod
+    def _read_storage(storage, key):
+        value = storage.get(key)
+        # InMemoryStorage reports a missing key as an error string
+        if isinstance(value, str) and value == f"Error: Key '{key}' not found.":
+            return None
+        return value
+
+    # -- transaction lifecycle ------------------------------------------------
+
+    def begin(self, transaction_id):
+        with self._lock:
+            if transaction_id in self.transactions:
+                logging.error(f"Transaction {transaction_id} already exists.")
+                return False
+            txn = self.transactions[transaction_id] = {"state": "ACTIVE", "data": {}, "start_ts": self._visible_ts()}
+            txn["start_ts"] = self._open_snapshot()
+        logging.info(f"Transaction {transaction_id} started.")
+        return True
+
+    def read(self, transaction_id, key, storage):
+        """The value of ``key`` in the transaction's snapshot, including its own buffered writes."""
+        txn = self.transactions.get(transaction_id)
+        if txn is None or txn["state"] not in ("ACTIVE", "PREPARED"):
+            raise KeyError(f"Transaction {transaction_id} is not open")
+        if key in txn["data"]:
+            return txn["data"][key]
+        found, value = self._snapshot_version(key, txn["start_ts"])
+        if found:
+            return value
+        # A write may be between recording its version and updating storage; under the
+        # key's stripe lock none is, so check the chain again and storage then holds the snapshot's value
+        with self._write_locks([key])[0]:
+            found, value = self._snapshot_version(key, txn["start_ts"])
+            return value if found else self._read_storage(storage, key)
+
+    def _snapshot_version(self, key, start_ts):
+        """(True, value) of the newest version of ``key`` at or before ``start_ts``, else (False, None)."""
+        with self._lock:
+            chain = list(self._versions.get(key, ()))
+        for ts, value in reversed(chain):
+            if ts <= start_ts:
+                return True, value
+        return False, None
+
+    def write(self, transaction_id, key, value):
+        txn = self.transactions.get(transaction_id)
+        if txn is None or txn["state"] != "ACTIVE":
+            raise KeyError(f"Transaction {transaction_id} is not active")
+        txn["data"][key] = value
+
+    def prepare(self, transaction_id, operations):
+        with self._lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is not None and txn["state"] != "ACTIVE":
+                logging.error(f"Transaction {transaction_id} already exists. Cannot prepare again.")
+                return False
+            if txn is None:
+                start_ts = self._open_snapshot()
+                if transaction_id in self.transactions:
+                    self._open -= 1
+                    logging.error(f"Transaction {transaction_id} already exists. Cannot prepare again.")
+                    return False
+            else:
+                start_ts = txn["start_ts"]
+            writes = dict(txn["data"]) if txn is not None else {}
+            writes.update(operations)
+            conflicts = [key for key in writes if self._last_write.get(key, 0) > start_ts
+                         or self._reserved.get(key, transaction_id) != transaction_id]
+            if conflicts:
+                if txn is not None:
+                    self._finish(txn, "ABORTED")
+                else:
+                    self._open -= 1
+                logging.info(f"Transaction {transaction_id} cannot prepare: {conflicts} changed or reserved.")
+                return False
+            self.transactions[transaction_id] = {"state": "PREPARED", "data": writes, "start_ts": start_ts}
+            for key in writes:
+                self._reserved[key] = transaction_id
+        if self.log is not None:
+            self.log.append(transaction_id, prepared=writes)
+        logging.info(f"Transaction {transaction_id} prepared with operations: {operations}")
+        return True
+
+    def recover(self):
+        """Re-register the PREPARED transactions of the log; returns their ids (in doubt until decided)."""
+        if self.log is None:
+            return []
+        with self._lock:
+            for transaction_id, record in self.log.pending.items():
+                self.transactions[transaction_id] = {"state": "PREPARED", "data": record["prepared"],
+                                                     "start_ts": self._visible_ts()}
+                self._open += 1
+                for key in record["prepared"]:
+                    self._reserved[key] = transaction_id
+            return list(self.log.pending)
+
+    def _release(self, transaction_id, txn):
+        """Drop the key reservations of a PREPARED transaction; call with ``_lock`` held."""
+        for key in txn["data"]:
+            if self._reserved.get(key) == transaction_id:
+                del self._reserved[key]
+        self._decided.notify_all()
+
+    def commit(self, transaction_id, storage):
+        txn = self.transactions.get(transaction_id)
+        if txn is None:
+            logging.error(f"Transaction {transaction_id} not found. Cannot commit.")
+            return False
+        if txn["state"] not in ("ACTIVE", "PREPARED"):
+            logging.error(f"Transaction {transaction_id} is not in PREPARED state, cannot commit.")
+            return False
+        writes = txn["data"]
+        locks = self._write_locks(writes)
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self._lock:
+                if txn["state"] not in ("ACTIVE", "PREPARED"):
+                    return False
+                prepared = txn["state"] == "PREPARED"
+                # A PREPARED transaction was validated and its keys reserved when it voted
+                conflicts = [] if prepared else [
+                    key for key in writes
+                    if self._last_write.get(key, 0) > txn["start_ts"] or key in self._reserved]
+                if conflicts:
+                    self._finish(txn, "ABORTED")
+                    logging.info(f"Transaction {transaction_id} aborted: {conflicts} changed since it started.")
+                    return False
+                txn["state"] = "COMMITTING"
+                ts = self._allocate_ts()
+                for key in writes:
+                    self._last_write[key] = max(ts, self._last_write.get(key, 0))
+            try:
+                for key, value in writes.items():
+                    self._record_version(key, ts, value, storage)
+                if self.apply is not None:
+                    self.apply(list(writes.items()))
+                else:
+                    for key, value in writes.items():
+                        storage.put(key, value)
+            finally:
+                with self._lock:
+                    txn["commit_ts"] = ts
+                    self._finish(txn, "COMMITTED")
+                    self._release(transaction_id, txn)
+                    self._installed(ts, list(writes))
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        if prepared and self.log is not None:
+            self.log.append(transaction_id, done=True)
+        if self.on_commit is not None:
+            self.on_commit(list(writes))
+        logging.info(f"Transaction {transaction_id} committed at {ts}.")
+        self.collect_garbage()
+        return True
+
+    def rollback(self, transaction_id):
+        with self._lock:
+            txn = self.transactions.get(transaction_id)
+            if txn is None:
+                logging.error(f"Transaction {transaction_id} not found. Cannot rollback.")
+                return False
+            if txn["state"] not in ("ACTIVE", "PREPARED"):
+                logging.error(f"Transaction {transaction_id} is not in PREPARED state, cannot rollback.")
+                return False
+            del self.transactions[transaction_id]
+            self._release(transaction_id, txn)
+            self._finished += 1
+            self._open -= 1
+        if txn["state"] == "PREPARED" and self.log is not None:
+            self.log.append(transaction_id, done=True)
+        logging.info(f"Transaction {transaction_id} rolled back.")
+        self.collect_garbage()
+        return True
+
+    def _finish(self, txn, state):
+        if txn["state"] in ("ACTIVE", "PREPARED", "COMMITTING"):
+            self._open -= 1
+        txn["state"] = state
+        txn["finished_at"] = time.monotonic()
+        self._finished += 1
+
+    # -- garbage collection ---------------------------------------------------
+
+    def collect_garbage(self, force=False):
+        """
+        Forget transactions finished more than ``retention`` seconds ago and versions no
+        open snapshot can read. Runs every ``gc_every`` finished transactions, and
+        whenever no transaction is open.
+        """
+        with self._lock:
+            open_starts = self._open_starts()
+            if not force and open_starts and self._finished % self.gc_every:
+                return
+            horizon = min(open_starts + [self._visible_ts()])
+            cutoff = time.monotonic() - self.retention
+            for transaction_id in [tid for tid, txn in self.transactions.items()
+                                   if txn.get("finished_at", cutoff + 1) <= cutoff]:
+                del self.transactions[transaction_id]
+            for key in list(self._versions):
+                chain = self._versions[key]
+                # The newest version at or below the horizon is the oldest anyone can still read
+                keep_from = 0
+                for index, (ts, _) in enumerate(chain):
+                    if ts <= horizon:
+                        keep_from = index
+                del chain[:keep_from]
+                if len(chain) == 1 and chain[0][0] <= horizon:
+                    del self._versions[key]  # storage holds this version
+            for key in [key for key, ts in self._last_write.items() if ts <= horizon]:
+                del self._last_write[key]
@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+def parse_version(version):
+    """
+    Sort key of a version string ``<physical ms>:<logical>:<node>``. A missing version
+    (a value written before versioning, or copied without one) sorts before every other.
+    """
+    if not version:
+        return (0, 0, "")
+    physical, logical, node = version.split(":", 2)
+    return (int(physical), int(logical), node)
+
+
+def newer(version, other):
+    """True if ``version`` supersedes ``other``."""
+    return parse_version(version) > parse_version(other)
+
+
+class HybridClock:
+    """
+    Hybrid logical clock stamping every write with a version.
+
+    A version is the wall-clock millisecond plus a logical counter that advances when
+    several writes share a millisecond, or when the clock has seen a version from a node
+    whose clock runs ahead. Versions therefore follow causality (a write that saw another
+    gets a higher version), stay close to real time, and the node name breaks the
+    remaining ties, so every replica orders any two writes of a key the same way.
+    """
+
+    def __init__(self, node, wall_clock=time.time):
+        self.node = node              # "host:port" of this node
+        self.wall_clock = wall_clock
+        self._lock = threading.Lock()
+        self._physical = 0
+        self._logical = 0
+
+    def now(self):
+        """A new version, higher than every version this clock issued or observed."""
+        wall = int(self.wall_clock() * 1000)
+        with self._lock:
+            if wall > self._physical:
+                self._physical, self._logical = wall, 0
+            else:
+                self._logical += 1
+            return f"{self._physical}:{self._logical}:{self.node}"
+
+    def observe(self, version):
+        """Move the clock past a version received from another node."""
+        if not version:
+            return
+        physical, logical, _ = parse_version(version)
+        with self._lock:
+            if (physical, logical) > (self._physical, self._logical):
+                self._physical, self._logical = physical, logical
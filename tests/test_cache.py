@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from utils.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2, ttl=None)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (3, 1, 1))
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_get_or_load_caches_found_values_only(self):
+        cache = LRUCache()
+        loads = []
+        loader = lambda key: loads.append(key) or ("value" if key == "a" else None)
+        self.assertEqual(cache.get_or_load("a", loader), "value")
+        self.assertEqual(cache.get_or_load("a", loader), "value")
+        self.assertIsNone(cache.get_or_load("missing", loader))
+        self.assertIsNone(cache.get_or_load("missing", loader))
+        self.assertEqual(loads, ["a", "missing", "missing"])
+
+    def test_invalidation_during_load_discards_loaded_value(self):
+        cache = LRUCache()
+        loading, release = threading.Event(), threading.Event()
+
+        def slow_loader(key):
+            loading.set()
+            release.wait(5)
+            return "old"
+
+        reader = threading.Thread(target=cache.get_or_load, args=("a", slow_loader))
+        reader.start()
+        loading.wait(5)
+        cache.invalidate("a")  # a write landed while the read was in flight
+        release.set()
+        reader.join()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get_or_load("a", lambda key: "new"), "new")
+
+    def test_zero_size_disables_caching(self):
+        cache = LRUCache(max_entries=0)
+        self.assertEqual(cache.get_or_load("a", lambda key: 1), 1)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+
+from utils.hashing import ConsistentHashing
+
+
+class TestConsistentHashingRing(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [("127.0.0.1", 5000 + i) for i in range(5)]
+        self.hashing = ConsistentHashing(self.nodes, vnodes=100)
+
+    def linear_lookup(self, key):
+        hash_key = self.hashing.hash(key)
+        for node_key in self.hashing.sorted_keys:
+            if hash_key <= node_key:
+                return self.hashing.ring[node_key]
+        return self.hashing.ring[self.hashing.sorted_keys[0]]
+
+    def test_bisect_lookup_matches_clockwise_walk(self):
+        for i in range(2000):
+            self.assertEqual(self.hashing.get_node(f"key{i}"), self.linear_lookup(f"key{i}"))
+
+    def test_vnode_count_and_weights(self):
+        self.assertEqual(len(self.hashing.sorted_keys), 500)
+        heavy = ("127.0.0.1", 6000)
+        self.hashing.add_node(heavy, weight=2.0)
+        self.assertEqual(sum(1 for owner in self.hashing.ring.values() if owner == heavy), 200)
+        shares = self.hashing.load_distribution()
+        self.assertGreater(shares[heavy], max(shares[node] for node in self.nodes))
+
+    def test_remove_node_keeps_ring_consistent(self):
+        removed = self.nodes[2]
+        before = {f"key{i}": self.hashing.get_node(f"key{i}") for i in range(2000)}
+        self.hashing.remove_node(removed)
+        self.assertNotIn(removed, self.hashing.ring.values())
+        self.assertEqual(self.hashing.sorted_keys, sorted(self.hashing.ring))
+        for key, owner in before.items():
+            if owner != removed:
+                # Only keys of the removed node move
+                self.assertEqual(self.hashing.get_node(key), owner)
+            self.assertEqual(self.hashing.get_node(key), self.linear_lookup(key))
+
+    def test_load_is_balanced_with_many_vnodes(self):
+        hashing = ConsistentHashing(self.nodes, vnodes=160)
+        counts = dict.fromkeys(self.nodes, 0)
+        for i in range(20000):
+            counts[hashing.get_node(f"key{i}")] += 1
+        self.assertLess(max(counts.values()) / (20000 / len(self.nodes)), 1.3)
+
+    def test_token_ranges_partition_the_ring_by_owner(self):
+        ranges = self.hashing.token_ranges()
+        spans = sorted((start, end, node) for node, owned in ranges.items() for start, end in owned)
+        self.assertEqual(spans[0][0], -1)
+        self.assertEqual(spans[-1][1], (1 << 64) - 1)
+        for previous, following in zip(spans, spans[1:]):
+            self.assertEqual(previous[1], following[0])
+        for i in range(500):
+            position = self.hashing.hash(f"key{i}")
+            owner = next(node for start, end, node in spans if start < position <= end)
+            self.assertEqual(owner, self.hashing.get_node(f"key{i}"))
+        down = self.nodes[0]
+        without = self.hashing.token_ranges(active_nodes=set(self.nodes[1:]))
+        self.assertNotIn(down, without)
+        self.assertEqual(sum(end - start for owned in without.values() for start, end in owned), 1 << 64)
+
+    def test_empty_ring(self):
+        self.assertIsNone(ConsistentHashing([]).get_node("key"))
+
+
+class TestPreferenceList(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [("127.0.0.1", 5000 + i) for i in range(6)]
+        self.hashing = ConsistentHashing(self.nodes, replicas=3, vnodes=50)
+
+    def clockwise_distinct(self, key):
+        start = self.hashing._position(key)
+        positions = len(self.hashing.sorted_keys)
+        walk = []
+        for step in range(positions):
+            owner = self.hashing.ring[self.hashing.sorted_keys[(start + step) % positions]]
+            if owner not in walk:
+                walk.append(owner)
+        return walk
+
+    def test_preference_list_is_distinct_clockwise_successors(self):
+        for i in range(500):
+            key = f"key{i}"
+            replicas = self.hashing.get_replicas(key)
+            self.assertEqual(len(set(replicas)), 3)
+            self.assertEqual(replicas[0], self.hashing.get_node(key))
+            self.assertEqual(replicas, self.clockwise_distinct(key)[:3])
+
+    def test_down_nodes_are_skipped(self):
+        key = "key42"
+        full = self.clockwise_distinct(key)
+        active = set(self.nodes) - {full[0], full[2]}
+        self.assertEqual(self.hashing.preference_list(key, active_nodes=active), [full[1], full[3], full[4]])
+
+    def test_falls_back_to_ring_walk_when_table_is_exhausted(self):
+        key = "key7"
+        full = self.clockwise_distinct(key)
+        active = {full[-1]}
+        self.assertEqual(self.hashing.preference_list(key, n=1, active_nodes=active), [full[-1]])
+
+    def test_table_rebuilt_after_membership_change(self):
+        self.hashing.preference_list("key1")
+        self.hashing.remove_node(self.nodes[0])
+        for i in range(200):
+            self.assertNotIn(self.nodes[0], self.hashing.preference_list(f"key{i}"))
+
+    def test_replication_load_is_spread(self):
+        counts = dict.fromkeys(self.nodes, 0)
+        hashing = ConsistentHashing(self.nodes, replicas=3)
+        for i in range(12000):
+            for node in hashing.get_replicas(f"key{i}"):
+                counts[node] += 1
+        self.assertLess(max(counts.values()) / (36000 / len(self.nodes)), 1.3)
+
+
+class TestTransferPlan(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [("127.0.0.1", 5000 + i) for i in range(4)]
+        self.hashing = ConsistentHashing(self.nodes, replicas=3, vnodes=50)
+        self.keys = [f"key{i}" for i in range(3000)]
+
+    @staticmethod
+    def in_ranges(position, ranges):
+        return any(start < position <= end for start, end in ranges)
+
+    def test_join_moves_only_the_ranges_the_new_node_gains(self):
+        joined = ("127.0.0.1", 6000)
+        after = self.hashing.copy()
+        after.add_node(joined)
+        plan = self.hashing.transfer_plan(after)
+        self.assertEqual({target for _, target in plan}, {joined})
+        moved = [key for key in self.keys
+                 if any(self.in_ranges(self.hashing.hash(key), ranges) for ranges in plan.values())]
+        self.assertEqual(moved, [key for key in self.keys if joined in after.preference_list(key)])
+        # Roughly N/(n+1) of the data, not the whole data set
+        self.assertLess(len(moved) / len(self.keys), 3 / 5 + 0.1)
+        for (source, _), ranges in plan.items():
+            for key in self.keys:
+                if self.in_ranges(self.hashing.hash(key), ranges):
+                    self.assertIn(source, self.hashing.preference_list(key))
+
+    def test_leave_streams_from_the_leaving_node(self):
+        leaving = self.nodes[0]
+        after = self.hashing.copy()
+        after.remove_node(leaving)
+        plan = self.hashing.transfer_plan(after)
+        self.assertEqual({source for source, _ in plan}, {leaving})
+        for key in self.keys:
+            gained = [node for node in after.preference_list(key) if node not in self.hashing.preference_list(key)]
+            holders = [target for (_, target), ranges in plan.items() if self.in_ranges(self.hashing.hash(key), ranges)]
+            self.assertEqual(holders, gained)
+
+    def test_ranges_responsible_and_keys(self):
+        node = self.nodes[1]
+        ranges = self.hashing.ranges_responsible(node)
+        responsible = self.hashing.get_keys_responsible(node, self.keys)
+        self.assertEqual(responsible, [key for key in self.keys if self.in_ranges(self.hashing.hash(key), ranges)])
+        self.assertAlmostEqual(len(responsible) / len(self.keys), 3 / 4, delta=0.1)
+
+    def test_unchanged_membership_moves_nothing(self):
+        self.assertEqual(self.hashing.transfer_plan(self.hashing.copy()), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
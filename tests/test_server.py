@@ -20,10 +20,71 @@
 #         self.assertEqual(response, "Error: Key 'key3' not found.")
 
 #MODIFIED
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from utils.data_structures import InMemoryStorage
 
-from server.server_upd import TransactionManager  # Import TransactionManager from your server code
+from client.client import Client
+from server.server import Server, TransactionManager  # Import TransactionManager from your server code
+from server.transactions import TransactionLog
+from server.async_server import AsyncConnectionPool, AsyncServer
+from server.health_monitor import HealthMonitor, MerkleTree, PhiAccrualDetector
+from server.hinted_handoff import HintedHandoff
+from server.quorum import QuorumSettings, parse_options
+from server.replication import ReplicationReceiver, ReplicationStream
+from server.versioning import HybridClock, newer, parse_version
+from utils.connection_pool import ConnectionPool
+from utils.protocol import FRAME_HEADER, ProtocolError, decode_fields, encode_frame, read_frame
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_extra_server(server_class=Server, **kwargs):
+    """Start another server in the test's scratch directory."""
+    server = server_class(port=free_port(), **kwargs)
+    threading.Thread(target=server.start_server, daemon=True).start()
+    wait_for_server(server)
+    return server
+
+
+def wait_for_server(server):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection((server.host, server.port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a real server on a free port inside a scratch working directory."""
+
+    server_class = Server
+    server_kwargs = {}
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.server = self.server_class(port=free_port(), **self.server_kwargs)
+        threading.Thread(target=self.server.start_server, daemon=True).start()
+        wait_for_server(self.server)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
 
 class TestInMemoryStorageWith2PC(unittest.TestCase):
     def setUp(self):
@@ -118,6 +179,1012 @@ class TestInMemoryStorageWith2PC(unittest.TestCase):
         self.assertEqual(self.storage.get("key9"), "new_value")
         self.assertEqual(self.storage.get("key10"), "value10")
 
+
+class TestSnapshotIsolation(unittest.TestCase):
+    def setUp(self):
+        self.storage = InMemoryStorage()
+        self.storage.put("balance", "100")
+        self.manager = TransactionManager()
+
+    def plain_write(self, key, value):
+        with self.manager.tracking_write([(key, value)], self.storage):
+            self.storage.put(key, value)
+
+    def test_reads_see_the_snapshot_of_their_start(self):
+        self.manager.begin("T1")
+        self.plain_write("balance", "50")
+        self.manager.begin("T2")
+        self.assertEqual(self.manager.read("T1", "balance", self.storage), "100")
+        self.assertEqual(self.manager.read("T2", "balance", self.storage), "50")
+        self.manager.write("T1", "balance", "75")
+        self.assertEqual(self.manager.read("T1", "balance", self.storage), "75")
+
+    def test_first_committer_wins(self):
+        self.manager.begin("T1")
+        self.manager.begin("T2")
+        self.manager.write("T1", "balance", "110")
+        self.manager.write("T2", "balance", "90")
+        self.assertTrue(self.manager.commit("T1", self.storage))
+        self.assertFalse(self.manager.commit("T2", self.storage))
+        self.assertEqual(self.manager.transactions["T2"]["state"], "ABORTED")
+        self.assertEqual(self.storage.get("balance"), "110")
+
+    def test_plain_write_after_start_aborts_commit(self):
+        self.manager.begin("T1")
+        self.manager.write("T1", "balance", "0")
+        self.plain_write("balance", "1")
+        self.assertFalse(self.manager.commit("T1", self.storage))
+
+    def test_disjoint_transactions_commit_in_parallel(self):
+        results = []
+
+        def run(i):
+            self.manager.prepare(f"T{i}", {f"k{i}": str(i)})
+            results.append(self.manager.commit(f"T{i}", self.storage))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(self.storage.get("k7"), "7")
+
+    def test_versions_are_collected_once_no_snapshot_needs_them(self):
+        self.manager.begin("T1")
+        self.plain_write("balance", "1")
+        self.plain_write("balance", "2")
+        self.assertEqual(len(self.manager._versions["balance"]), 3)
+        self.manager.rollback("T1")
+        self.assertEqual(self.manager._versions, {})
+        self.assertEqual(self.manager._last_write, {})
+
+        self.manager.retention = 0
+        self.manager.prepare("T2", {"balance": "3"})
+        self.manager.commit("T2", self.storage)
+        self.manager.collect_garbage(force=True)
+        self.assertNotIn("T2", self.manager.transactions)
+
+    def test_plain_writes_keep_no_versions_without_open_snapshots(self):
+        reads = []
+        get = self.storage.get
+        self.storage.get = lambda key: reads.append(key) or get(key)
+        self.plain_write("balance", "1")
+        self.assertEqual((reads, self.manager._versions, self.manager._last_write), ([], {}, {}))
+
+        # A snapshot opened during such a write starts after it
+        with self.manager.tracking_write([("balance", "2")], self.storage):
+            opener = threading.Thread(target=self.manager.begin, args=("T1",))
+            opener.start()
+            opener.join(timeout=0.1)
+            self.assertTrue(opener.is_alive())
+            self.storage.put("balance", "2")
+        opener.join(timeout=5)
+        self.plain_write("balance", "3")
+        self.assertEqual(self.manager.read("T1", "balance", self.storage), "2")
+
+    def test_storage_fallback_never_sees_a_write_newer_than_the_snapshot(self):
+        self.manager.begin("T1")
+        applied, finish = threading.Event(), threading.Event()
+
+        def writer():
+            with self.manager.tracking_write([("balance", "2")], self.storage):
+                self.storage.put("balance", "2")
+                applied.set()
+                finish.wait(5)
+
+        lookup = self.manager._snapshot_version
+
+        def racing_lookup(key, start_ts):
+            # A write lands between the chain lookup and the storage read
+            found = lookup(key, start_ts)
+            if not applied.is_set():
+                threading.Thread(target=writer).start()
+                applied.wait(5)
+                threading.Timer(0.1, finish.set).start()
+            return found
+
+        self.manager._snapshot_version = racing_lookup
+        self.assertEqual(self.manager.read("T1", "balance", self.storage), "100")
+
+    def test_prepared_keys_are_reserved_until_decided(self):
+        self.assertTrue(self.manager.prepare("T1", {"balance": "1"}))
+        self.assertFalse(self.manager.prepare("T2", {"balance": "2"}))
+        self.manager.begin("T3")
+        self.manager.write("T3", "balance", "3")
+        self.assertFalse(self.manager.commit("T3", self.storage))
+        self.assertTrue(self.manager.commit("T1", self.storage))
+        self.assertTrue(self.manager.prepare("T4", {"balance": "4"}))
+
+    def test_plain_writes_wait_for_a_prepared_transaction(self):
+        self.assertTrue(self.manager.prepare("T1", {"balance": "txn"}))
+        writer = threading.Thread(target=self.plain_write, args=("balance", "plain"))
+        writer.start()
+        writer.join(timeout=0.1)
+        self.assertTrue(writer.is_alive())  # held back until T1 is decided
+        self.assertTrue(self.manager.commit("T1", self.storage))
+        writer.join(timeout=5)
+        self.assertEqual(self.storage.get("balance"), "plain")  # the acknowledged PUT is not lost
+
+        self.manager.reservation_timeout = 0.05
+        self.manager.prepare("T2", {"balance": "undecided"})
+        with self.assertRaises(TimeoutError):
+            self.plain_write("balance", "rejected")
+        self.assertEqual(self.storage.get("balance"), "plain")
+        self.manager.rollback("T2")
+        self.plain_write("balance", "after")
+        self.assertEqual(self.storage.get("balance"), "after")
+
+    def test_prepared_votes_survive_a_restart(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        path = os.path.join(tmp_dir, "transactions.log")
+        manager = TransactionManager(log=TransactionLog(path))
+        manager.prepare("T1", {"a": "1"})
+        manager.prepare("T2", {"b": "2"})
+        manager.rollback("T2")
+        manager.log.close()
+
+        restarted = TransactionManager(log=TransactionLog(path))
+        self.assertEqual(restarted.recover(), ["T1"])
+        self.assertFalse(restarted.prepare("T3", {"a": "3"}))
+        self.assertTrue(restarted.commit("T1", self.storage))
+        self.assertEqual(self.storage.get("a"), "1")
+        restarted.log.close()
+        self.assertEqual(TransactionLog(path).pending, {})
+
+class TestBinaryProtocol(ServerTestCase):
+    def test_text_protocol_still_served(self):
+        client = Client(port=self.server.port)
+        self.assertEqual(client.put("key1", "value1"), "PUT key1=value1 OK")
+        self.assertEqual(client.get("key1"), "GET key1=value1")
+
+    def test_large_values_with_spaces(self):
+        client = Client(port=self.server.port, protocol="binary")
+        value = "hello world " * 1000
+        self.assertEqual(client.put("key 1", value), f"PUT key 1={value} OK")
+        self.assertEqual(client.get("key 1"), f"GET key 1={value}")
+        self.assertEqual(client.call("HEARTBEAT"), "ALIVE")
+        client.close()
+
+    def test_pipelined_requests_keep_request_ids(self):
+        client = Client(port=self.server.port, protocol="binary")
+        commands = [("PUT", f"key{i}", f"value {i}") for i in range(50)]
+        commands += [("GET", f"key{i}") for i in range(50)]
+        responses = client.pipeline(commands)
+        self.assertEqual(responses[0], "PUT key0=value 0 OK")
+        self.assertEqual(responses[99], "GET key49=value 49")
+        self.assertTrue(client.get("missing").startswith("Error"))
+        client.close()
+
+    def test_raw_frames_round_trip(self):
+        with socket.create_connection((self.server.host, self.server.port)) as sock:
+            sock.sendall(b"HELLO BINARY/1")
+            self.assertEqual(sock.recv(64), b"BINARY/1 OK")
+            sock.sendall(encode_frame(7, ["PUT", "k", "v"]) + encode_frame(8, ["GET", "k"]))
+            stream = sock.makefile("rb")
+            self.assertEqual(read_frame(stream), (7, 0, ["PUT k=v OK"]))
+            self.assertEqual(read_frame(stream), (8, 0, ["GET k=v"]))
+
+    def test_invalid_utf8_field_closes_the_connection(self):
+        with self.assertRaises(ProtocolError):
+            decode_fields(encode_frame(1, [b"\xff\xfe"])[FRAME_HEADER.size:])
+        with socket.create_connection((self.server.host, self.server.port)) as sock:
+            sock.sendall(b"HELLO BINARY/1")
+            self.assertEqual(sock.recv(64), b"BINARY/1 OK")
+            sock.sendall(encode_frame(7, ["GET", b"\xff\xfe"]))
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(64), b"")  # no text error written onto the framed connection
+
+
+class TestConnectionPool(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.peer = (self.server.host, self.server.port)
+        self.pool = ConnectionPool(max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super().tearDown()
+
+    def test_connections_are_reused(self):
+        for i in range(20):
+            self.assertEqual(self.pool.request(self.peer, "PUT", f"key{i}", "v"), f"PUT key{i}=v OK")
+        self.assertEqual(self.pool.request(self.peer, "GET", "key3"), "GET key3=v")
+        self.assertEqual(self.pool.connections_opened, 1)
+
+    def test_reconnects_when_pooled_connection_died(self):
+        self.pool.request(self.peer, "HEARTBEAT")
+        self.pool._idle[self.peer][0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.pool.request(self.peer, "HEARTBEAT"), "ALIVE")
+        self.assertEqual(self.pool.connections_opened, 2)
+
+    def test_timed_out_requests_are_not_retried(self):
+        self.pool.request(self.peer, "HEARTBEAT")
+        calls = []
+        dispatch = self.server.dispatch
+
+        def slow_dispatch(command_parts, addr=None):
+            calls.append(command_parts)
+            time.sleep(0.3)
+            return dispatch(command_parts, addr)
+
+        self.server.dispatch = slow_dispatch
+        with self.assertRaises(socket.timeout):
+            self.pool.request(self.peer, "PUT", "once", "v", timeout=0.1)
+        time.sleep(0.4)
+        self.assertEqual(calls, [["PUT", "once", "v"]])
+
+    def test_pool_size_is_bounded(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.pool.request(self.peer, "HEARTBEAT")))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["ALIVE"] * 10)
+        self.assertLessEqual(self.pool.connections_opened, 2)
+
+    def test_misbehaving_replica_is_excluded(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+
+        def garbled_peer():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(64)
+                conn.sendall(b"BINARY/1 OK")
+                conn.recv(1024)
+                conn.sendall(FRAME_HEADER.pack(2 ** 31, 1, 0))  # larger than any frame may be
+
+        threading.Thread(target=garbled_peer, daemon=True).start()
+        garbled = listener.getsockname()
+        self.assertEqual(self.server.validate_replicas([garbled, self.peer]), [self.peer])
+
+    def test_health_monitor_heartbeats_through_pool(self):
+        monitor = HealthMonitor([self.peer], connection_pool=self.pool)
+        self.assertTrue(monitor.send_heartbeat(self.peer))
+        self.assertTrue(monitor.send_heartbeat(self.peer))
+        self.assertFalse(monitor.send_heartbeat(("127.0.0.1", free_port())))
+        self.assertEqual(self.pool.connections_opened, 1)
+
+
+
+class TestFailureDetection(ServerTestCase):
+    def test_phi_grows_with_silence(self):
+        detector = PhiAccrualDetector(threshold=8.0, min_std=0.1)
+        for beat in range(10):
+            detector.heartbeat("node", now=float(beat))
+        self.assertLess(detector.phi("node", now=9.5), 1.0)
+        self.assertTrue(detector.is_available("node", now=10.2))
+        self.assertGreater(detector.phi("node", now=14.0), 8.0)
+        self.assertFalse(detector.is_available("node", now=14.0))
+
+    def test_gossip_spreads_membership_into_the_ring(self):
+        owner = (self.server.host, self.server.port)
+        newcomer = start_extra_server(replicas=[owner], gossip_interval=0)
+        newcomer.health_monitor.gossip_round()
+        joined = (newcomer.host, newcomer.port)
+        self.assertIn(joined, self.server.replicas)
+        self.assertIn(joined, self.server.consistent_hashing.nodes)
+        self.assertIn(joined, self.server.health_monitor.active_nodes)
+        stats = json.loads(Client(port=self.server.port).call("MEMBERSHIP"))
+        self.assertTrue(stats["nodes"][f"{newcomer.host}:{newcomer.port}"]["alive"])
+
+    def test_zero_interval_disables_detection(self):
+        peer, other = ("127.0.0.1", free_port()), ("127.0.0.1", free_port())
+        monitor = HealthMonitor([peer], heartbeat_interval=0)
+        monitor.detector._last[peer] -= 60
+        monitor.receive_gossip(json.dumps({f"{other[0]}:{other[1]}": [1.0, 1]}))
+        self.assertEqual(monitor.active_nodes, {peer, other})
+        self.assertTrue(all(node["alive"] for node in monitor.stats()["nodes"].values()))
+
+    def test_silent_node_is_declared_down(self):
+        dead = ("127.0.0.1", free_port())
+        changes = []
+        monitor = HealthMonitor([dead], heartbeat_interval=0.1, on_status=lambda node, alive: changes.append(alive))
+        monitor.detector._last[dead] -= 5
+        monitor.gossip_round()
+        self.assertNotIn(dead, monitor.active_nodes)
+        self.assertEqual(changes, [False])
+        self.assertEqual(monitor.stats()["detections"], 1)
+
+
+
+class TestHintedHandoff(ServerTestCase):
+    def test_writes_for_a_down_replica_are_hinted_and_replayed(self):
+        replica = (self.server.host, self.server.port)
+        node = start_extra_server(replicas=[replica], gossip_interval=0)
+        node.replica_status_changed(replica, False)
+        node.handle_put("k1", "v1")
+        node.handle_put("k1", "v2")
+        node.handle_put("k2", "x")
+        self.assertIsNone(self.server.storage["k1"])
+        self.assertEqual(node.hinted_handoff.stats()["hinted"], 3)
+
+        node.hand_off_hints(replica)
+        self.assertEqual((self.server.storage["k1"], self.server.storage["k2"]), ("v2", "x"))
+        self.assertEqual(node.hinted_handoff.stats()["diverted"], [])
+        self.assertEqual(os.listdir(node.hinted_handoff.hint_dir), [])
+        node.handle_put("k3", "y")
+        self.assertTrue(node.replication_streams[replica].flush(timeout=5))
+        self.assertEqual(self.server.storage["k3"], "y")
+
+    def test_hints_survive_restart_and_overflow_triggers_anti_entropy(self):
+        sent, overflowed = [], []
+        replica = ("127.0.0.1", 6001)
+        hints = HintedHandoff("hints", lambda peer, *fields: sent.append(json.loads(fields[1])) or "OK",
+                              max_bytes=30, batch_size=1)
+        hints.divert(replica)
+        for i in range(5):
+            hints.hint(replica, f"k{i}", "v")
+        self.assertEqual(hints.stats()["dropped"], 3)
+
+        restarted = HintedHandoff("hints", hints.send, batch_size=1, on_overflow=overflowed.append)
+        self.assertEqual(restarted.pending_nodes(), [replica])
+        self.assertTrue(restarted.replay(replica))
+        self.assertEqual(sent, [[["k0", "v"]], [["k1", "v"]]])
+        self.assertEqual(overflowed, [replica])
+        self.assertFalse(restarted.is_diverted(replica))
+
+
+class TestRebalancing(ServerTestCase):
+    server_kwargs = {"replication_factor": 1, "gossip_interval": 0, "anti_entropy_interval": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.second = start_extra_server(replicas=[(self.server.host, self.server.port)], **self.server_kwargs)
+        self.server.add_peer((self.second.host, self.second.port))
+        self.nodes = {(node.host, node.port): node for node in (self.server, self.second)}
+        self.keys = [f"key{i:03d}" for i in range(300)]
+        for key in self.keys:
+            owner = self.server.consistent_hashing.preference_list(key)[0]
+            self.nodes[owner].handle_put(key, f"value {key}", is_replication=True)
+
+    def test_join_streams_only_the_gained_ranges(self):
+        joined = start_extra_server(**self.server_kwargs)
+        me = (joined.host, joined.port)
+        streamed = joined.join((self.server.host, self.server.port))
+        gained = [key for key in self.keys if joined.consistent_hashing.preference_list(key) == [me]]
+        self.assertTrue(0 < len(gained) < len(self.keys))
+        self.assertEqual(streamed, len(gained))
+        self.assertEqual(sorted(joined.storage.keys()), gained)
+        for node in self.nodes.values():
+            self.assertIn(me, node.consistent_hashing.nodes)
+        # The new owner receives later writes to its ranges
+        Client(port=self.server.port).put(gained[0], "after")
+        self.server.replication_streams[me].flush()
+        self.assertEqual(joined.storage[gained[0]], "after")
+
+    def test_live_writes_are_not_overwritten_by_the_transfer(self):
+        joined = start_extra_server(**self.server_kwargs)
+        original = joined.rebalancer.send
+        written = []
+
+        def send_then_write(peer, command, *args):
+            response = original(peer, command, *args)
+            if command == "TOKEN_SCAN" and not written:
+                key = json.loads(response)["items"][0][0]
+                written.append(key)
+                joined.apply_replicated_batch([(key, "live")])
+            return response
+
+        joined.rebalancer.send = send_then_write
+        joined.join((self.server.host, self.server.port))
+        self.assertEqual(joined.storage[written[0]], "live")
+        self.assertGreaterEqual(joined.rebalancer.stats()["skipped"], 1)
+
+    def test_leave_hands_ranges_to_the_remaining_nodes(self):
+        leaving = (self.second.host, self.second.port)
+        self.assertTrue(self.second.leave())
+        self.assertEqual(self.server.consistent_hashing.nodes, [(self.server.host, self.server.port)])
+        self.assertNotIn(leaving, self.server.replication_streams)
+        for key in self.keys:
+            self.assertEqual(self.server.storage[key], f"value {key}")
+        # Gossip about the departed node does not bring it back
+        self.server.health_monitor.merge({f"{leaving[0]}:{leaving[1]}": [0, 5]})
+        self.assertNotIn(leaving, self.server.replicas)
+
+    def test_leave_waits_for_a_throttled_hand_over(self):
+        # Pulling the leaving node's keys in pages of 5 at 200 keys/s outlasts the default request timeout
+        for node in self.nodes.values():
+            node.rebalancer.chunk_size, node.rebalancer.rate = 5, 200
+        self.second.connection_pool.request_timeout = 0.2
+        self.assertTrue(self.second.leave())
+        for key in self.keys:
+            self.assertEqual(self.server.storage[key], f"value {key}")
+
+
+class TestAsyncServer(TestBinaryProtocol):
+    server_class = AsyncServer
+
+    def test_replication_reuses_pooled_streams(self):
+        replica = start_extra_server()
+        peer = (replica.host, replica.port)
+        primary = start_extra_server(server_class=AsyncServer, replicas=[peer])
+        for i in range(5):
+            primary.handle_put(f"key{i}", f"value{i}")
+        self.assertTrue(primary.replication_streams[peer].flush(timeout=5))
+        self.assertEqual(replica.storage["key4"], "value4")
+        self.assertEqual(len(primary.replica_pool._idle[peer]), 1)
+
+    def test_peer_traffic_before_the_loop_runs_waits_for_it(self):
+        node = AsyncServer(port=free_port())
+        peer = (self.server.host, self.server.port)
+        results = []
+        sender = threading.Thread(target=lambda: results.append(node.send_to_peer(peer, "HEARTBEAT")))
+        sender.start()
+        threading.Thread(target=node.start_server, daemon=True).start()
+        sender.join(timeout=5)
+        self.assertEqual(results, ["ALIVE"])
+
+    def test_pooled_requests_time_out_and_drop_the_stream(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+
+        def silent_peer():
+            conn, _ = listener.accept()
+            conn.recv(64)
+            conn.sendall(b"BINARY/1 OK")
+            self.addCleanup(conn.close)
+
+        threading.Thread(target=silent_peer, daemon=True).start()
+        pool = AsyncConnectionPool(request_timeout=0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(pool.request(listener.getsockname(), "HEARTBEAT"))
+        self.assertEqual(pool._idle[listener.getsockname()], [])
+
+
+class TestReplicationStream(unittest.TestCase):
+    def test_batches_coalesce_and_ship_in_order(self):
+        sent = []
+        receiver = ReplicationReceiver(lambda batch: sent.append(batch))
+        stream = ReplicationStream(
+            ("127.0.0.1", 1), lambda peer, *fields: receiver.receive(*fields[1:]),
+            source="127.0.0.1:0", max_delay_ms=50,
+        )
+        for i in range(100):
+            stream.enqueue("hot", i)
+        stream.enqueue("cold", "x")
+        self.assertEqual(stream.lag()["ops"], 2)
+        self.assertTrue(stream.flush(timeout=5))
+        self.assertEqual(sent, [[["hot", 99], ["cold", "x"]]])
+        self.assertEqual(stream.lag(), {"ops": 0, "bytes": 0, "sent_seq": 1, "acked_seq": 1, "coalesced": 99})
+        stream.close()
+
+    def test_failed_batches_are_retried_with_same_sequence(self):
+        attempts = []
+        applied = []
+        receiver = ReplicationReceiver(applied.extend)
+
+        def flaky_send(peer, command, source, epoch, seq, payload):
+            attempts.append(seq)
+            if len(attempts) == 1:
+                raise ConnectionError("replica down")
+            return receiver.receive(source, epoch, seq, payload)
+
+        stream = ReplicationStream(("127.0.0.1", 1), flaky_send, source="a", max_batch_ops=1, retry_interval=0.01)
+        stream.enqueue("key1", "value1")
+        stream.enqueue("key2", "value2")
+        self.assertTrue(stream.flush(timeout=5))
+        self.assertEqual(attempts[:2], [1, 1])
+        self.assertEqual(applied, [["key1", "value1"], ["key2", "value2"]])
+        stream.close()
+
+    def test_closing_during_retries_acknowledges_nothing(self):
+        acks = []
+        stream = ReplicationStream(("127.0.0.1", 1), lambda *args: "Error: replica busy", source="a",
+                                   max_batch_ops=1, retry_interval=0.01)
+        stream.enqueue("key1", "value1", on_ack=acks.append, urgent=True)
+        self.assertFalse(stream.flush(timeout=0.1))
+        stream.close()
+        stream._thread.join(timeout=5)
+        self.assertFalse(stream._thread.is_alive())
+        self.assertEqual((acks, stream.lag()["acked_seq"]), ([], 0))
+
+    def test_receiver_drops_duplicates_and_rejects_gaps(self):
+        applied = []
+        receiver = ReplicationReceiver(applied.extend)
+        self.assertEqual(receiver.receive("a", "e1", "1", '[["k", "v1"]]'), "ACK 1")
+        self.assertEqual(receiver.receive("a", "e1", "1", '[["k", "v1"]]'), "ACK 1")
+        self.assertTrue(receiver.receive("a", "e1", "3", '[["k", "v3"]]').startswith("Error"))
+        # A restarted sender starts a new epoch at sequence 1
+        self.assertEqual(receiver.receive("a", "e2", "1", '[["k", "v4"]]'), "ACK 1")
+        self.assertEqual(applied, [["k", "v1"], ["k", "v4"]])
+
+
+class TestServerReplication(ServerTestCase):
+    def test_client_puts_replicate_and_report_lag(self):
+        replica = self.server
+        peer = (replica.host, replica.port)
+        primary = start_extra_server(replicas=[peer])
+        client = Client(port=primary.port)
+        for i in range(20):
+            client.put("hot", f"value{i}")
+        self.assertTrue(primary.replication_streams[peer].flush(timeout=5))
+        self.assertEqual(replica.storage["hot"], "value19")
+        status = json.loads(client.send_request("REPLICATION_STATUS"))
+        self.assertEqual(status[f"{replica.host}:{replica.port}"]["ops"], 0)
+        # The replica applied the batch without forwarding it again
+        self.assertEqual(replica.replication_status(), {})
+
+
+class TestBatchOperations(ServerTestCase):
+    def test_mput_and_mget_fan_out_to_owners(self):
+        owner = (self.server.host, self.server.port)
+        coordinator = start_extra_server(replicas=[owner])
+        client = Client(port=coordinator.port)
+        items = {f"key{i}": f"value {i}" for i in range(100)}
+        self.assertEqual(client.mput(items, batch_size=40), "MPUT 100 OK")
+        self.assertTrue(coordinator.replication_streams[owner].flush(timeout=5))
+        self.assertEqual(self.server.storage.load_data(), items)
+        owned_here = [key for key in items if coordinator.preference_list(key, 1)[0] == owner]
+        self.assertTrue(0 < len(owned_here) < 100)
+        self.assertNotIn(owned_here[0], coordinator.storage)
+
+        values = client.mget(list(items) + ["missing"])
+        self.assertEqual(values, dict(items, missing=None))
+        self.assertEqual(client.send_request("MGET key1 key2"), json.dumps({"key1": "value 1", "key2": "value 2"}))
+        self.assertTrue(client.send_request("MPUT key1").startswith("Error: MPUT command"))
+
+    def test_unreachable_owner_falls_back_to_local_write(self):
+        coordinator = start_extra_server(replicas=[("127.0.0.1", free_port())])
+        client = Client(port=coordinator.port)
+        items = {f"key{i}": str(i) for i in range(20)}
+        self.assertEqual(client.mput(items), "MPUT 20 OK")
+        self.assertEqual(coordinator.storage.load_data(), items)
+        self.assertEqual(client.mget(items), items)
+
+
+class TestReadCache(ServerTestCase):
+    def test_hot_reads_hit_cache_and_writes_invalidate(self):
+        client = Client(port=self.server.port)
+        client.put("hot", "v1")
+        for _ in range(5):
+            self.assertEqual(client.get("hot"), "GET hot=v1")
+        stats = json.loads(client.send_request("CACHE_STATS"))
+        self.assertEqual((stats["hits"], stats["misses"]), (4, 1))
+
+        client.put("hot", "v2")
+        self.assertEqual(client.get("hot"), "GET hot=v2")
+        self.server.apply_replicated_batch([("hot", "v3", self.server.clock.now())])
+        self.assertEqual(client.get("hot"), "GET hot=v3")
+        self.server.transaction_manager.prepare("tx1", {"hot": "v4"})
+        self.server.transaction_manager.commit("tx1", self.server.storage)
+        self.assertEqual(client.get("hot"), "GET hot=v4")
+
+    def test_client_cache_holds_reads_for_the_lease(self):
+        client = Client(port=self.server.port, cache_lease=60)
+        client.put("key1", "v1")
+        self.assertEqual(client.get("key1"), "GET key1=v1")
+        self.server.apply_replicated_batch([("key1", "remote", self.server.clock.now())])
+        self.assertEqual(client.get("key1"), "GET key1=v1")  # still within the lease
+        client.put("key1", "v2")
+        self.assertEqual(client.get("key1"), "GET key1=v2")
+
+
+class TestServerTransactions(ServerTestCase):
+    def test_transaction_commands(self):
+        client = Client(port=self.server.port)
+        client.put("stock", "5")
+        self.assertEqual(client.send_request("TRANSACTION T1 BEGIN"), "TRANSACTION T1 BEGIN OK")
+        client.put("stock", "4")
+        self.assertEqual(client.send_request("TRANSACTION T1 GET stock"), "GET stock=5")
+        client.send_request("TRANSACTION T1 PUT stock 6")
+        self.assertEqual(client.send_request("TRANSACTION T1 COMMIT"),
+                         "Error: Transaction T1 aborted by a conflicting write.")
+
+        self.assertEqual(client.send_request("TRANSACTION T2 PREPARE stock 7 other 1"), "TRANSACTION T2 PREPARED")
+        self.assertEqual(client.send_request("TRANSACTION T2 COMMIT"), "TRANSACTION T2 COMMITTED")
+        self.assertEqual(client.get("stock"), "GET stock=7")
+        self.assertEqual(self.server.storage["other"], "1")
+
+
+class TestDistributedTransactions(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = (self.server.host, self.server.port)
+        self.coordinator = start_extra_server(replicas=[self.owner])
+        self.client = Client(port=self.coordinator.port)
+        self.items = {f"key{i}": f"value {i}" for i in range(20)}
+        self.remote = [key for key in self.items if self.coordinator.preference_list(key, 1)[0] == self.owner]
+        self.assertTrue(0 < len(self.remote) < 20)
+
+    def test_execute_commits_on_every_owner(self):
+        response = self.client.transact(self.items, "T1")
+        self.assertEqual(response, f"TRANSACTION {self.coordinator.host}:{self.coordinator.port}/T1 COMMITTED")
+        for key, value in self.items.items():
+            node = self.server if key in self.remote else self.coordinator
+            self.assertEqual(node.storage[key], value)
+        self.assertEqual(self.coordinator.coordinator.log.pending, {})
+
+    def test_refused_prepare_aborts_everywhere(self):
+        blocker = self.remote[0]
+        self.assertTrue(self.server.transaction_manager.prepare("other", {blocker: "x"}))
+        response = self.client.transact(self.items, "T2")
+        self.assertTrue(response.startswith("Error: Transaction"), response)
+        self.assertEqual(len(self.coordinator.storage), 0)
+        self.assertIsNone(self.server.storage[self.remote[-1]])
+        tid = self.coordinator.coordinator.global_id("T2")
+        self.assertEqual(self.client.call("TRANSACTION", tid, "STATUS"), "ABORTED")
+
+    def test_abort_rolls_back_a_participant_whose_vote_was_lost(self):
+        blocker = next(key for key in self.items if key not in self.remote)
+        self.assertTrue(self.coordinator.transaction_manager.prepare("other", {blocker: "x"}))
+        send = self.coordinator.coordinator.send
+
+        def lossy_send(peer, *fields):
+            response = send(peer, *fields)
+            return "Error: timed out" if fields[2] == "PREPARE" else response
+
+        self.coordinator.coordinator.send = lossy_send
+        response = self.client.transact(self.items, "T4")
+        self.assertTrue(response.startswith("Error: Transaction"), response)
+        tid = self.coordinator.coordinator.global_id("T4")
+        self.assertNotIn(tid, self.server.transaction_manager.transactions)
+        self.assertTrue(self.server.transaction_manager.prepare("next", {self.remote[0]: "y"}))
+
+    def test_in_doubt_participant_asks_the_coordinator(self):
+        tid = self.coordinator.coordinator.global_id("T3")
+        self.server.dispatch(["TRANSACTION", tid, "PREPARE", self.remote[0], "decided"])
+        self.coordinator.coordinator.log.append(tid, decision="COMMIT", participants=[list(self.owner)])
+        self.server.resolve_in_doubt([tid])
+        self.assertEqual(self.server.storage[self.remote[0]], "decided")
+        self.assertEqual(self.server.transaction_manager.log.pending, {})
+
+
+class TestScans(ServerTestCase):
+    server_kwargs = {"secondary_indexes": ["status"]}
+
+    def test_scan_prefix_and_query_commands(self):
+        client = Client(port=self.server.port)
+        client.mput({f"job:{i}": json.dumps({"status": "done" if i % 2 else "open"}) for i in range(6)})
+        page = json.loads(client.send_request("SCAN job:0 job:9 2"))
+        self.assertEqual([key for key, _ in page["items"]], ["job:0", "job:1"])
+        page = json.loads(client.send_request(f"SCAN job:0 job:9 10 {page['cursor']}"))
+        self.assertEqual([key for key, _ in page["items"]], ["job:2", "job:3", "job:4", "job:5"])
+        self.assertIsNone(page["cursor"])
+        self.assertEqual(len(json.loads(client.send_request("PREFIX job: 100"))["items"]), 6)
+        done = json.loads(client.send_request("QUERY status done 10"))
+        self.assertEqual([key for key, _ in done["items"]], ["job:1", "job:3", "job:5"])
+        self.assertEqual(client.send_request("QUERY owner bob 10"), "Error: No secondary index on 'owner'.")
+        self.assertTrue(client.send_request("SCAN a b").startswith("Error: SCAN command"))
+
+
+class TestClusterScan(ServerTestCase):
+    def test_scan_merges_every_nodes_ranges_in_key_order(self):
+        second = start_extra_server()
+        peers = [(self.server.host, self.server.port), (second.host, second.port)]
+        coordinator = start_extra_server(replicas=peers, anti_entropy_interval=0)
+        nodes = {(node.host, node.port): node for node in (self.server, second, coordinator)}
+        expected = {}
+        for i in range(120):
+            key, value = f"key{i:03d}", f"value {i}"
+            expected[key] = value
+            owner = coordinator.preference_list(key, 1)[0]
+            nodes[owner].storage[key] = value
+            if i % 3 == 0:
+                coordinator.storage[key] = value  # replica copies must not show up twice
+        client = Client(port=coordinator.port)
+        items, token = client.cluster_scan_page(limit=50)
+        self.assertEqual(len(items), 50)
+        self.assertEqual(items, sorted(items))
+        rest = list(client.scan_cluster(page_size=7, token=token))
+        self.assertEqual(dict(items + rest), expected)
+        self.assertEqual([key for key, _ in items + rest], sorted(expected))
+        self.assertTrue(client.call("CLUSTER_SCAN", "10", "bogus").startswith("Error"))
+
+
+class TestQuorumSettings(unittest.TestCase):
+    def test_request_options_override_cluster_defaults(self):
+        quorum = QuorumSettings(n=3, r=1, w=1)
+        self.assertEqual(quorum.resolve({}), (3, 1, 1))
+        self.assertEqual(quorum.resolve(parse_options(["W=3", "replication=true"])), (3, 1, 3))
+        self.assertEqual(quorum.resolve({"CONSISTENCY": "quorum"}), (3, 2, 2))
+        self.assertEqual(quorum.resolve({"CONSISTENCY": "all", "R": "1"}), (3, 1, 3))
+        with self.assertRaises(ValueError):
+            quorum.resolve({"W": "4"})
+
+
+class TestQuorumReadsAndWrites(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.second = start_extra_server()
+        self.peers = [(self.server.host, self.server.port), (self.second.host, self.second.port)]
+
+    def test_write_all_is_visible_on_every_replica_when_acknowledged(self):
+        primary = start_extra_server(replicas=self.peers, replication_batch_delay=1000)
+        client = Client(port=primary.port)
+        self.assertEqual(client.send_request("PUT key1 value1 W=3"), "PUT key1=value1 OK")
+        self.assertEqual(self.server.storage["key1"], "value1")
+        self.assertEqual(self.second.storage["key1"], "value1")
+
+    def test_quorum_read_prefers_majority_value(self):
+        primary = start_extra_server(replicas=self.peers)
+        client = Client(port=primary.port)
+        client.send_request("PUT key1 value1 CONSISTENCY=all")
+        primary.storage["key1"] = "stale"
+        self.assertEqual(client.send_request("GET key1"), "GET key1=stale")
+        self.assertEqual(client.send_request("GET key1 R=3"), "GET key1=value1")
+        self.assertEqual(client.send_request("GET missing CONSISTENCY=quorum"), "Error: Key 'missing' not found.")
+
+    def test_write_quorum_fails_with_a_replica_down(self):
+        down = ("127.0.0.1", free_port())
+        primary = start_extra_server(replicas=[self.peers[0], down], quorum_timeout=0.3)
+        client = Client(port=primary.port)
+        self.assertEqual(client.send_request("PUT key1 value1 W=2"), "PUT key1=value1 OK")
+        self.assertTrue(client.send_request("PUT key2 value2 W=3").startswith("Error: Write quorum not reached"))
+        self.assertEqual(client.send_request("GET key1 R=2"), "GET key1=value1")
+
+    def test_quorum_read_answers_without_waiting_for_the_slowest_replica(self):
+        primary = start_extra_server(replicas=self.peers)
+        client = Client(port=primary.port)
+        client.send_request("PUT key1 value1 CONSISTENCY=all")
+        dispatch = self.second.dispatch
+
+        def slow_dispatch(command_parts, addr=None):
+            if command_parts[0] == "VERSIONED_GET":
+                time.sleep(1.5)
+            return dispatch(command_parts, addr)
+
+        self.second.dispatch = slow_dispatch
+        started = time.monotonic()
+        self.assertEqual(client.send_request("GET key1 R=2"), "GET key1=value1")
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def stray_key(self, coordinator):
+        """A key whose N=2 preference list leaves out ``coordinator``."""
+        me = (coordinator.host, coordinator.port)
+        return next(f"key{i}" for i in range(1000) if me not in coordinator.preference_list(f"key{i}", 2))
+
+    def test_a_stray_local_copy_fills_no_read_quorum_slot(self):
+        primary = start_extra_server(replicas=self.peers, replication_factor=2)
+        client = Client(port=primary.port)
+        key = self.stray_key(primary)
+        self.assertEqual(client.send_request(f"PUT {key} value W=2"), f"PUT {key}=value OK")
+        self.assertEqual((self.server.storage[key], self.second.storage[key]), ("value", "value"))
+        primary.storage[key] = "stray"
+        primary.versions.put(key, "9999999999999:0:127.0.0.1:1")
+        self.assertEqual(client.send_request(f"GET {key} R=2"), f"GET {key}=value")
+
+    def test_a_node_outside_the_preference_list_reads_from_the_replicas(self):
+        primary = start_extra_server(replicas=self.peers, replication_factor=2)
+        client = Client(port=primary.port)
+        key = self.stray_key(primary)
+        self.assertEqual(client.send_request(f"PUT {key} value W=2"), f"PUT {key}=value OK")
+        del primary.storage[key]  # as if the write had come in through another node
+        primary.read_cache.invalidate(key)
+        self.assertEqual(client.send_request(f"GET {key}"), f"GET {key}=value")
+        self.assertEqual(client.send_request("GET missing"), "Error: Key 'missing' not found.")
+
+    def test_a_stray_local_write_is_no_ack(self):
+        down = ("127.0.0.1", free_port())
+        primary = start_extra_server(replicas=[self.peers[0], down], replication_factor=2, quorum_timeout=0.3)
+        client = Client(port=primary.port)
+        key = self.stray_key(primary)
+        self.assertTrue(client.send_request(f"PUT {key} value W=2").startswith("Error: Write quorum not reached"))
+        self.assertEqual(client.send_request(f"PUT {key} value W=1"), f"PUT {key}=value OK")
+        self.assertEqual(self.server.storage[key], "value")
+
+class TestVersions(unittest.TestCase):
+    def test_hybrid_clock_is_monotonic_and_follows_observed_versions(self):
+        clock = HybridClock("a:1", wall_clock=lambda: 1.0)
+        first, second = clock.now(), clock.now()
+        self.assertEqual((first, second), ("1000:0:a:1", "1000:1:a:1"))
+        clock.observe("5000:3:b:2")  # a node whose clock runs ahead
+        self.assertEqual(clock.now(), "5000:4:a:1")
+        self.assertTrue(newer("1000:1:a:1", "1000:0:b:2"))
+        self.assertTrue(newer("1000:0:b:2", "1000:0:a:1"))
+        self.assertTrue(newer("1:0:a:1", None))
+        self.assertEqual(parse_version(None), (0, 0, ""))
+
+
+class TestVersionedReplication(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.second = start_extra_server()
+        self.peers = [(self.server.host, self.server.port), (self.second.host, self.second.port)]
+        self.primary = start_extra_server(replicas=self.peers, anti_entropy_interval=0)
+
+    def test_older_versions_never_overwrite_newer_ones(self):
+        self.server.apply_replicated_batch([["k", "new", "2000:0:b:2"]])
+        self.server.apply_replicated_batch([["k", "old", "1000:5:a:1"]])
+        self.assertEqual(self.server.storage["k"], "new")
+        self.assertEqual(self.server.versions.get("k"), "2000:0:b:2")
+        # Local writes are stamped after every version the node has seen
+        self.server.handle_put("k", "local")
+        self.assertTrue(newer(self.server.versions.get("k"), "2000:0:b:2"))
+
+    def test_unversioned_writes_never_overwrite_versioned_ones(self):
+        self.server.apply_replicated_batch([["k", "new", "2000:0:b:2"]])
+        # Anti-entropy pushes, rebalance streaming and old hints carry no version
+        self.server.apply_replicated_batch([["k", "stale"], ["bare", "filled"]])
+        self.server.handle_put("k", "stale", is_replication=True)
+        self.assertEqual((self.server.storage["k"], self.server.versions.get("k")), ("new", "2000:0:b:2"))
+        self.assertEqual(self.server.storage["bare"], "filled")
+        self.assertIsNone(self.server.versions.get("bare"))
+        self.server.apply_replicated_batch([["bare", "replaced"]])
+        self.assertEqual(self.server.storage["bare"], "replaced")
+
+    def test_quorum_read_returns_newest_version_and_repairs_stale_replicas(self):
+        client = Client(port=self.primary.port)
+        client.send_request("PUT key1 value1 CONSISTENCY=all")
+        version = self.primary.versions.get("key1")
+        self.assertEqual(self.server.versions.get("key1"), version)
+        # One replica missed the write, the other has an older version
+        self.server.storage["key1"] = "old"
+        self.server.versions.put("key1", "1:0:127.0.0.1:1")
+        del self.second.storage["key1"]
+        self.second.versions.delete("key1")
+        self.assertEqual(client.send_request("GET key1 R=3"), "GET key1=value1")
+        deadline = time.time() + 5
+        while self.primary.read_repairs < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.primary.read_repairs, 2)
+        for node in (self.server, self.second):
+            self.assertEqual((node.storage["key1"], node.versions.get("key1")), ("value1", version))
+
+
+class TestMerkleTree(unittest.TestCase):
+    def test_overwrite_replaces_leaf_entry(self):
+        tree = MerkleTree(depth=4)
+        tree.update("key1", "value1")
+        tree.update("key1", "value2")
+        self.assertEqual(sum(len(bucket) for bucket in tree.buckets), 1)
+        self.assertTrue(tree.verify_data("key1", "value2"))
+        self.assertFalse(tree.verify_data("key1", "value1"))
+
+        fresh = MerkleTree(depth=4)
+        fresh.update("key1", "value2")
+        self.assertEqual(tree.root_hash, fresh.root_hash)
+
+    def test_root_is_independent_of_write_order(self):
+        first, second = MerkleTree(), MerkleTree()
+        for i in range(200):
+            first.update(f"key{i}", i)
+        for i in reversed(range(200)):
+            second.update(f"key{i}", i)
+        self.assertEqual(first.build_tree(), second.build_tree())
+        second.update("key7", "changed")
+        self.assertNotEqual(first.root_hash, second.root_hash)
+
+    def test_update_rehashes_only_one_path(self):
+        tree = MerkleTree(depth=6)
+        before = list(tree.nodes)
+        tree.update("key1", "value1")
+        changed = [i for i, (old, new) in enumerate(zip(before, tree.nodes)) if old != new]
+        self.assertEqual(len(changed), tree.depth + 1)
+
+    def test_remove_restores_previous_root(self):
+        tree = MerkleTree()
+        tree.update("key1", "value1")
+        root = tree.root_hash
+        tree.update("key2", "value2")
+        tree.remove("key2")
+        self.assertEqual(tree.root_hash, root)
+
+
+class TestMerkleTreeFollowsStorage(ServerTestCase):
+    def test_racing_writes_to_a_key_leave_the_tree_matching_storage(self):
+        def writer(n):
+            for i in range(200):
+                self.server.handle_put("contended", f"w{n}-{i}")
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(self.server.merkle_tree.verify_data("contended", self.server.storage["contended"]))
+
+    def test_deletes_leave_the_tree(self):
+        root = self.server.merkle_tree.root_hash
+        self.server.storage["gone"] = "soon"
+        del self.server.storage["gone"]
+        self.assertEqual(self.server.merkle_tree.root_hash, root)
+
+
+class TestAntiEntropy(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.peer = (self.server.host, self.server.port)
+        self.node = start_extra_server(replicas=[self.peer])
+        self.server.add_peer((self.node.host, self.node.port))
+        for i in range(300):
+            for server in (self.server, self.node):
+                server.handle_put(f"key{i}", f"value{i}", is_replication=True)
+
+    def test_in_sync_trees_need_one_round_trip(self):
+        self.assertEqual(Client(port=self.server.port).send_request(f"CHECK_HASH {self.node.merkle_tree.root_hash}"), "MATCH")
+        stats = self.node.resync_with_node(self.peer)
+        self.assertEqual((stats["rounds"], stats["buckets"]), (1, 0))
+
+    def test_only_divergent_ranges_are_transferred(self):
+        self.server.handle_put("only-remote", "r", is_replication=True)
+        self.node.handle_put("only-local", "l", is_replication=True)
+        self.server.handle_put("key5", "remote-version", is_replication=True)
+        fetched = []
+        original = self.node.anti_entropy.send
+
+        def recording_send(peer, command, *args):
+            if command == "RANGE_FETCH":
+                fetched.extend(args[0].split(","))
+            return original(peer, command, *args)
+
+        self.node.anti_entropy.send = recording_send
+        stats = self.node.resync_with_node(self.peer)
+        self.assertLessEqual(len(fetched), 3)
+        self.assertEqual((stats["pulled"], stats["pushed"], stats["conflicts"]), (1, 2, 1))
+        self.assertEqual(self.node.storage["only-remote"], "r")
+        self.assertEqual(self.server.storage["only-local"], "l")
+        # Two unversioned copies are settled by value, the same way from either side
+        self.assertEqual(self.server.storage["key5"], "value5")
+        self.assertEqual(self.node.merkle_tree.root_hash, self.server.merkle_tree.root_hash)
+
+    def test_conflicts_are_settled_by_version_in_both_directions(self):
+        self.server.write_batch([("key1", "stale", self.server.clock.now())])
+        self.node.clock.observe(self.server.versions.get("key1"))
+        self.node.write_batch([("key1", "fresh", self.node.clock.now())])
+        self.node.write_batch([("key2", "stale", self.node.clock.now())])
+        self.server.clock.observe(self.node.versions.get("key2"))
+        self.server.write_batch([("key2", "fresh", self.server.clock.now())])
+        # Even while recovering, a newer local copy is kept and sent to the peer
+        stats = self.node.resync_with_node(self.peer, prefer_remote=True)
+        self.assertEqual((stats["pulled"], stats["pushed"], stats["conflicts"]), (1, 1, 2))
+        for server in (self.server, self.node):
+            self.assertEqual((server.storage["key1"], server.storage["key2"]), ("fresh", "fresh"))
+        self.assertEqual(self.node.merkle_tree.root_hash, self.server.merkle_tree.root_hash)
+
+    def test_synced_values_keep_their_versions(self):
+        older = self.node.clock.now()
+        self.server.clock.observe(older)
+        self.node.write_batch([("key7", "old", older)])
+        self.server.write_batch([("key7", "new", self.server.clock.now())])
+        stats = self.node.resync_with_node(self.peer, prefer_remote=True)
+        self.assertEqual(stats["pulled"], 1)
+        self.assertEqual(self.node.storage["key7"], "new")
+        self.assertEqual(self.node.versions.get("key7"), self.server.versions.get("key7"))
+        self.assertEqual(self.node.merkle_tree.root_hash, self.server.merkle_tree.root_hash)
+
+
+
+class TestAntiEntropyOverSharedRanges(ServerTestCase):
+    server_kwargs = {"replication_factor": 2}
+
+    def setUp(self):
+        super().setUp()
+        first = (self.server.host, self.server.port)
+        self.second = start_extra_server(replicas=[first], replication_factor=2)
+        self.third = start_extra_server(replicas=[first, (self.second.host, self.second.port)], replication_factor=2)
+        self.nodes = [self.server, self.second, self.third]
+        for server in self.nodes:
+            for other in self.nodes:
+                server.add_peer((other.host, other.port))
+        # Every key is stored on its two preferred nodes only
+        for i in range(300):
+            key = f"key{i}"
+            for node in self.server.consistent_hashing.preference_list(key):
+                owner = next(server for server in self.nodes if (server.host, server.port) == node)
+                owner.write_batch([(key, f"value{i}", None)])
+
+    def test_nodes_in_sync_on_their_shared_ranges_find_no_divergence(self):
+        self.assertNotEqual(self.second.merkle_tree.root_hash, self.server.merkle_tree.root_hash)
+        stats = self.second.resync_with_node((self.server.host, self.server.port))
+        self.assertEqual((stats["rounds"], stats["buckets"]), (1, 0))
+
+    def test_a_write_to_a_shared_key_shows_up_as_divergence(self):
+        key = next(f"key{i}" for i in range(300)
+                   if self.server.holds_replica((self.second.host, self.second.port), f"key{i}")
+                   and self.server.holds_replica((self.server.host, self.server.port), f"key{i}"))
+        self.server.write_batch([(key, "changed", self.server.clock.now())])
+        stats = self.second.resync_with_node((self.server.host, self.server.port))
+        self.assertEqual((stats["buckets"], stats["pulled"]), (1, 1))
+        self.assertEqual(self.second.storage[key], "changed")
+
+
 # Run the tests
 if __name__ == "__main__":
     unittest.main()
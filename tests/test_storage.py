@@ -0,0 +1,511 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.backup import BackupManager, WriteAheadLog
+from utils.codec import ValueCodec, is_encoded
+from utils.data_structures import PersistentStorage
+from utils.storage_engine import LogStructuredEngine
+
+
+class TestLogStructuredStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.tmp_dir, "server_9000_storage.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def open_engine(self, **kwargs):
+        kwargs.setdefault("background_compaction", False)
+        return LogStructuredEngine(self.storage_file, **kwargs)
+
+    def test_put_get_overwrite_delete(self):
+        storage = PersistentStorage(self.storage_file)
+        storage["key1"] = "value1"
+        storage["key1"] = "value2"
+        storage["key2"] = {"nested": [1, 2]}
+        self.assertEqual(storage["key1"], "value2")
+        self.assertEqual(storage["key2"], {"nested": [1, 2]})
+        del storage["key1"]
+        self.assertIsNone(storage["key1"])
+        self.assertNotIn("key1", storage)
+        self.assertEqual(len(storage), 1)
+        storage.close()
+
+    def test_reload_rebuilds_index(self):
+        engine = self.open_engine()
+        engine.put("key1", "value1")
+        engine.put("key2", "value2")
+        engine.put("key1", "value3")
+        engine.delete("key2")
+        engine.close()
+
+        reopened = self.open_engine()
+        self.assertEqual(reopened.get("key1"), "value3")
+        self.assertIsNone(reopened.get("key2"))
+        self.assertEqual(reopened.keys(), ["key1"])
+        reopened.close()
+
+    def test_put_appends_instead_of_rewriting(self):
+        engine = self.open_engine()
+        engine.put("key00", "x" * 100)
+        size_after_one = engine._sizes[engine._active_id]
+        for i in range(1, 50):
+            engine.put(f"key{i:02d}", "x" * 100)
+        self.assertEqual(engine._sizes[engine._active_id], size_after_one * 50)
+        engine.close()
+
+    def test_compaction_drops_dead_records(self):
+        engine = self.open_engine(max_segment_bytes=512)
+        for round_no in range(20):
+            for i in range(10):
+                engine.put(f"key{i}", f"value{round_no}")
+        engine.delete("key0")
+        before = sum(engine._sizes.values())
+        engine.compact()
+        self.assertLess(sum(engine._sizes.values()), before)
+        for i in range(1, 10):
+            self.assertEqual(engine.get(f"key{i}"), "value19")
+        self.assertIsNone(engine.get("key0"))
+        engine.close()
+
+        reopened = self.open_engine()
+        self.assertEqual(reopened.get("key5"), "value19")
+        self.assertIsNone(reopened.get("key0"))
+        reopened.close()
+
+    def test_torn_tail_is_truncated(self):
+        engine = self.open_engine()
+        engine.put("key1", "value1")
+        path = engine._segment_path(engine._active_id)
+        engine.close()
+        with open(path, "ab") as f:
+            f.write(b"\x00\x01garbage")
+
+        reopened = self.open_engine()
+        self.assertEqual(reopened.get("key1"), "value1")
+        reopened.put("key2", "value2")
+        reopened.close()
+        self.assertEqual(self.open_engine().get("key2"), "value2")
+
+    def test_imports_legacy_json_file(self):
+        with open(self.storage_file, "w") as f:
+            json.dump({"key1": "value1", "key2": "69"}, f)
+        engine = self.open_engine()
+        self.assertEqual(engine.get("key2"), "69")
+        self.assertEqual(len(engine), 2)
+        engine.close()
+
+    def test_sealed_segments_are_synced_when_rolled(self):
+        engine = self.open_engine(max_segment_bytes=256)
+        first = engine._fds[engine._active_id]
+        with mock.patch("utils.storage_engine.os.fsync", wraps=os.fsync) as fsync:
+            for i in range(20):
+                engine.put(f"key{i}", "x" * 40)
+        self.assertGreater(engine._active_id, 1)
+        self.assertIn(mock.call(first), fsync.call_args_list)
+        engine.close()
+
+    def test_json_engine_syncs_before_replacing_the_file(self):
+        storage = PersistentStorage(self.storage_file, engine="json")
+        with mock.patch("utils.storage_engine.os.fsync", wraps=os.fsync) as fsync:
+            storage["key1"] = "value1"
+            storage.save_data()
+        self.assertGreaterEqual(fsync.call_count, 2)  # the new file, then its directory
+
+    def test_json_engine_still_available(self):
+        storage = PersistentStorage(self.storage_file, engine="json")
+        storage["key1"] = "value1"
+        with open(self.storage_file) as f:
+            self.assertEqual(json.load(f), {"key1": "value1"})
+
+
+class TestValueEncoding(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.tmp_dir, "server_9000_storage.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def open_engine(self, **kwargs):
+        return LogStructuredEngine(self.storage_file, background_compaction=False, **kwargs)
+
+    def test_codec_round_trips_typed_values(self):
+        values = [None, True, False, 0, -7, 2 ** 70, 3.25, "héllo wörld", "", b"\x00\xff",
+                  [1, "two", [None]], {"id": 1, "tags": ["a", "b"], "price": 9.99}]
+        for codec in (ValueCodec(), ValueCodec("zlib", min_size=1), ValueCodec("lzma", min_size=1)):
+            for value in values:
+                encoded = codec.encode(value)
+                self.assertTrue(is_encoded(encoded))
+                self.assertEqual(ValueCodec.decode(encoded), value)
+                self.assertIs(type(ValueCodec.decode(encoded)), type(value))
+        self.assertLess(len(ValueCodec().encode({"status": "open"})), len(json.dumps({"status": "open"})))
+        with self.assertRaises(ValueError):
+            ValueCodec("snappy")
+
+    def test_large_values_are_compressed_per_record(self):
+        blob = "customer order shipped from warehouse " * 100
+        plain = self.open_engine()
+        plain.put("blob", blob)
+        plain_size = plain._sizes[plain._active_id]
+        plain.close()
+        shutil.rmtree(plain.segment_dir)
+
+        compressed = self.open_engine(compression="zlib")
+        compressed.put("blob", blob)
+        compressed.put("small", "x")
+        self.assertLess(compressed._sizes[compressed._active_id], plain_size / 4)
+        compressed.close()
+        # Any engine reads records written with any compression setting
+        reopened = self.open_engine()
+        self.assertEqual((reopened.get("blob"), reopened.get("small")), (blob, "x"))
+        reopened.close()
+
+    def test_json_records_stay_readable_and_compaction_converts_them(self):
+        legacy = self.open_engine(value_format="json")
+        for i in range(10):
+            legacy.put(f"key{i}", {"n": i})
+        legacy.close()
+
+        engine = self.open_engine()
+        self.assertEqual(engine.get("key3"), {"n": 3})
+        engine.put("key0", {"n": 100})
+        engine.compact()
+        segment_id, offset, length = engine._index["key5"]
+        self.assertTrue(is_encoded(os.pread(engine._fds[segment_id], length, offset)))
+        expected = {f"key{i}": {"n": i} for i in range(10)}
+        expected["key0"] = {"n": 100}
+        self.assertEqual(dict(engine.items()), expected)
+        engine.close()
+
+
+class TestConcurrentStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.tmp_dir, "server_9000_storage.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_json_engine_shares_rewrites_between_writers(self):
+        storage = PersistentStorage(self.storage_file, engine="json")
+        rewrites = []
+        real_replace = os.replace
+
+        def counting_replace(src, dst):
+            rewrites.append(dst)
+            real_replace(src, dst)
+
+        os.replace = counting_replace
+        try:
+            self.run_threads(lambda n: [storage.put(f"key{n}-{i}", i) for i in range(50)])
+        finally:
+            os.replace = real_replace
+        with open(self.storage_file) as f:
+            self.assertEqual(len(json.load(f)), 400)
+        self.assertLess(len(rewrites), 400)
+        storage.close()
+
+    def test_log_engine_reads_stay_correct_during_writes_and_compaction(self):
+        storage = PersistentStorage(self.storage_file)
+        engine = storage.engine
+        for i in range(200):
+            storage[f"key{i}"] = f"value{i}"
+        errors = []
+
+        def worker(n):
+            for round_ in range(30):
+                for i in range(n, 200, 8):
+                    if n % 2:
+                        storage[f"key{i}"] = f"value{i}"
+                    elif storage[f"key{i}"] != f"value{i}":
+                        errors.append((f"key{i}", storage[f"key{i}"]))
+                if n == 0 and round_ % 10 == 0:
+                    engine.compact()
+
+        self.run_threads(worker)
+        self.assertEqual(errors, [])
+        self.assertEqual(storage.load_data(), {f"key{i}": f"value{i}" for i in range(200)})
+        storage.close()
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, "write_ahead_log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_lines(self):
+        lines = []
+        segment_dir = os.path.join(self.tmp_dir, "write_ahead_log.segments")
+        for name in sorted(os.listdir(segment_dir)):
+            with open(os.path.join(segment_dir, name)) as f:
+                lines.extend(f.read().splitlines())
+        return lines
+
+    def test_always_policy_is_durable_on_return(self):
+        wal = WriteAheadLog(self.log_file, sync_policy="always")
+        lsn = wal.append("PUT key1 value1")
+        self.assertEqual(lsn, len("PUT key1 value1\n"))
+        self.assertEqual(self.read_lines(), ["PUT key1 value1"])
+        wal.close()
+
+    def test_concurrent_writers_share_fsyncs(self):
+        wal = WriteAheadLog(self.log_file, sync_policy="always")
+        fsyncs = []
+        real_fsync = os.fsync
+
+        def counting_fsync(fd):
+            fsyncs.append(fd)
+            real_fsync(fd)
+
+        os.fsync = counting_fsync
+        try:
+            threads = [
+                threading.Thread(target=lambda n=n: [wal.append(f"PUT key{n}-{i} v") for i in range(20)])
+                for n in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.fsync = real_fsync
+        wal.close()
+        self.assertEqual(len(self.read_lines()), 160)
+        self.assertLess(len(fsyncs), 160)
+
+    def test_interval_policy_syncs_in_background(self):
+        wal = WriteAheadLog(self.log_file, sync_policy="interval", sync_interval_ms=10)
+        lsn = wal.append("PUT key1 value1")
+        wal.sync()
+        self.assertGreaterEqual(wal._synced_lsn, lsn)
+        wal.close()
+        self.assertEqual(self.read_lines(), ["PUT key1 value1"])
+
+    def test_bytes_policy_and_reopen_continues_lsn(self):
+        wal = WriteAheadLog(self.log_file, sync_policy="bytes", sync_bytes=32)
+        for i in range(10):
+            wal.append(f"PUT key{i} value")
+        wal.close()
+        reopened = WriteAheadLog(self.log_file)
+        self.assertEqual(reopened.position, len("".join(f"PUT key{i} value\n" for i in range(10))))
+        reopened.close()
+
+    def test_rotates_segments_and_reads_across_them(self):
+        wal = WriteAheadLog(self.log_file, sync_policy="always", segment_bytes=64)
+        lsns = [wal.append(f"PUT key{i} value{i}") for i in range(20)]
+        self.assertGreater(len(wal.segments()), 1)
+        records = list(wal.read_from(lsns[4]))
+        self.assertEqual(records[0], (lsns[5], "PUT key5 value5"))
+        self.assertEqual(len(records), 15)
+        self.assertEqual(len(list(wal.read_from(lsns[4], until=lsns[9]))), 5)
+
+        removed = wal.truncate(lsns[9])
+        self.assertGreater(removed, 0)
+        self.assertLessEqual(wal.first_lsn, lsns[9])
+        self.assertEqual([operation for _, operation in wal.read_from(lsns[9])][0], "PUT key10 value10")
+        wal.close()
+        self.assertEqual(WriteAheadLog(self.log_file).position, lsns[-1])
+
+    def test_imports_single_file_log(self):
+        with open(self.log_file, "w") as f:
+            f.write("PUT key1 value1\nPUT key2 value2\n")
+        wal = WriteAheadLog(self.log_file)
+        self.assertEqual([operation for _, operation in wal.read_from(0)], ["PUT key1 value1", "PUT key2 value2"])
+        self.assertEqual(wal.position, os.path.getsize(self.log_file))
+        wal.close()
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            WriteAheadLog(self.log_file, sync_policy="never")
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = PersistentStorage(os.path.join(self.tmp_dir, "server_9000_storage.json"))
+        self.backups = BackupManager(self.storage, backup_dir=os.path.join(self.tmp_dir, "backups"),
+                                     log_file=os.path.join(self.tmp_dir, "wal.txt"), chunk_size=7)
+
+    def tearDown(self):
+        self.backups.wal.close()
+        self.storage.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def put(self, key, value):
+        lsn = self.backups.log_write(["PUT", key, value])
+        self.storage[key] = value
+        self.backups.mark_applied(lsn)
+
+    def restore_into_fresh_storage(self):
+        restored = PersistentStorage(os.path.join(self.tmp_dir, "restored_storage.json"))
+        manager = BackupManager(restored, backup_dir=self.backups.backup_dir,
+                                log_file=os.path.join(self.tmp_dir, "restored_wal.txt"))
+        lsn = manager.restore()
+        manager.wal.close()
+        return restored, lsn
+
+    def test_snapshot_is_point_in_time(self):
+        for i in range(20):
+            self.storage[f"key{i}"] = i
+        with self.storage.snapshot() as items:
+            self.storage["key0"] = "changed"
+            self.storage["late"] = 1
+            self.assertEqual(dict(items), {f"key{i}": i for i in range(20)})
+
+    def test_full_then_delta_chain_restores(self):
+        for i in range(20):
+            self.put(f"key{i}", i)
+        full = self.backups.save_snapshot()
+        self.put("key3", "updated")
+        self.put("new", "value")
+        delta = self.backups.save_snapshot(incremental=True)
+        self.assertTrue(full.endswith("-full.jsonl") and delta.endswith("-delta.jsonl"))
+        with open(delta) as snapshot_file:
+            header = json.loads(snapshot_file.readline())
+            changed = dict(pair for line in snapshot_file for pair in json.loads(line))
+        self.assertEqual(changed, {"key3": "updated", "new": "value"})
+        self.assertEqual(header["lsn"], self.backups.wal.position)
+        self.assertIsNone(self.backups.save_snapshot(incremental=True))
+
+        restored, lsn = self.restore_into_fresh_storage()
+        self.assertEqual(lsn, header["lsn"])
+        self.assertEqual(restored.load_data(), self.storage.load_data())
+        restored.close()
+
+    def test_unapplied_writes_are_left_to_the_wal(self):
+        self.put("a", 1)
+        pending = self.backups.log_write(["PUT", "b", 2])
+        path = self.backups.save_snapshot()
+        self.assertEqual(self.backups.last_snapshot_lsn, self.backups.wal.position - len('["PUT", "b", 2]\n'))
+        self.backups.mark_applied(pending)
+        self.assertTrue(os.path.exists(path))
+
+    def test_replay_starts_at_last_checkpoint(self):
+        for i in range(50):
+            self.put(f"key{i % 10}", i)
+        self.backups.checkpoint()
+        self.storage["key1"] = "lost"          # as if a crash hit between log and apply
+        self.backups.log_write(["PUT", "key1", "has spaces"])
+        self.backups.log_write(["PUT", "key2", "after"])
+        self.backups.wal.close()
+        self.backups = BackupManager(self.storage, backup_dir=self.backups.backup_dir,
+                                     log_file=self.backups.log_file)
+
+        stats = self.backups.replay_log()
+        self.assertEqual((stats["records"], stats["keys"]), (2, 2))
+        self.assertEqual(self.storage["key1"], "has spaces")
+        self.assertEqual(self.storage["key9"], 49)
+        self.assertEqual(self.backups.replay_log()["records"], 0)
+
+    def test_replay_after_restore_covers_writes_since_snapshot(self):
+        self.put("a", 1)
+        self.backups.save_snapshot()
+        self.put("b", 2)
+        self.put("a", 3)
+        restored = PersistentStorage(os.path.join(self.tmp_dir, "restored_storage.json"))
+        self.backups.storage = restored
+        lsn = self.backups.restore()
+        self.backups.replay_log(start_lsn=lsn)
+        self.assertEqual(restored.load_data(), {"a": 3, "b": 2})
+        restored.close()
+
+    def test_replay_keeps_spaces_newlines_and_types(self):
+        self.backups.checkpoint()
+        self.backups.log_write(["PUT", "user 1", "alice"])
+        self.backups.log_write(["MPUT", [["a", "x\nPUT b injected"], ["n", 42], ["doc", {"tags": [1, None]}]]])
+        self.backups.wal.close()
+        self.backups = BackupManager(self.storage, backup_dir=self.backups.backup_dir,
+                                     log_file=self.backups.log_file)
+
+        stats = self.backups.replay_log()
+        self.assertEqual((stats["records"], stats["keys"]), (4, 4))
+        self.assertEqual(self.storage.load_data(), {"user 1": "alice", "a": "x\nPUT b injected", "n": 42,
+                                                    "doc": {"tags": [1, None]}})
+
+    def test_delta_includes_keys_written_in_batches(self):
+        self.put("a", 1)
+        self.backups.save_snapshot()
+        lsn = self.backups.log_write(["MPUT", [["key with space", "v"], ["b", "line\nbreak"]]])
+        self.storage.update([("key with space", "v"), ("b", "line\nbreak")])
+        self.backups.mark_applied(lsn)
+        self.assertEqual(sorted(self.backups._changed_keys(self.backups.last_snapshot_lsn, self.backups.wal.position)),
+                         ["b", "key with space"])
+
+    def test_replays_plain_text_records_of_older_logs(self):
+        self.assertEqual(BackupManager.parse_log_operation("PUT key1 has spaces"), [("key1", "has spaces")])
+        self.assertEqual(BackupManager.read_log_record("CHECKPOINT 42"), ["CHECKPOINT", "42"])
+        self.assertEqual(BackupManager.parse_log_operation('["CHECKPOINT", 42]'), [])
+
+    def test_first_incremental_snapshot_is_full(self):
+        self.put("a", 1)
+        self.assertTrue(self.backups.save_snapshot(incremental=True).endswith("-full.jsonl"))
+
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.tmp_dir, "server_9000_storage.json")
+        self.storage = PersistentStorage(self.storage_file, indexes=["color"])
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan_pages_through_a_range(self):
+        for i in range(25):
+            self.storage[f"user:{i:03d}"] = i
+        self.storage["zzz"] = "outside"
+        pages, cursor = [], None
+        while True:
+            items, cursor = self.storage.scan("user:005", "user:020", limit=4, cursor=cursor)
+            pages.append([key for key, _ in items])
+            if cursor is None:
+                break
+        self.assertEqual(sum(pages, []), [f"user:{i:03d}" for i in range(5, 20)])
+        self.assertEqual(len(pages[0]), 4)
+
+    def test_prefix_scan_and_deletes(self):
+        self.storage.update([("order:1", "a"), ("order:2", "b"), ("orders", "c"), ("other", "d")])
+        del self.storage["order:2"]
+        items, cursor = self.storage.prefix("order:", limit=10)
+        self.assertEqual((items, cursor), ([("order:1", "a")], None))
+
+    def test_secondary_index_follows_updates(self):
+        self.storage["car1"] = json.dumps({"color": "red", "doors": 4})
+        self.storage["car2"] = {"color": "red"}
+        self.storage["car3"] = json.dumps({"color": "blue"})
+        self.storage["plain"] = "red"
+        self.assertEqual([key for key, _ in self.storage.query("color", "red")[0]], ["car1", "car2"])
+        self.storage["car1"] = json.dumps({"color": "blue"})
+        del self.storage["car2"]
+        self.assertEqual([key for key, _ in self.storage.query("color", "blue")[0]], ["car1", "car3"])
+        self.assertEqual(self.storage.query("color", "red"), ([], None))
+
+    def test_indexes_are_rebuilt_on_reopen(self):
+        self.storage["b"] = json.dumps({"color": "green"})
+        self.storage["a"] = 1
+        self.storage.close()
+        self.storage = PersistentStorage(self.storage_file, indexes=["color"])
+        self.assertEqual(self.storage.scan("", None, 10)[0], [("a", 1), ("b", json.dumps({"color": "green"}))])
+        self.assertEqual(len(self.storage.query("color", "green")[0]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,66 +1,525 @@
 import os
+import re
 import json
 import time
+import shutil
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
 
+
+class WriteAheadLog:
+    """
+    Group-commit writer for the write-ahead log.
+
+    Records are queued by callers and written by a single background thread through
+    one long-lived file handle. Whatever accumulated while the previous write/fsync
+    was in flight goes out as one batch, so concurrent writers share a single fsync.
+
+    The log is split into segment files in ``<log_file stem>.segments/``, each named
+    after the LSN of its first byte, and a new segment is started once the active one
+    reaches ``segment_bytes``. Segments wholly covered by a checkpoint can be dropped
+    with ``truncate``.
+
+    Sync policies:
+      - "always":   every append waits until its batch has been fsynced
+      - "interval": fsync at most every ``sync_interval_ms`` milliseconds
+      - "bytes":    fsync once ``sync_bytes`` unsynced bytes have accumulated
+    """
+
+    SYNC_POLICIES = ("always", "interval", "bytes")
+    SEGMENT_SUFFIX = ".wal"
+
+    def __init__(self, log_file, sync_policy="interval", sync_interval_ms=100, sync_bytes=64 * 1024,
+                 segment_bytes=16 * 1024 * 1024):
+        if sync_policy not in self.SYNC_POLICIES:
+            raise ValueError(f"Unknown WAL sync policy '{sync_policy}'. Choose from: {', '.join(self.SYNC_POLICIES)}")
+        self.log_file = log_file
+        self.sync_policy = sync_policy
+        self.sync_interval = sync_interval_ms / 1000.0
+        self.sync_bytes = sync_bytes
+        self.segment_bytes = segment_bytes
+        self.segment_dir = os.path.splitext(log_file)[0] + ".segments"
+
+        if not os.path.isdir(self.segment_dir):
+            os.makedirs(self.segment_dir)
+            # Carry over a single-file log from before segments (LSNs stay byte offsets)
+            if os.path.isfile(log_file):
+                shutil.copyfile(log_file, self._segment_path(0))
+        segments = self.segments()
+        self._active_start = segments[-1] if segments else 0
+        self._file = open(self._segment_path(self._active_start), "ab")
+        self._cond = threading.Condition()
+        self._pending = []
+        self._next_lsn = self._active_start + self._file.tell()   # LSN = byte offset just past a record
+        self._written_lsn = self._next_lsn
+        self._synced_lsn = self._next_lsn
+        self._unsynced_bytes = 0
+        self._last_sync = time.monotonic()
+        self._sync_requested = False
+        self._closed = False
+        self._error = None
+        self._unapplied = {}  # end LSN -> start LSN of records not yet applied to storage
+
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def append(self, operation, pending_apply=False):
+        """
+        Queue one record; returns its LSN once the sync policy is satisfied. With
+        ``pending_apply`` the record counts as in flight until ``mark_applied(lsn)``.
+        """
+        data = f"{operation}\n".encode("utf-8")
+        with self._cond:
+            if self._closed:
+                raise ValueError("Write-ahead log is closed")
+            self._pending.append(data)
+            self._next_lsn += len(data)
+            lsn = self._next_lsn
+            if pending_apply:
+                self._unapplied[lsn] = lsn - len(data)
+            self._cond.notify_all()
+            if self.sync_policy == "always":
+                self._wait_for(lambda: self._synced_lsn >= lsn)
+        return lsn
+
+    def sync(self):
+        """Block until everything appended so far is on disk."""
+        with self._cond:
+            lsn = self._next_lsn
+            self._sync_requested = True
+            self._cond.notify_all()
+            self._wait_for(lambda: self._synced_lsn >= lsn)
+
+    def mark_applied(self, lsn):
+        with self._cond:
+            self._unapplied.pop(lsn, None)
+
+    @property
+    def position(self):
+        """LSN of the last appended record."""
+        return self._next_lsn
+
+    @property
+    def applied_position(self):
+        """Highest LSN such that every record up to it has been applied to storage."""
+        with self._cond:
+            return min(self._unapplied.values()) if self._unapplied else self._next_lsn
+
+    @property
+    def first_lsn(self):
+        """Oldest LSN still held by the log; records before it were truncated."""
+        segments = self.segments()
+        return segments[0] if segments else self._next_lsn
+
+    def _segment_path(self, start):
+        return os.path.join(self.segment_dir, f"{start:016d}{self.SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """Start LSNs of the segment files, oldest first."""
+        return sorted(int(name[:-len(self.SEGMENT_SUFFIX)]) for name in os.listdir(self.segment_dir)
+                      if name.endswith(self.SEGMENT_SUFFIX))
+
+    def read_from(self, start, until=None):
+        """Yield (lsn, operation) for the records between byte offsets ``start`` and ``until``."""
+        self.sync()
+        segments = self.segments()
+        for index, segment_start in enumerate(segments):
+            segment_end = segments[index + 1] if index + 1 < len(segments) else None
+            if segment_end is not None and segment_end <= start:
+                continue
+            lsn = max(start, segment_start)
+            try:
+                log_file = open(self._segment_path(segment_start), "rb")
+            except FileNotFoundError:
+                continue  # truncated while we were reading
+            with log_file:
+                log_file.seek(lsn - segment_start)
+                for line in log_file:
+                    if until is not None and lsn + len(line) > until:
+                        return
+                    if not line.endswith(b"\n"):
+                        break  # torn tail of a crashed write
+                    lsn += len(line)
+                    yield lsn, line.decode("utf-8").rstrip("\n")
+
+    def truncate(self, lsn):
+        """Delete the segments whose records all end at or before ``lsn``; returns how many."""
+        with self._cond:
+            active_start = self._active_start
+        segments = self.segments()
+        removed = 0
+        for index, segment_start in enumerate(segments[:-1]):
+            if segments[index + 1] > lsn or segment_start >= active_start:
+                break
+            os.remove(self._segment_path(segment_start))
+            removed += 1
+        if removed:
+            logging.info(f"Truncated {removed} write-ahead log segment(s) covered by LSN {lsn}")
+        return removed
+
+    def close(self):
+        if self._closed:
+            return
+        self.sync()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    def _wait_for(self, predicate):
+        while not predicate():
+            if self._error is not None:
+                raise self._error
+            self._cond.wait()
+
+    def _sync_due(self):
+        if self._sync_requested or self.sync_policy == "always":
+            return self._unsynced_bytes > 0 or self._sync_requested
+        if self.sync_policy == "bytes":
+            return self._unsynced_bytes >= self.sync_bytes
+        return self._unsynced_bytes > 0 and time.monotonic() - self._last_sync >= self.sync_interval
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._sync_due() and not self._closed:
+                    timeout = None
+                    if self.sync_policy == "interval" and self._unsynced_bytes:
+                        timeout = max(0.0, self._last_sync + self.sync_interval - time.monotonic())
+                    self._cond.wait(timeout)
+                if self._closed and not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                batch_lsn = self._next_lsn
+            try:
+                if batch:
+                    data = b"".join(batch)
+                    self._file.write(data)
+                    self._file.flush()
+                    self._unsynced_bytes += len(data)
+                with self._cond:
+                    self._written_lsn = batch_lsn
+                    sync_now = self._sync_due()
+                rotate = batch_lsn - self._active_start >= self.segment_bytes
+                if sync_now or rotate:
+                    os.fsync(self._file.fileno())
+                    with self._cond:
+                        self._synced_lsn = batch_lsn
+                        self._unsynced_bytes = 0
+                        self._last_sync = time.monotonic()
+                        self._sync_requested = False
+                        self._cond.notify_all()
+                if rotate:
+                    self._file.close()
+                    self._file = open(self._segment_path(batch_lsn), "ab")
+                    with self._cond:
+                        self._active_start = batch_lsn
+            except OSError as e:
+                logging.error(f"Write-ahead log write to {self.log_file} failed: {e}")
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+
 class BackupManager:
-    def __init__(self, storage, backup_dir="backups", log_file="write_ahead_log.txt"):
+    """
+    Write-ahead logging plus streamed full and incremental snapshots of the storage engine.
+
+    A snapshot file is JSON lines: a header ``{"type", "lsn", "base", "created"}``
+    followed by chunks of ``[key, value]`` pairs. ``lsn`` is the WAL position covered by
+    the snapshot. A full snapshot holds every key; a delta holds the keys written to the
+    WAL between ``base`` (the previous snapshot's LSN) and ``lsn``, with ``null`` for
+    deleted keys. Restoring applies the latest full snapshot and then its chain of deltas.
+    """
+
+    SNAPSHOT_PATTERN = re.compile(r"^snapshot-(\d{16})-(full|delta)\.jsonl$")
+
+    def __init__(self, storage, backup_dir="backups", log_file="write_ahead_log.txt",
+                 wal_sync="interval", wal_sync_interval=100, wal_sync_bytes=64 * 1024,
+                 backup_interval=5, chunk_size=1000, full_snapshot_every=10, restore_workers=4,
+                 wal_segment_bytes=16 * 1024 * 1024):
         self.storage = storage
         self.backup_dir = backup_dir
         self.log_file = log_file
-        self.backup_interval = 5
+        self.backup_interval = backup_interval
+        self.chunk_size = chunk_size
+        self.full_snapshot_every = full_snapshot_every
+        self.restore_workers = restore_workers
+        self.wal = WriteAheadLog(log_file, sync_policy=wal_sync, sync_interval_ms=wal_sync_interval,
+                                 sync_bytes=wal_sync_bytes, segment_bytes=wal_segment_bytes)
+        self._snapshot_lock = threading.Lock()
 
         # Ensure the backup directory exists
         os.makedirs(self.backup_dir, exist_ok=True)
+        chain = self.snapshot_chain()
+        self.last_snapshot_lsn = chain[-1][0] if chain else None
+        self.deltas_since_full = len(chain) - 1 if chain else 0
+
+    def list_snapshots(self):
+        """(lsn, kind, path) of every snapshot file, oldest first."""
+        snapshots = []
+        for name in os.listdir(self.backup_dir):
+            match = self.SNAPSHOT_PATTERN.match(name)
+            if match:
+                snapshots.append((int(match.group(1)), match.group(2), os.path.join(self.backup_dir, name)))
+        return sorted(snapshots, key=lambda snapshot: (snapshot[0], snapshot[1] == "full"))
+
+    def snapshot_chain(self):
+        """The latest full snapshot followed by the deltas that build on it, in order."""
+        snapshots = self.list_snapshots()
+        fulls = [snapshot for snapshot in snapshots if snapshot[1] == "full"]
+        if not fulls:
+            return []
+        chain = [fulls[-1]]
+        deltas = {self._read_header(path)["base"]: (lsn, kind, path)
+                  for lsn, kind, path in snapshots if kind == "delta" and lsn > chain[0][0]}
+        while chain[-1][0] in deltas:
+            chain.append(deltas.pop(chain[-1][0]))
+        return chain
+
+    @staticmethod
+    def _read_header(path):
+        with open(path, "r") as snapshot_file:
+            return json.loads(snapshot_file.readline())
+
+    def save_snapshot(self, incremental=False):
+        """
+        Stream a point-in-time snapshot to disk; returns its path (None when no key
+        changed since the previous snapshot).
+
+        The engine snapshot only pins the current index, so writers are not blocked
+        while chunks are written. Falls back to a full snapshot when there is no base
+        to build a delta on or the WAL no longer covers it.
+        """
+        with self._snapshot_lock:
+            base = self.last_snapshot_lsn
+            if (base is None or not self.wal.first_lsn <= base <= self.wal.position
+                    or self.deltas_since_full >= self.full_snapshot_every):
+                incremental = False
+            # Every WAL record up to ``lsn`` is already in storage when the snapshot is taken
+            lsn = self.wal.applied_position
+            changed = self._changed_keys(base, lsn) if incremental else None
+            if incremental and not changed:
+                logging.debug(f"No writes since the snapshot at LSN {base}; skipping")
+                return None
+            kind = "delta" if incremental else "full"
+            path = os.path.join(self.backup_dir, f"snapshot-{lsn:016d}-{kind}.jsonl")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as snapshot_file:
+                header = {"type": kind, "lsn": lsn, "base": base if incremental else None, "created": time.time()}
+                snapshot_file.write(json.dumps(header) + "\n")
+                if incremental:
+                    count = self._write_chunks(snapshot_file, ((key, self.storage[key]) for key in changed))
+                else:
+                    with self.storage.snapshot() as items:
+                        count = self._write_chunks(snapshot_file, items)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(tmp_path, path)
+            self.last_snapshot_lsn = lsn
+            self.deltas_since_full = self.deltas_since_full + 1 if incremental else 0
+            if not incremental:
+                self._prune_snapshots()
+        logging.info(f"{kind.capitalize()} snapshot of {count} keys at LSN {lsn} saved to {path}")
+        return path
+
+    def _changed_keys(self, base, lsn):
+        keys = {}
+        for _, operation in self.wal.read_from(base, until=lsn):
+            for key, _ in self.parse_log_operation(operation):
+                keys[key] = None
+        return list(keys)
+
+    def _prune_snapshots(self):
+        """Keep the current chain and the one before it; older snapshot files are removed."""
+        fulls = [lsn for lsn, kind, _ in self.list_snapshots() if kind == "full"]
+        if len(fulls) < 2:
+            return
+        for lsn, _, path in self.list_snapshots():
+            if lsn < fulls[-2]:
+                os.remove(path)
 
-    def save_snapshot(self):
-        """Periodically save the current state of the storage to a snapshot file."""
-        backup_filename = os.path.join(self.backup_dir, f"backup_{int(time.time())}.json")
-        with open(backup_filename, 'w') as backup_file:
-            json.dump(self.storage, backup_file)
-        logging.info(f"Backup saved to {backup_filename}")
+    def _write_chunks(self, snapshot_file, items):
+        chunk, count = [], 0
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                snapshot_file.write(json.dumps(chunk) + "\n")
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            snapshot_file.write(json.dumps(chunk) + "\n")
+            count += len(chunk)
+        return count
+
+    def restore(self):
+        """Restore storage from the latest snapshot chain; returns the LSN it covers, or None."""
+        chain = self.snapshot_chain()
+        if not chain:
+            logging.info("No snapshot found to restore.")
+            return None
+        for _, _, path in chain:
+            self.apply_backup(path)
+        return chain[-1][0]
 
     def apply_backup(self, backup_filename):
-        """Restore storage from a backup file."""
-        if os.path.exists(backup_filename):
-            with open(backup_filename, 'r') as backup_file:
-                self.storage = json.load(backup_file)
-            logging.info(f"Backup applied from {backup_filename}")
-        else:
+        """
+        Restore storage from a backup file into the engine.
+
+        Snapshot chunks are decoded and written by ``restore_workers`` threads while the
+        file is still being read; legacy ``backup_*.json`` dumps are loaded as a whole.
+        """
+        if not os.path.exists(backup_filename):
             logging.error(f"Backup file {backup_filename} does not exist.")
+            return
+        with open(backup_filename, 'r') as backup_file:
+            if not self.SNAPSHOT_PATTERN.match(os.path.basename(backup_filename)):
+                self.storage.update(json.load(backup_file).items(), flush=False)
+                self.storage.save_data()
+                logging.info(f"Backup applied from {backup_filename}")
+                return
+            header = json.loads(backup_file.readline())
+            self._run_parallel(self._apply_chunk, backup_file)
+        self.storage.save_data()
+        logging.info(f"{header['type'].capitalize()} snapshot at LSN {header['lsn']} applied from {backup_filename}")
 
-    def log_write(self, operation):
-        """Log a write operation (e.g., PUT command) to a write-ahead log."""
-        with open(self.log_file, 'a') as log_file:
-            log_file.write(f"{operation}\n")
-        logging.info(f"Operation logged: {operation}")
+    def _run_parallel(self, func, jobs):
+        """Run ``func`` over ``jobs`` on ``restore_workers`` threads, reading ahead a bounded amount."""
+        inflight = deque()
+        with ThreadPoolExecutor(max_workers=self.restore_workers) as executor:
+            for job in jobs:
+                if len(inflight) >= 2 * self.restore_workers:
+                    inflight.popleft().result()
+                inflight.append(executor.submit(func, job))
+            for future in inflight:
+                future.result()
 
-    def replay_log(self):
-        """Replay the write-ahead log to restore the system's state after failure."""
-        if os.path.exists(self.log_file):
-            with open(self.log_file, 'r') as log_file:
-                for line in log_file:
-                    operation = line.strip()
-                    # Apply each logged operation to storage
-                    self.apply_log_operation(operation)
-            logging.info("Log replay completed.")
-        else:
-            logging.info("No log file found to replay.")
+    def _apply_chunk(self, line):
+        chunk = json.loads(line)
+        self.storage.update([(key, value) for key, value in chunk if value is not None], flush=False)
+        for key, value in chunk:
+            if value is None and key in self.storage:
+                del self.storage[key]
+
+    def log_write(self, record):
+        """
+        Log a write record, ``["PUT", key, value]`` or ``["MPUT", [[key, value], ...]]``,
+        to the write-ahead log as one JSON line, so keys and values keep their spaces,
+        newlines and types. Call ``mark_applied`` with the returned LSN once the write
+        has reached storage.
+        """
+        operation = json.dumps(record)
+        lsn = self.wal.append(operation, pending_apply=True)
+        logging.debug(f"Operation logged at LSN {lsn}: {operation}")
+        return lsn
+
+    def mark_applied(self, lsn):
+        self.wal.mark_applied(lsn)
+
+    def checkpoint(self):
+        """
+        Sync storage to disk, then record a CHECKPOINT marker in the WAL and drop the
+        segments it covers; returns the checkpoint LSN. Segments newer than the last snapshot are
+        kept so the next delta can still be computed from them.
+        """
+        lsn = self.wal.applied_position
+        self.storage.save_data()
+        self.wal.append(json.dumps(["CHECKPOINT", lsn]))
+        self.wal.sync()
+        keep_from = lsn if self.last_snapshot_lsn is None else min(lsn, self.last_snapshot_lsn)
+        self.wal.truncate(keep_from)
+        logging.info(f"Checkpoint at LSN {lsn}")
+        return lsn
+
+    def last_checkpoint(self):
+        """LSN named by the newest CHECKPOINT marker still in the WAL, or None."""
+        lsn = None
+        for _, operation in self.wal.read_from(self.wal.first_lsn):
+            record = self.read_log_record(operation)
+            if record[:1] == ["CHECKPOINT"] and len(record) == 2:
+                lsn = int(record[1])
+        return lsn
+
+    def replay_log(self, start_lsn=None):
+        """
+        Replay the write-ahead log to restore the system's state after failure.
+
+        Replay starts at ``start_lsn`` (e.g. the LSN of a just restored snapshot) or
+        else at the last checkpoint. Records are coalesced per key, applied in parallel
+        chunks and flushed once at the end; a checkpoint is taken afterwards so the
+        next start does not replay them again. Returns replay statistics.
+        """
+        started = time.monotonic()
+        if start_lsn is None:
+            start_lsn = self.last_checkpoint() or self.wal.first_lsn
+        if start_lsn < self.wal.first_lsn:
+            logging.warning(f"Write-ahead log starts at LSN {self.wal.first_lsn}, after the requested LSN {start_lsn}")
+        latest = {}
+        records = 0
+        for _, operation in self.wal.read_from(max(start_lsn, self.wal.first_lsn)):
+            pairs = self.parse_log_operation(operation)
+            latest.update(pairs)
+            records += len(pairs)
+        items = list(latest.items())
+        self._run_parallel(lambda chunk: self.storage.update(chunk, flush=False),
+                           (items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)))
+        self.storage.save_data()
+        if records:
+            self.checkpoint()
+        stats = {"start_lsn": start_lsn, "records": records, "keys": len(items),
+                 "seconds": round(time.monotonic() - started, 3)}
+        logging.info(f"Log replay completed: {records} records, {len(items)} keys from LSN {start_lsn} "
+                     f"in {stats['seconds']}s")
+        return stats
+
+    @staticmethod
+    def read_log_record(operation):
+        """
+        The ``[name, ...]`` list of a logged record; ``[]`` for malformed lines. Lines in
+        the plain-text format of older logs (``PUT <key> <value>``) are read as before.
+        """
+        try:
+            record = json.loads(operation)
+        except ValueError:
+            parts = operation.split(" ", 2)
+            if len(parts) == 3 and parts[0] == "PUT":
+                return parts
+            if len(parts) == 2 and parts[0] == "CHECKPOINT" and parts[1].isdigit():
+                return parts
+            return []
+        return record if isinstance(record, list) else []
+
+    @classmethod
+    def parse_log_operation(cls, operation):
+        """(key, value) pairs written by a logged PUT or MPUT; empty for markers and malformed lines."""
+        record = cls.read_log_record(operation)
+        if record[:1] == ["PUT"] and len(record) == 3:
+            return [(record[1], record[2])]
+        if record[:1] == ["MPUT"] and len(record) == 2:
+            return [(key, value) for key, value in record[1]]
+        return []
 
     def apply_log_operation(self, operation):
         """Apply an operation (like a PUT command) from the log to the storage."""
-        parts = operation.split()
-        if parts[0] == "PUT" and len(parts) == 3:
-            key = parts[1]
-            value = parts[2]
-            self.storage[key] = value
-            logging.info(f"Applied operation: {operation}")
+        pairs = self.parse_log_operation(operation)
+        if pairs:
+            self.storage.update(pairs)
+            logging.debug(f"Applied operation: {operation}")
+
     def periodic_backup(self):
         """Run periodic backups at the defined interval."""
         while True:
             time.sleep(self.backup_interval)  # Sleep for the backup interval
-            self.save_snapshot()  #
+            try:
+                self.save_snapshot(incremental=True)
+                self.checkpoint()
+            except Exception as e:
+                logging.error(f"Periodic snapshot failed: {e}")
 
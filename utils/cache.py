@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe read cache with LRU eviction and an optional TTL.
+
+    ``get_or_load`` fills the cache from a loader, but drops the loaded value if the
+    key was invalidated while the load was in flight, so a read racing a write never
+    caches the overwritten value. ``max_entries=0`` disables caching.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at or None)
+        self._loading = {}             # key -> [loads in flight, invalidated meanwhile]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """Cached value of ``key``, or None on a miss."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.max_entries or value is None:
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_load(self, key, loader):
+        """Cached value of ``key``, calling ``loader(key)`` and caching its result on a miss."""
+        if not self.max_entries:
+            return loader(key)
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+            self._loading.setdefault(key, [0, False])[0] += 1
+        value = None
+        try:
+            value = loader(key)
+        finally:
+            with self._lock:
+                loading = self._loading[key]
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[key]
+                if value is not None and not loading[1]:
+                    self._store(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+            if key in self._loading:
+                self._loading[key][1] = True
+
+    def invalidate_many(self, keys):
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for loading in self._loading.values():
+                loading[1] = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,156 @@
+import lzma
+import struct
+import zlib
+
+# Type tags of the binary value encoding
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _BYTES, _LIST, _DICT = range(9)
+_FLOAT64 = struct.Struct(">d")
+
+# A compressed value starts with one of these markers instead of a type tag. Tags and
+# markers are all below 0x20, which never starts JSON text, so readers can tell binary
+# records from legacy JSON ones.
+COMPRESSION_MARKERS = {"zlib": 0x10, "lzma": 0x11}
+_COMPRESSORS = {
+    0x10: (zlib.compress, zlib.decompress),
+    0x11: (lzma.compress, lzma.decompress),
+}
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _encode(value, out):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)  # zigzag
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _FLOAT64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        out.append(_STR)
+        _write_varint(out, len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == _STR:
+        length, pos = _read_varint(data, pos)
+        return str(data[pos:pos + length], "utf-8"), pos + length
+    if tag == _INT:
+        n, pos = _read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _FLOAT:
+        return _FLOAT64.unpack_from(data, pos)[0], pos + _FLOAT64.size
+    if tag == _BYTES:
+        length, pos = _read_varint(data, pos)
+        return bytes(data[pos:pos + length]), pos + length
+    if tag == _LIST:
+        length, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(length):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == _DICT:
+        length, pos = _read_varint(data, pos)
+        items = {}
+        for _ in range(length):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+    raise ValueError(f"Unknown value tag {tag}")
+
+
+def is_encoded(data):
+    """True for the output of ValueCodec.encode, False for JSON text."""
+    return bool(data) and data[0] < 0x20
+
+
+class ValueCodec:
+    """
+    Compact, typed binary encoding of stored values.
+
+    None, booleans, integers (zigzag varints), floats, strings, bytes, lists and dicts
+    are written with a one-byte type tag and varint lengths instead of JSON text, so
+    strings need no quoting or escaping and bytes are stored as they are. An encoded
+    value of at least ``min_size`` bytes is compressed with ``compression`` (zlib or
+    lzma) when that makes it smaller, behind a one-byte marker naming the compressor,
+    so any codec decodes values written with any setting.
+    """
+
+    def __init__(self, compression=None, min_size=256, level=None):
+        if compression is not None and compression not in COMPRESSION_MARKERS:
+            raise ValueError(f"Unknown compression '{compression}'. Choose from: zlib, lzma")
+        self.compression = compression
+        self.min_size = min_size
+        self.level = level
+
+    def encode(self, value):
+        body = bytearray()
+        _encode(value, body)
+        if self.compression is not None and len(body) >= self.min_size:
+            marker = COMPRESSION_MARKERS[self.compression]
+            compress = _COMPRESSORS[marker][0]
+            if self.level is None:
+                packed = compress(bytes(body))
+            elif self.compression == "lzma":
+                packed = compress(bytes(body), preset=self.level)
+            else:
+                packed = compress(bytes(body), self.level)
+            if len(packed) + 1 < len(body):
+                return bytes([marker]) + packed
+        return bytes(body)
+
+    @staticmethod
+    def decode(data):
+        if data[0] in _COMPRESSORS:
+            data = _COMPRESSORS[data[0]][1](memoryview(data)[1:])
+        value, _ = _decode(data, 0)
+        return value
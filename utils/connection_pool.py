@@ -0,0 +1,145 @@
+import itertools
+import logging
+import select
+import socket
+import threading
+import time
+
+from utils.protocol import HELLO, HELLO_OK, ProtocolError, encode_frame, read_frame
+
+
+class PooledConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.stream = sock.makefile('rb')
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        try:
+            self.stream.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Per-peer pool of persistent framed-protocol connections for intra-cluster traffic.
+
+    Idle connections are checked before reuse (not idle for longer than
+    ``idle_timeout`` and not closed by the peer), at most ``max_size`` connections
+    are open to one peer at a time, and a request whose reused connection turns out
+    to have been closed by the peer (reset or EOF before any reply) is retried once
+    on a fresh one. Requests that time out are never retried.
+    """
+
+    def __init__(self, max_size=8, connect_timeout=2, request_timeout=5, idle_timeout=60):
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}    # peer -> [PooledConnection, ...]
+        self._slots = {}   # peer -> BoundedSemaphore(max_size)
+        self._request_ids = itertools.count(1)
+        self.connections_opened = 0
+
+    def _slot(self, peer):
+        with self._lock:
+            if peer not in self._slots:
+                self._slots[peer] = threading.BoundedSemaphore(self.max_size)
+            return self._slots[peer]
+
+    def _connect(self, peer):
+        sock = socket.create_connection(peer, timeout=self.connect_timeout)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(HELLO.encode('utf-8'))
+            reply = sock.recv(len(HELLO_OK)).decode('utf-8')
+            if reply != HELLO_OK:
+                raise ConnectionError(f"Peer {peer} does not support the binary protocol: {reply}")
+        except Exception:
+            sock.close()
+            raise
+        with self._lock:
+            self.connections_opened += 1
+        return PooledConnection(sock)
+
+    def _is_healthy(self, conn):
+        if time.monotonic() - conn.last_used > self.idle_timeout:
+            return False
+        try:
+            # An idle connection must have nothing to read; readable means EOF or garbage.
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _acquire(self, peer, fresh=False):
+        if not self._slot(peer).acquire(timeout=self.request_timeout):
+            raise ConnectionError(f"Connection pool to {peer} exhausted ({self.max_size} in use)")
+        try:
+            while not fresh:
+                with self._lock:
+                    idle = self._idle.get(peer)
+                    conn = idle.pop() if idle else None
+                if conn is None:
+                    break
+                if self._is_healthy(conn):
+                    conn.reused = True
+                    return conn
+                conn.close()
+            return self._connect(peer)
+        except Exception:
+            self._slot(peer).release()
+            raise
+
+    def _release(self, peer, conn, reusable=True):
+        if reusable:
+            conn.last_used = time.monotonic()
+            with self._lock:
+                self._idle.setdefault(peer, []).append(conn)
+        else:
+            conn.close()
+        self._slot(peer).release()
+
+    def request(self, peer, *fields, timeout=None):
+        """Send one command to ``peer`` and return its response text."""
+        fresh = False
+        while True:
+            conn = self._acquire(peer, fresh=fresh)
+            try:
+                conn.sock.settimeout(timeout or self.request_timeout)
+                request_id = next(self._request_ids)
+                conn.sock.sendall(encode_frame(request_id, fields))
+                frame = read_frame(conn.stream)
+                if frame is None:
+                    raise ConnectionResetError(f"{peer} closed the connection without replying")
+                if frame[0] != request_id:
+                    raise ProtocolError(f"Unexpected reply from {peer}")
+            except (OSError, ProtocolError) as e:
+                self._release(peer, conn, reusable=False)
+                # Only a reset or EOF before any reply means the peer had dropped the idle
+                # connection; after a timeout or a partial reply the request may have run
+                if conn.reused and not fresh and isinstance(e, ConnectionError):
+                    logging.debug(f"Pooled connection to {peer} failed ({e}); reconnecting")
+                    fresh = True
+                    continue
+                raise
+            self._release(peer, conn)
+            return frame[2][0] if frame[2] else ""
+
+    def discard(self, peer):
+        """Drop every idle connection to ``peer`` (e.g. after it was reported down)."""
+        with self._lock:
+            connections = self._idle.pop(peer, [])
+        for conn in connections:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            peers = list(self._idle)
+        for peer in peers:
+            self.discard(peer)
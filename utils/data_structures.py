@@ -1,51 +1,162 @@
 import json
 import os
 import logging
-import json
-import os
+import threading
+
+from utils.indexes import OrderedKeyIndex, SecondaryIndex
+from utils.storage_engine import create_engine
 
 class PersistentStorage:
-    def __init__(self, storage_file="server_storage.json"):
+    """
+    Dict-like facade over a storage engine plus the key and attribute indexes.
+
+    Writes to the same key are serialized by one of ``lock_stripes`` locks picked by
+    the key's hash, so the engine and the indexes see them in the same order while
+    writes to other keys proceed in parallel. Reads take no lock. Watchers registered
+    with watch() see every change inside the same stripe lock, in storage order.
+    """
+
+    def __init__(self, storage_file="server_storage.json", engine="log", indexes=(), lock_stripes=64,
+                 engine_options=None):
         self.storage_file = storage_file
-        self.data = self.load_data()
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        # Pluggable backend: "log" (append-only segments) or "json" (legacy full rewrite)
+        self.engine = create_engine(engine, storage_file, **(engine_options or {}))
+        # Sorted keys for SCAN/PREFIX, and attribute indexes for QUERY
+        self.key_index = OrderedKeyIndex(self.engine.keys())
+        self.secondary_indexes = {}
+        self._watchers = []
+        for attribute in indexes:
+            self.add_index(attribute)
+
+    def add_index(self, attribute):
+        """Create a secondary index on ``attribute`` of structured values, built from current data."""
+        if attribute not in self.secondary_indexes:
+            index = SecondaryIndex(attribute)
+            for key, value in self.engine.items():
+                index.update(key, value)
+            self.secondary_indexes[attribute] = index
+        return self.secondary_indexes[attribute]
+
+    def watch(self, watcher):
+        """Call ``watcher.update(key, value)`` and ``watcher.remove(key)`` on every change from now on."""
+        self._watchers.append(watcher)
+
+    def _indexed(self, key, value):
+        self.key_index.add(key)
+        for index in self.secondary_indexes.values():
+            index.update(key, value)
+        for watcher in self._watchers:
+            watcher.update(key, value)
 
     def load_data(self):
-        """Load the data from the storage file, handling empty files gracefully."""
-        if not os.path.exists(self.storage_file) or os.path.getsize(self.storage_file) == 0:
-            # If the file doesn't exist or is empty, return an empty dictionary
-            return {}
-        
-        try:
-            with open(self.storage_file, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            # Handle the case where the file exists but the contents are invalid
-            print(f"Error: Failed to decode JSON from {self.storage_file}. Returning empty storage.")
-            return {}
+        """Return a plain dict copy of everything currently stored."""
+        return dict(self.engine.items())
 
     def save_data(self):
-        """Save the data to the storage file."""
-        with open(self.storage_file, "w") as f:
-            json.dump(self.data, f)
+        """Flush pending writes of the storage engine to disk."""
+        self.engine.flush()
 
     def __getitem__(self, key):
         """Allow accessing the data like a dictionary."""
-        return self.data.get(key)
+        return self.engine.get(key)
 
     def __setitem__(self, key, value):
         """Allow setting data like a dictionary."""
-        self.data[key] = value
-        self.save_data()  # Persist data after every change
+        with self._stripe(key):
+            self.engine.put(key, value)
+            self._indexed(key, value)
 
     def __delitem__(self, key):
         """Allow deleting an item from the storage."""
-        if key in self.data:
-            del self.data[key]
-            self.save_data()  # Persist data after deletion
+        with self._stripe(key):
+            self.engine.delete(key)
+            self.key_index.remove(key)
+            for index in self.secondary_indexes.values():
+                index.remove(key)
+            for watcher in self._watchers:
+                watcher.remove(key)
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _stripes_for(self, keys):
+        """The distinct stripe locks of ``keys`` in a fixed order, so batches cannot deadlock."""
+        return [self._stripes[i] for i in sorted({hash(key) % len(self._stripes) for key in keys})]
 
     def __contains__(self, key):
         """Allow checking if a key exists in the storage."""
-        return key in self.data
+        return self.engine.contains(key)
+
+    def __len__(self):
+        return len(self.engine)
+
+    def __iter__(self):
+        return iter(self.engine.keys())
+
+    def keys(self):
+        return self.engine.keys()
+
+    def items(self):
+        return self.engine.items()
+
+    def put(self, key, value):
+        """Add or update an item in storage."""
+        self[key] = value
+
+    def get(self, key):
+        """Value of ``key``, or None if it is missing."""
+        return self[key]
+
+    def update(self, items, flush=True):
+        """
+        Write many (key, value) pairs in one batch. Bulk loaders pass ``flush=False``
+        and call save_data() once at the end.
+        """
+        items = list(items)
+        stripes = self._stripes_for(key for key, _ in items)
+        for stripe in stripes:
+            stripe.acquire()
+        try:
+            self.engine.put_many(items, flush=flush)
+            self.key_index.add_many(key for key, _ in items)
+            for index in self.secondary_indexes.values():
+                for key, value in items:
+                    index.update(key, value)
+            for watcher in self._watchers:
+                for key, value in items:
+                    watcher.update(key, value)
+        finally:
+            for stripe in reversed(stripes):
+                stripe.release()
+
+    def scan(self, start, end=None, limit=100, cursor=None):
+        """
+        Items with ``start <= key < end`` in key order, one page at a time. Returns
+        ``(items, cursor)``; pass the cursor back for the next page (None when done).
+        """
+        return self._page(self.key_index.range(start, end, limit, after=cursor), limit)
+
+    def prefix(self, prefix, limit=100, cursor=None):
+        """Items whose key starts with ``prefix``, paginated like scan()."""
+        return self._page(self.key_index.prefix(prefix, limit, after=cursor), limit)
+
+    def query(self, attribute, value, limit=100, cursor=None):
+        """Items whose ``attribute`` equals ``value`` through its secondary index, paginated like scan()."""
+        if attribute not in self.secondary_indexes:
+            raise KeyError(f"No secondary index on '{attribute}'")
+        return self._page(self.secondary_indexes[attribute].query(value, limit, after=cursor), limit)
+
+    def _page(self, keys, limit):
+        items = [(key, value) for key, value in ((key, self.engine.get(key)) for key in keys) if value is not None]
+        return items, keys[-1] if len(keys) == limit else None
+
+    def snapshot(self):
+        """Context manager yielding a point-in-time iterator of (key, value) pairs."""
+        return self.engine.snapshot()
+
+    def close(self):
+        self.engine.close()
 
 # class PersistentStorage:
 #     def __init__(self, storage_file="server_storage.json"):
@@ -1,80 +1,270 @@
-import hashlib
-import os
-import fnmatch
-import shutil
-import json
+import bisect
+import functools
+import threading
+import zlib
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(h):
+    """One xorshift-multiply round of the MurmurHash3 finalizer to spread the CRC bits."""
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    return h ^ (h >> 33)
+
+
+@functools.lru_cache(maxsize=65536)
+def ring_hash(key):
+    """Non-cryptographic 64-bit ring position for a string (two seeded CRC32s, then mixed)."""
+    data = key.encode('utf-8')
+    return _mix64((zlib.crc32(data) << 32) | zlib.crc32(data, 0x9e3779b9))
+
+
+class _RingView:
+    """One immutable version of the ring; readers take a view and never see a half-applied change."""
+
+    __slots__ = ("ring", "sorted_keys", "owners", "preference_table")
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.sorted_keys = sorted(ring)
+        self.owners = [ring[key] for key in self.sorted_keys]  # parallel to sorted_keys for bisect lookups
+        self.preference_table = None                            # built lazily on the first preference_list()
+
+
 class ConsistentHashing:
-    def __init__(self, nodes, replicas=3):
-        self.replicas = replicas
-        self.ring = {}
-        self.sorted_keys = []
+    def __init__(self, nodes, replicas=3, vnodes=160, weights=None):
+        self.replicas = replicas  # Copies of each key
+        self.vnodes = vnodes      # Ring positions per node of weight 1.0
+        self.weights = {}
+        self._view = _RingView({})
+        self._lock = threading.Lock()  # serializes membership changes; lookups take no lock
+        weights = weights or {}
         for node in nodes:
-            self.add_node(node)
+            self.add_node(node, weights.get(node, 1.0))
+
+    @property
+    def nodes(self):
+        return list(self.weights)
+
+    @property
+    def ring(self):
+        return self._view.ring
 
-    def add_node(self, node):
-        for i in range(self.replicas):
-            key = self.hash(f"{node}-{i}")
-            self.ring[key] = node
-            self.sorted_keys.append(key)
-        self.sorted_keys.sort()
+    @property
+    def sorted_keys(self):
+        return self._view.sorted_keys
+
+    @property
+    def _owners(self):
+        return self._view.owners
+
+    def _vnode_count(self, node, weight):
+        return max(1, int(round(self.vnodes * weight)))
+
+    def add_node(self, node, weight=1.0):
+        with self._lock:
+            ring = {key: owner for key, owner in self._view.ring.items() if owner != node}
+            for i in range(self._vnode_count(node, weight)):
+                key = self.hash(f"{node}-{i}")
+                if key in ring:
+                    continue  # 64-bit collision; the earlier owner keeps the position
+                ring[key] = node
+            weights = dict(self.weights)
+            weights.pop(node, None)
+            weights[node] = weight
+            # Swapped in whole, so concurrent lookups see either the old or the new ring
+            self._view = _RingView(ring)
+            self.weights = weights
 
     def remove_node(self, node):
-        for i in range(self.replicas):
-            key = self.hash(f"{node}-{i}")
-            del self.ring[key]
-            self.sorted_keys.remove(key)
+        with self._lock:
+            if node not in self.weights:
+                return
+            self.weights = {other: weight for other, weight in self.weights.items() if other != node}
+            self._view = _RingView({key: owner for key, owner in self._view.ring.items() if owner != node})
+
+    def copy(self):
+        """An independent ring with the same members, e.g. to plan a membership change."""
+        return ConsistentHashing(self.nodes, replicas=self.replicas, vnodes=self.vnodes, weights=self.weights)
 
     def hash(self, key):
-        return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+        return ring_hash(key)
+
+    @staticmethod
+    def _index(view, position):
+        """Index of the first ring position clockwise from a hash position."""
+        index = bisect.bisect_left(view.sorted_keys, position)
+        return 0 if index == len(view.sorted_keys) else index
+
+    def _position(self, key):
+        """Index of the first ring position clockwise from the key's hash."""
+        return self._index(self._view, self.hash(key))
 
     def get_node(self, key):
-        hash_key = self.hash(key)
-        for node_key in self.sorted_keys:
-            if hash_key <= node_key:
-                return self.ring[node_key]
-        return self.ring[self.sorted_keys[0]]
+        view = self._view
+        if not view.sorted_keys:
+            return None
+        return view.owners[self._index(view, self.hash(key))]
+
+    def _preference_table(self, view):
+        """
+        For every ring position, the first distinct physical nodes met walking clockwise.
+
+        Keys hashing between two adjacent positions share the same preference list, so a
+        lookup is one bisect plus an index into this table. Entries hold twice the
+        replica count so a few unavailable nodes can be skipped without walking the ring.
+        """
+        if view.preference_table is not None:
+            return view.preference_table
+        depth = min(len(set(view.owners)), 2 * self.replicas)
+        positions = len(view.owners)
+        table = []
+        for start in range(positions):
+            preferred = []
+            for step in range(positions):
+                owner = view.owners[(start + step) % positions]
+                if owner not in preferred:
+                    preferred.append(owner)
+                    if len(preferred) == depth:
+                        break
+            table.append(tuple(preferred))
+        view.preference_table = table
+        return table
+
+    @staticmethod
+    def _walk_distinct(view, start):
+        """Every physical node in clockwise order from ``start`` (slow path)."""
+        seen = []
+        positions = len(view.owners)
+        members = len(set(view.owners))
+        for step in range(positions):
+            owner = view.owners[(start + step) % positions]
+            if owner not in seen:
+                seen.append(owner)
+                if len(seen) == members:
+                    break
+        return seen
+
+    def _preference_at(self, view, start, n, active_nodes=None):
+        table = self._preference_table(view)
+        candidates = table[start]
+        if active_nodes is not None:
+            candidates = [node for node in candidates if node in active_nodes]
+        if len(candidates) < n and len(table[start]) < len(set(view.owners)):
+            candidates = self._walk_distinct(view, start)
+            if active_nodes is not None:
+                candidates = [node for node in candidates if node in active_nodes]
+        return list(candidates[:n])
+
+    def preference_list(self, key, n=None, active_nodes=None):
+        """
+        The ``n`` (default: replica count) distinct nodes responsible for ``key``: the
+        clockwise successors of the key's hash. When ``active_nodes`` is given, nodes
+        outside it are skipped and the next healthy successors take their place
+        (sloppy quorum).
+        """
+        n = self.replicas if n is None else n
+        view = self._view
+        if not view.sorted_keys:
+            return []
+        return self._preference_at(view, self._index(view, self.hash(key)), n, active_nodes)
 
     def get_replicas(self, key):
-        node = self.get_node(key)
-        index = self.sorted_keys.index(self.hash(f"{node}-0"))
-        replicas = []
-        for i in range(self.replicas):
-            replicas.append(self.ring[self.sorted_keys[(index + i) % len(self.sorted_keys)]])
-        return replicas
-    
-    def get_keys_responsible(node):
-        node_port = node[1]
-        
-    
-    def find_and_transfer_json_files(directory, node_port, replica_port):
-        file_found = False
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if fnmatch.fnmatch(file, f"*{node_port}*.json"):  # Look for files containing node_port
-                    file_found = True
-                    old_path = os.path.join(root, file)
-                    
-                    # Load data from the file
-                    with open(old_path, 'r') as json_file:
-                        try:
-                            data = json.load(json_file)  # Assuming JSON content is valid
-                        except json.JSONDecodeError as e:
-                            print(f"Error decoding JSON from file {file}: {e}")
-                            continue
-
-                    # Construct new file name for the replica
-                    new_file_name = file.replace(node_port, replica_port)
-                    new_path = os.path.join(root, new_file_name)
-
-                    # Write data to the new file
-                    with open(new_path, 'w') as new_json_file:
-                        json.dump(data, new_json_file, indent=4)
-
-                    print(f"Data copied from {old_path} to {new_path}")
-
-                    # Optional: Remove the old file if needed
-                    # os.remove(old_path)
-        
-        if not file_found:
-            print(f"No JSON file containing port {node_port} found.")
-        return file_found
+        return self.preference_list(key)
+
+    def token_ranges(self, active_nodes=None):
+        """
+        Split the hash space into ``(start, end]`` ranges by primary owner: {node: [(start, end), ...]}.
+
+        Position i owns the hashes after position i-1 up to itself, and the hashes past
+        the last position wrap around to position 0. With ``active_nodes``, a range of a
+        node that is down goes to its first healthy successor, as in preference_list().
+        Adjacent ranges of the same node are merged.
+        """
+        view = self._view
+        if not view.sorted_keys:
+            return {}
+        owners = []
+        for index in range(len(view.sorted_keys)):
+            candidates = self._preference_at(view, index, 1, active_nodes)
+            owners.append(candidates[0] if candidates else None)
+        bounds = [(-1, view.sorted_keys[0], owners[0])]
+        bounds += [(view.sorted_keys[i - 1], view.sorted_keys[i], owners[i]) for i in range(1, len(owners))]
+        bounds.append((view.sorted_keys[-1], _MASK64, owners[0]))
+        ranges = {}
+        for start, end, owner in bounds:
+            if owner is None:
+                continue
+            _append_range(ranges.setdefault(owner, []), start, end)
+        return ranges
+
+    def _segments(self, other=None):
+        """
+        ``(start, end]`` pieces of the hash space on which the preference lists of this
+        ring (and of ``other``) do not change, with their lists: [(start, end, own, other's)].
+        """
+        views = [self._view] + ([other._view] if other is not None else [])
+        bounds = sorted(set().union(*(view.sorted_keys for view in views)))
+        if not bounds:
+            return []
+        if bounds[-1] != _MASK64:
+            bounds.append(_MASK64)
+        segments = []
+        start = -1
+        for end in bounds:
+            lists = tuple(self._preference_at(view, self._index(view, end), self.replicas) if view.sorted_keys
+                          else [] for view in views)
+            segments.append((start, end) + lists)
+            start = end
+        return segments
+
+    def ranges_responsible(self, node):
+        """``(start, end]`` ranges in whose preference list ``node`` is, i.e. the data it should hold."""
+        ranges = []
+        for start, end, preferred in self._segments():
+            if node in preferred:
+                _append_range(ranges, start, end)
+        return ranges
+
+    def get_keys_responsible(self, node, keys):
+        """The subset of ``keys`` that ``node`` should hold a replica of."""
+        return [key for key in keys if node in self.preference_list(key)]
+
+    def transfer_plan(self, new_ring):
+        """
+        What has to move when this ring's membership changes to ``new_ring``'s:
+        {(source, target): [(start, end), ...]}. A target gains a range when it enters
+        the range's preference list; the source is a previous holder that leaves the list
+        (it is giving the range up, e.g. a leaving node), else the first previous holder.
+        Ranges whose preference list is unchanged do not move.
+        """
+        plan = {}
+        for start, end, old, new in self._segments(new_ring):
+            gained = [node for node in new if node not in old]
+            if not gained or not old:
+                continue
+            leaving = [node for node in old if node not in new]
+            source = leaving[0] if leaving else old[0]
+            for target in gained:
+                _append_range(plan.setdefault((source, target), []), start, end)
+        return plan
+
+    def load_distribution(self):
+        """Fraction of the hash space owned by each node."""
+        view = self._view
+        shares = {node: 0 for node in self.weights}
+        if not view.sorted_keys:
+            return shares
+        previous = view.sorted_keys[-1] - (1 << 64)
+        for key, owner in zip(view.sorted_keys, view.owners):
+            shares[owner] += (key - previous) / float(1 << 64)
+            previous = key
+        return shares
+
+
+def _append_range(ranges, start, end):
+    """Append ``(start, end]``, merging it into the previous range when they touch."""
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
@@ -0,0 +1,130 @@
+import bisect
+import json
+import threading
+
+
+class OrderedKeyIndex:
+    """
+    Keys kept in sorted order next to the storage engine, for range and prefix scans.
+
+    Scans are paginated by cursor: pass the last key of a page as ``after`` to get the
+    keys that follow it.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = sorted(set(keys))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            index = bisect.bisect_left(self._keys, key)
+            return index < len(self._keys) and self._keys[index] == key
+
+    def add(self, key):
+        with self._lock:
+            index = bisect.bisect_left(self._keys, key)
+            if index == len(self._keys) or self._keys[index] != key:
+                self._keys.insert(index, key)
+
+    def add_many(self, keys):
+        keys = set(keys)
+        with self._lock:
+            if len(keys) > len(self._keys) // 8:
+                # Cheaper to merge and re-sort than to insert one by one
+                self._keys = sorted(keys.union(self._keys))
+                return
+        for key in keys:
+            self.add(key)
+
+    def remove(self, key):
+        with self._lock:
+            index = bisect.bisect_left(self._keys, key)
+            if index < len(self._keys) and self._keys[index] == key:
+                del self._keys[index]
+
+    def _first(self, start, after):
+        index = bisect.bisect_left(self._keys, start)
+        if after is not None:
+            index = max(index, bisect.bisect_right(self._keys, after))
+        return index
+
+    def range(self, start, end=None, limit=100, after=None):
+        """Up to ``limit`` keys with ``start <= key < end`` (``end=None``: no upper bound)."""
+        with self._lock:
+            first = self._first(start, after)
+            last = len(self._keys) if end is None else bisect.bisect_left(self._keys, end)
+            return self._keys[first:min(last, first + limit)]
+
+    def prefix(self, prefix, limit=100, after=None):
+        """Up to ``limit`` keys starting with ``prefix``."""
+        with self._lock:
+            first = self._first(prefix, after)
+            keys = []
+            for key in self._keys[first:first + limit]:
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+            return keys
+
+
+def attribute_of(value, attribute):
+    """The attribute of a structured value (a dict or a JSON object string) as a string, or None."""
+    if isinstance(value, str):
+        if not value.startswith("{"):
+            return None
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if not isinstance(value, dict):
+        return None
+    found = value.get(attribute)
+    if found is None or isinstance(found, (dict, list)):
+        return None
+    return found if isinstance(found, str) else json.dumps(found)
+
+
+class SecondaryIndex:
+    """
+    Maps one attribute of structured values to the keys holding each attribute value,
+    like a DynamoDB global secondary index. Kept up to date incrementally on every write.
+    """
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self._lock = threading.Lock()
+        self._by_value = {}   # attribute value -> OrderedKeyIndex of keys
+        self._key_value = {}  # key -> its indexed attribute value
+
+    def update(self, key, value):
+        new = attribute_of(value, self.attribute)
+        with self._lock:
+            old = self._key_value.get(key)
+            if old == new:
+                return
+            self._unlink(key, old)
+            if new is not None:
+                self._key_value[key] = new
+                self._by_value.setdefault(new, OrderedKeyIndex()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._unlink(key, self._key_value.get(key))
+
+    def _unlink(self, key, old):
+        if old is None:
+            return
+        del self._key_value[key]
+        keys = self._by_value[old]
+        keys.remove(key)
+        if not len(keys):
+            del self._by_value[old]
+
+    def query(self, attribute_value, limit=100, after=None):
+        """Up to ``limit`` keys, in key order, whose attribute equals ``attribute_value``."""
+        with self._lock:
+            keys = self._by_value.get(attribute_value)
+        return keys.range("", limit=limit, after=after) if keys is not None else []
@@ -0,0 +1,97 @@
+import asyncio
+import struct
+
+# Sent as a plain text command to switch a connection to the framed protocol.
+HELLO = "HELLO BINARY/1"
+HELLO_OK = "BINARY/1 OK"
+
+# body length, request id, flags
+FRAME_HEADER = struct.Struct(">IIB")
+FIELD_LENGTH = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _to_bytes(field):
+    if isinstance(field, bytes):
+        return field
+    return str(field).encode("utf-8")
+
+
+def encode_frame(request_id, fields, flags=STATUS_OK):
+    """
+    Encode one frame: a header followed by length-prefixed fields.
+
+    Requests carry the command name as their first field followed by its arguments;
+    responses carry the response text. Keys and values may contain any bytes,
+    including spaces and newlines.
+    """
+    body = b"".join(FIELD_LENGTH.pack(len(data)) + data for data in map(_to_bytes, fields))
+    if len(body) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(body)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return FRAME_HEADER.pack(len(body), request_id, flags) + body
+
+
+def decode_fields(body):
+    fields = []
+    offset = 0
+    while offset < len(body):
+        if offset + FIELD_LENGTH.size > len(body):
+            raise ProtocolError("Truncated field length")
+        (length,) = FIELD_LENGTH.unpack_from(body, offset)
+        offset += FIELD_LENGTH.size
+        if offset + length > len(body):
+            raise ProtocolError("Truncated field")
+        try:
+            fields.append(body[offset:offset + length].decode("utf-8"))
+        except UnicodeDecodeError as e:
+            raise ProtocolError(f"Field is not valid UTF-8: {e}")
+        offset += length
+    return fields
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        if not data:
+            return None
+        raise ProtocolError("Connection closed mid-frame")
+    return data
+
+
+def read_frame(stream):
+    """Read one frame from a buffered binary stream; returns None on a clean EOF."""
+    header = _read_exact(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, request_id, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    body = _read_exact(stream, length) if length else b""
+    if body is None:
+        raise ProtocolError("Connection closed mid-frame")
+    return request_id, flags, decode_fields(body)
+
+
+async def read_frame_async(reader):
+    """Read one frame from an asyncio StreamReader; returns None on a clean EOF."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed mid-frame")
+    length, request_id, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    try:
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed mid-frame")
+    return request_id, flags, decode_fields(body)
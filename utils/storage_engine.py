@@ -0,0 +1,516 @@
+import contextlib
+import json
+import os
+import struct
+import threading
+import zlib
+import logging
+
+from utils.codec import ValueCodec, is_encoded
+
+
+def fsync_dir(path):
+    """Make file creations, renames and removals in directory ``path`` durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JsonFileEngine:
+    """
+    Legacy engine: keeps everything in a dict and rewrites one JSON file on changes.
+
+    The file is rewritten by a single background flusher, never by request threads.
+    A write returns once a rewrite that includes it is on disk, and writes arriving
+    during a rewrite share the next one, as in the WAL's group commit. Readers only
+    touch the dict and never wait for the flusher.
+    """
+
+    def __init__(self, storage_file):
+        self.storage_file = storage_file
+        self.data = self.load_data()
+        self._cond = threading.Condition()
+        self._version = 0          # bumped after every change to ``data``
+        self._flushed_version = 0
+        self._closed = False
+        self._error = None
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def load_data(self):
+        """Load the data from the storage file, handling empty files gracefully."""
+        if not os.path.exists(self.storage_file) or os.path.getsize(self.storage_file) == 0:
+            return {}
+        try:
+            with open(self.storage_file, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print(f"Error: Failed to decode JSON from {self.storage_file}. Returning empty storage.")
+            return {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value):
+        self.data[key] = value
+        self._changed()
+
+    def put_many(self, items, flush=True):
+        # Bulk loads (restore, replay) pass flush=False and flush once when they are done
+        self.data.update(items)
+        self._changed(wait=flush)
+
+    def delete(self, key):
+        if self.data.pop(key, None) is not None:
+            self._changed()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        yield iter(list(self.data.items()))
+
+    def contains(self, key):
+        return key in self.data
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def items(self):
+        return list(self.data.items())
+
+    def __len__(self):
+        return len(self.data)
+
+    def _changed(self, wait=True):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+            if wait:
+                self._wait_flushed(self._version)
+
+    def _wait_flushed(self, version):
+        while self._flushed_version < version:
+            if self._error is not None:
+                raise self._error
+            self._cond.wait()
+
+    def flush(self):
+        """Block until the storage file holds every change made so far."""
+        with self._cond:
+            self._wait_flushed(self._version)
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while self._flushed_version == self._version and not self._closed:
+                    self._cond.wait()
+                if self._flushed_version == self._version:
+                    return
+                version = self._version
+                data = dict(self.data)
+            try:
+                tmp_path = self.storage_file + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.storage_file)
+                fsync_dir(os.path.dirname(os.path.abspath(self.storage_file)))
+            except (OSError, TypeError, ValueError) as e:
+                logging.error(f"Failed to save {self.storage_file}: {e}")
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._flushed_version = version
+                self._cond.notify_all()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+
+
+class LogStructuredEngine:
+    """
+    Append-only, Bitcask-style engine.
+
+    Every write appends one record to the active segment and updates an in-memory
+    key -> (segment, offset, length) index, so a PUT costs a single small append no
+    matter how many keys are stored. Once the active segment grows past
+    ``max_segment_bytes`` it is sealed; sealed segments are merged in the background
+    when enough of their bytes are shadowed by newer records.
+
+    Values are stored in the compact binary ValueCodec format, compressed per record
+    with ``compression`` (zlib or lzma) once they reach ``compress_min_bytes``;
+    ``value_format="json"`` keeps writing JSON text. Records of either format are
+    readable whatever the setting, and compaction rewrites old ones in the current one.
+    """
+
+    # crc32, key length, value length, flags
+    HEADER = struct.Struct(">IIIB")
+    FLAG_TOMBSTONE = 1
+    SEGMENT_SUFFIX = ".seg"
+
+    def __init__(self, storage_file, max_segment_bytes=4 * 1024 * 1024,
+                 compaction_ratio=0.5, compaction_min_bytes=1024 * 1024,
+                 background_compaction=True, value_format="binary", compression=None,
+                 compress_min_bytes=256):
+        if value_format not in ("binary", "json"):
+            raise ValueError(f"Unknown value format '{value_format}'. Choose from: binary, json")
+        self.storage_file = storage_file
+        self.codec = ValueCodec(compression, min_size=compress_min_bytes) if value_format == "binary" else None
+        self.segment_dir = os.path.splitext(storage_file)[0] + ".segments"
+        self.max_segment_bytes = max_segment_bytes
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+
+        self._lock = threading.RLock()
+        self._index = {}           # key -> (segment_id, value_offset, value_length)
+        self._fds = {}             # segment_id -> read/append file descriptor
+        self._sizes = {}           # segment_id -> bytes written
+        self._dead_bytes = 0
+        self._pins = 0             # open snapshots; compaction waits while any exist
+        self._retired_fds = []     # descriptors of compacted segments, closed by the next compaction
+        self._active_id = None
+        self._closed = False
+        self._compact_event = threading.Event()
+
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self._load_segments()
+        if self._active_id is None:
+            self._open_segment(1)
+            fsync_dir(self.segment_dir)
+            self._import_legacy_json()
+
+        self._compactor = None
+        if background_compaction:
+            self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+            self._compactor.start()
+
+    # -- segment files -------------------------------------------------------
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.segment_dir, f"{segment_id:08d}{self.SEGMENT_SUFFIX}")
+
+    def _open_segment(self, segment_id):
+        fd = os.open(self._segment_path(segment_id), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._fds[segment_id] = fd
+        self._sizes[segment_id] = os.fstat(fd).st_size
+        self._active_id = segment_id
+        return fd
+
+    def _segment_ids(self):
+        ids = []
+        for name in os.listdir(self.segment_dir):
+            if name.endswith(self.SEGMENT_SUFFIX):
+                try:
+                    ids.append(int(name[:-len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(ids)
+
+    def _encode(self, key, value, flags=0):
+        key_bytes = key.encode("utf-8")
+        if flags & self.FLAG_TOMBSTONE:
+            value_bytes = b""
+        elif self.codec is not None:
+            value_bytes = self.codec.encode(value)
+        else:
+            value_bytes = json.dumps(value).encode("utf-8")
+        crc = zlib.crc32(key_bytes + value_bytes + bytes([flags]))
+        header = self.HEADER.pack(crc, len(key_bytes), len(value_bytes), flags)
+        return header + key_bytes + value_bytes, len(header) + len(key_bytes), len(value_bytes)
+
+    @staticmethod
+    def _decode(raw):
+        return ValueCodec.decode(raw) if is_encoded(raw) else json.loads(raw.decode("utf-8"))
+
+    def _scan(self, segment_id):
+        """Yield (key, value_offset, value_length, flags, record_end) for every intact record."""
+        fd = self._fds[segment_id]
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset + self.HEADER.size <= size:
+            crc, key_len, value_len, flags = self.HEADER.unpack(os.pread(fd, self.HEADER.size, offset))
+            end = offset + self.HEADER.size + key_len + value_len
+            if end > size:
+                break
+            body = os.pread(fd, key_len + value_len, offset + self.HEADER.size)
+            if zlib.crc32(body + bytes([flags])) != crc:
+                break
+            key = body[:key_len].decode("utf-8")
+            yield key, offset + self.HEADER.size + key_len, value_len, flags, end
+            offset = end
+        if offset < size:
+            logging.warning(f"Truncating torn record at {self._segment_path(segment_id)}:{offset}")
+            os.ftruncate(fd, offset)
+
+    def _load_segments(self):
+        """Rebuild the in-memory index by scanning every segment in order."""
+        for segment_id in self._segment_ids():
+            self._open_segment(segment_id)
+            for key, value_offset, value_len, flags, end in self._scan(segment_id):
+                previous = self._index.pop(key, None)
+                if previous is not None:
+                    self._dead_bytes += self._record_size(key, previous[2])
+                if flags & self.FLAG_TOMBSTONE:
+                    self._dead_bytes += self._record_size(key, value_len)
+                else:
+                    self._index[key] = (segment_id, value_offset, value_len)
+            self._sizes[segment_id] = os.fstat(self._fds[segment_id]).st_size
+
+    def _import_legacy_json(self):
+        """Carry over data from a pre-existing JSON storage file on first start."""
+        if not os.path.exists(self.storage_file) or os.path.getsize(self.storage_file) == 0:
+            return
+        try:
+            with open(self.storage_file, "r") as f:
+                legacy = json.load(f)
+        except json.JSONDecodeError:
+            logging.error(f"Failed to decode legacy storage {self.storage_file}; starting empty.")
+            return
+        for key, value in legacy.items():
+            self.put(key, value)
+        self.flush()
+        logging.info(f"Imported {len(legacy)} keys from {self.storage_file}")
+
+    def _record_size(self, key, value_len):
+        return self.HEADER.size + len(key.encode("utf-8")) + value_len
+
+    def _append(self, key, value, flags=0):
+        record, value_offset, value_len = self._encode(key, value, flags)
+        if self._sizes[self._active_id] + len(record) > self.max_segment_bytes and self._sizes[self._active_id]:
+            self._roll_segment()
+        segment_id = self._active_id
+        start = self._sizes[segment_id]
+        os.write(self._fds[segment_id], record)
+        self._sizes[segment_id] = start + len(record)
+        return segment_id, start + value_offset, value_len, len(record)
+
+    def _roll_segment(self):
+        # flush() only syncs the active segment, so a segment is made durable as it is sealed
+        os.fsync(self._fds[self._active_id])
+        self._open_segment(self._active_id + 1)
+        fsync_dir(self.segment_dir)
+
+    # -- mapping operations --------------------------------------------------
+
+    def get(self, key):
+        # Lock-free fast path: records are immutable and compaction keeps the descriptors
+        # it replaces open until its next run. If the key's location changed while we
+        # read, the bytes may be stale, so retry.
+        for _ in range(3):
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment_id, offset, length = location
+            try:
+                raw = os.pread(self._fds[segment_id], length, offset)
+            except (KeyError, OSError):
+                continue
+            if self._index.get(key) is location:
+                return self._decode(raw)
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment_id, offset, length = location
+            raw = os.pread(self._fds[segment_id], length, offset)
+        return self._decode(raw)
+
+    def put(self, key, value):
+        with self._lock:
+            segment_id, offset, length, _ = self._append(key, value)
+            previous = self._index.get(key)
+            self._index[key] = (segment_id, offset, length)
+            if previous is not None:
+                self._dead_bytes += self._record_size(key, previous[2])
+        self._maybe_schedule_compaction()
+
+    def put_many(self, items, flush=True):
+        """
+        Append many records with one write per segment and a single lock acquisition.
+        Records reach the segment file immediately, so ``flush`` has nothing to defer.
+        """
+        with self._lock:
+            buffer, locations = [], []
+            size = self._sizes[self._active_id]
+            for key, value in items:
+                record, value_offset, value_len = self._encode(key, value)
+                if buffer and size + len(record) > self.max_segment_bytes:
+                    self._write_buffer(buffer, locations, size)
+                    self._roll_segment()
+                    buffer, locations, size = [], [], 0
+                buffer.append(record)
+                locations.append((key, size + value_offset, value_len))
+                size += len(record)
+            if buffer:
+                self._write_buffer(buffer, locations, size)
+        self._maybe_schedule_compaction()
+
+    def _write_buffer(self, buffer, locations, size):
+        segment_id = self._active_id
+        os.write(self._fds[segment_id], b"".join(buffer))
+        self._sizes[segment_id] = size
+        for key, offset, length in locations:
+            previous = self._index.get(key)
+            self._index[key] = (segment_id, offset, length)
+            if previous is not None:
+                self._dead_bytes += self._record_size(key, previous[2])
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Point-in-time view of the store as an iterator of (key, value).
+
+        Only the index is copied; values are read lazily from the immutable records it
+        points to, so writers keep appending while the snapshot is streamed. Compaction
+        is held off until the snapshot is closed.
+        """
+        with self._lock:
+            index = dict(self._index)
+            self._pins += 1
+        try:
+            yield self._read_locations(index)
+        finally:
+            with self._lock:
+                self._pins -= 1
+
+    def _read_locations(self, index):
+        for key, (segment_id, offset, length) in index.items():
+            yield key, self._decode(os.pread(self._fds[segment_id], length, offset))
+
+    def delete(self, key):
+        with self._lock:
+            previous = self._index.pop(key, None)
+            if previous is None:
+                return
+            _, _, _, record_len = self._append(key, None, self.FLAG_TOMBSTONE)
+            self._dead_bytes += self._record_size(key, previous[2]) + record_len
+        self._maybe_schedule_compaction()
+
+    def contains(self, key):
+        return key in self._index
+
+    def keys(self):
+        with self._lock:
+            return list(self._index.keys())
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def __len__(self):
+        return len(self._index)
+
+    def flush(self):
+        """Force the active segment to disk; sealed segments were synced when they were rolled."""
+        with self._lock:
+            if not self._closed:
+                os.fsync(self._fds[self._active_id])
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.fsync(self._fds[self._active_id])
+            for fd in list(self._fds.values()) + self._retired_fds:
+                os.close(fd)
+            self._fds.clear()
+            self._retired_fds = []
+        self._compact_event.set()
+
+    # -- compaction ----------------------------------------------------------
+
+    def _maybe_schedule_compaction(self):
+        total = sum(self._sizes.values())
+        if self._dead_bytes >= self.compaction_min_bytes and self._dead_bytes >= total * self.compaction_ratio:
+            self._compact_event.set()
+
+    def _compaction_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Compaction of {self.segment_dir} failed: {e}")
+
+    def compact(self):
+        """Merge every sealed segment into one, dropping overwritten and deleted records."""
+        with self._lock:
+            if self._closed or self._pins:
+                return
+            # Seal the active segment so everything written so far can be merged.
+            if self._sizes[self._active_id]:
+                self._roll_segment()
+            victims = [segment_id for segment_id in self._fds if segment_id != self._active_id]
+            if not victims:
+                return
+        target = max(victims)
+        tmp_path = self._segment_path(target) + ".compact"
+
+        # Copy live records without holding the lock; sealed segments never change.
+        moved = []
+        written = 0
+        with open(tmp_path, "wb") as out:
+            for segment_id in sorted(victims):
+                fd = self._fds[segment_id]
+                for key, value_offset, value_len, flags, _ in self._scan(segment_id):
+                    if self._index.get(key) != (segment_id, value_offset, value_len):
+                        continue
+                    value = self._decode(os.pread(fd, value_len, value_offset))
+                    record, new_value_offset, _ = self._encode(key, value)
+                    out.write(record)
+                    moved.append((key, (segment_id, value_offset, value_len), written + new_value_offset))
+                    written += len(record)
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self._lock:
+            if self._closed or self._pins:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self._segment_path(target))
+            # Lock-free readers may still hold the replaced descriptors; close last run's instead
+            for fd in self._retired_fds:
+                os.close(fd)
+            self._retired_fds = []
+            for segment_id in victims:
+                self._retired_fds.append(self._fds.pop(segment_id))
+                self._sizes.pop(segment_id)
+                if segment_id != target:
+                    os.remove(self._segment_path(segment_id))
+            fsync_dir(self.segment_dir)
+            self._fds[target] = os.open(self._segment_path(target), os.O_RDWR | os.O_APPEND)
+            self._sizes[target] = written
+            for key, old_location, new_offset in moved:
+                if self._index.get(key) == old_location:
+                    self._index[key] = (target, new_offset, old_location[2])
+            # Records copied but overwritten meanwhile are already dead in the merged segment.
+            live = sum(self._record_size(key, location[2]) for key, location in self._index.items())
+            self._dead_bytes = sum(self._sizes.values()) - live
+        logging.info(f"Compacted {len(victims)} segment(s) in {self.segment_dir} into {written} bytes")
+
+
+ENGINES = {
+    "json": JsonFileEngine,
+    "log": LogStructuredEngine,
+}
+
+
+def create_engine(engine, storage_file, **options):
+    """Build a storage engine from a registered name and its options, or pass an engine instance through."""
+    if isinstance(engine, str):
+        try:
+            return ENGINES[engine](storage_file, **options)
+        except KeyError:
+            raise ValueError(f"Unknown storage engine '{engine}'. Choose from: {', '.join(ENGINES)}")
+    return engine